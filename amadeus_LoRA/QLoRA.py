@@ -1,8 +1,9 @@
 from unsloth import FastLanguageModel
 import torch
-from datasets import load_dataset
 from trl import SFTTrainer
 from transformers import TrainingArguments
+import os
+from pretokenize import build_or_load_cache, PackedDataset, PackedCollator, report, default_attention
 
 # 1. Configuration
 max_seq_length = 2048 # Supports RoPE Scaling internally, so choose any!
@@ -32,34 +33,34 @@ model = FastLanguageModel.get_peft_model(
     loftq_config = None, # And LoftQ
 )
 
-# 4. Filter Helpers
-EOS_TOKEN = tokenizer.eos_token # Must add EOS_TOKEN
+# 4. Load Dataset (pre-tokenized cache)
+# Chat template + tokenization run once and are cached under .token_cache/ (see pretokenize.py).
+# Short dialogs are packed into max_seq_length rows only when dialogs in a row can be kept from attending
+# to each other: FlashAttention varlen via position_ids. The 4D block mask is opt-in (PACKED_ATTENTION=block)
+# until `python pretokenize.py --check_mask <model>` passes; otherwise each dialog gets its own padded row.
+per_device_train_batch_size = 2
+attention = os.getenv("PACKED_ATTENTION") or default_attention()
+cache = build_or_load_cache(tokenizer, "train.jsonl")
+dataset = PackedDataset(cache, max_seq_length, per_device_train_batch_size, pack = attention != "padded")
+stats = report(cache, max_seq_length, per_device_train_batch_size)
+if attention == "padded":
+    print(f"Packing off (no FlashAttention): {stats['records']} dialogs, one per row")
+else:
+    print(f"Packed {stats['records']} dialogs into {stats['packed_rows']} rows ({attention}, "
+          f"padding efficiency {stats['naive_efficiency']:.1%} -> {stats['packed_efficiency']:.1%})")
 
-def formatting_prompts_func(examples):
-    conversations = examples["messages"]
-    texts = []
-    for conversation in conversations:
-        # Create standard Llama-3 format
-        # <|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n...<|eot_id|>...
-        text = tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=False)
-        texts.append(text)
-    return { "text" : texts, }
-
-# 5. Load Dataset
-dataset = load_dataset("json", data_files="train.jsonl", split="train")
-dataset = dataset.map(formatting_prompts_func, batched = True,)
-
-# 6. Train
+# 5. Train
 trainer = SFTTrainer(
     model = model,
     tokenizer = tokenizer,
     train_dataset = dataset,
-    dataset_text_field = "text",
+    data_collator = PackedCollator(tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+                                   attention = attention, dtype = model.dtype),
     max_seq_length = max_seq_length,
-    dataset_num_proc = 2,
-    packing = False, # Can make training 5x faster for short sequences.
+    dataset_kwargs = {"skip_prepare_dataset": True}, # Already tokenized and packed
     args = TrainingArguments(
-        per_device_train_batch_size = 2,
+        per_device_train_batch_size = per_device_train_batch_size,
+        remove_unused_columns = False, # Keep position_ids for the packed rows
         gradient_accumulation_steps = 4,
         warmup_steps = 5,
         max_steps = 60, # Increase this for full training!
@@ -78,10 +79,12 @@ trainer = SFTTrainer(
 print("Starting training...")
 trainer_stats = trainer.train()
 
-# 7. Export to GGUF
+# 6. Export to GGUF
 print("Exporting to GGUF...")
-# Save to 8bit Q8_0
-model.save_pretrained_gguf("kurisu_model_gguf", tokenizer, quantization_method = "q8_0")
+# Q8_0 に加えて小さい量子化も書き出し、bench_gguf.py で速度と口調を比べてから Modelfile の FROM を選ぶ
+quantization_methods = ["q8_0", "q5_k_m", "q4_k_m"]
+model.save_pretrained_gguf("kurisu_model_gguf", tokenizer, quantization_method = quantization_methods)
 # model.save_pretrained_gguf("kurisu_model_gguf", tokenizer, quantization_method = "f16")
 
 print("Done! GGUF saved to 'kurisu_model_gguf'")
+print("Compare quantizations: python bench_gguf.py --gguf kurisu_model_gguf/*.gguf")
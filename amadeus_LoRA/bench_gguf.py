@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+量子化違いの GGUF を、同じプロンプトセットで Ollama 互換エンドポイントに投げて比べるベンチマーク。
+どの量子化（Q8_0 / Q5_K_M / Q4_K_M ...）をバックエンドに載せるかを決めるためのもの。
+
+計測内容（モデルごと）:
+- プロンプト評価速度 (prompt_eval_count / prompt_eval_duration, tokens/s)
+- 生成速度 (eval_count / eval_duration, tokens/s)
+- 最初のトークンまでの時間 (TTFT, クライアント側で計測。p50 / p90)
+- メモリ: そのモデルを読み込んだ Ollama ランナープロセスだけの RSS（/proc から、GGUF のパスで特定。
+  取れなければ /api/ps の size）。モデルごとに計測が終わったら keep_alive=0 で降ろすので、
+  前のモデルのランナーが残って数字に混ざることはない
+- キャラクター口調スコア（文字数制限・語尾・鉤括弧なし・敬語なし・日本語率の平均, 0〜1）
+
+プロンプトセット:
+- train.jsonl から seed 固定で抜いた会話（最後の assistant の直前まで）
+- バックエンドの実際のプロンプト（back/src/prompts.py の build_amadeus_system_prompt /
+  build_greeting_prompt。0人・1人・グループ）
+どのモデルにも同じ順番で投げ、温度 0・seed 固定で生成する。各モデルの最初に1回ウォームアップ
+（モデルのロード）を入れ、計測からは外す。
+
+使い方:
+  # GGUF から一時モデルを作って比べる（Modelfile のテンプレートを流用。ollama CLI が必要）
+  python bench_gguf.py --gguf kurisu_model_gguf/*.gguf
+  # 登録済みのモデル名で比べる
+  python bench_gguf.py --models kurisu-q8 kurisu-q4 --host http://192.168.1.10:11434 --json bench.json
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "back", "src"))
+from prompts import describe_visual_scene, build_amadeus_system_prompt, build_greeting_prompt  # noqa: E402
+
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://127.0.0.1:11434")
+MODELFILE = os.path.join(HERE, "Modelfile")
+# 口調スコアの許容差。最良スコアからこれ以内なら「品質は許容範囲」として速度で選ぶ
+STYLE_TOLERANCE = 0.05
+
+QUANT_PATTERN = re.compile(r"(I?Q\d_K_[SML]|I?Q\d_K|Q\d_\d|BF16|F16|F32)", re.IGNORECASE)
+ENDINGS = ("わね", "かしら", "のよ", "わよ", "でしょ", "じゃない", "よ", "わ", "ね")
+POLITE = ("です", "ます")
+JAPANESE = re.compile(r"[ぁ-んァ-ヴー一-龥]")
+TRAILING = "。、！？!?…‥ 　"
+
+# ==========================================
+# プロンプトセット
+# ==========================================
+def train_prompts(path: str, n: int, seed: int) -> List[dict]:
+    """train.jsonl から n 件抜き、最後の assistant ターンを参照解答にする"""
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    rng = random.Random(seed)
+    prompts = []
+    for obj in rng.sample(records, min(n, len(records))):
+        msgs = obj["messages"]
+        last = max(i for i, m in enumerate(msgs) if m["role"] == "assistant")
+        prompts.append({
+            "id": f"train:{obj.get('id', len(prompts))}",
+            "kind": "train",
+            "messages": msgs[:last],
+            "max_chars": 50,
+            "reference": msgs[last]["content"],
+        })
+    return prompts
+
+def backend_prompts() -> List[dict]:
+    """バックエンドが実際に送るのと同じ形のプロンプト"""
+    scenes = [
+        (0, None),
+        (1, [{"x": 0.0, "y": 0.0}]),
+        (1, [{"x": -0.5, "y": 0.1}]),
+        (3, [{"x": -0.5, "y": 0.0}, {"x": 0.0, "y": 0.0}, {"x": 0.5, "y": 0.0}]),
+    ]
+    user_inputs = [None, "こんにちは", "タイムマシンって作れると思う？", "クリスティーナ"]
+    prompts = []
+    for face_count, positions in scenes:
+        visual = describe_visual_scene(face_count, positions)
+        system = build_amadeus_system_prompt(face_count, visual)
+        for text in user_inputs:
+            user = text if text else f"[状況: {visual}] 何か一言話しかけて。"
+            prompts.append({
+                "id": f"backend:{face_count}:{text or 'idle'}",
+                "kind": "backend",
+                "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
+                "max_chars": 50,
+                "reference": None,
+            })
+        if face_count:
+            prompts.append({
+                "id": f"greeting:{face_count}",
+                "kind": "greeting",
+                "messages": [
+                    {"role": "system", "content": build_greeting_prompt(face_count)},
+                    {"role": "user", "content": visual},
+                ],
+                "max_chars": 40,
+                "reference": None,
+            })
+    return prompts
+
+# ==========================================
+# 口調スコア
+# ==========================================
+def style_score(text: str, max_chars: int) -> Dict[str, float]:
+    """キャラクター口調の簡易スコア（各項目 0〜1 と平均）"""
+    t = text.strip()
+    body = t.rstrip(TRAILING)
+    n = len(t)
+    parts = {
+        "length": 1.0 if n <= max_chars else max(0.0, 1.0 - (n - max_chars) / max_chars),
+        "ending": 1.0 if body.endswith(ENDINGS) else 0.0,
+        "no_brackets": 0.0 if ("「" in t or "」" in t) else 1.0,
+        "no_polite": 0.0 if any(p in t for p in POLITE) else 1.0,
+        "japanese": 1.0 if n and len(JAPANESE.findall(t)) / n >= 0.5 else 0.0,
+    }
+    parts["score"] = sum(parts.values()) / len(parts)
+    return parts
+
+# ==========================================
+# Ollama とのやり取り
+# ==========================================
+def chat_stream(host: str, model: str, messages: List[dict], options: dict, timeout: float) -> dict:
+    """/api/chat をストリームで呼び、本文・TTFT・Ollama の計測値を返す"""
+    body = json.dumps({"model": model, "messages": messages, "stream": True, "options": options}).encode("utf-8")
+    req = urllib.request.Request(f"{host}/api/chat", data=body, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    ttft = None
+    text = []
+    final = {}
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        for line in resp:
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise RuntimeError(chunk["error"])
+            piece = chunk.get("message", {}).get("content", "")
+            if piece and ttft is None:
+                ttft = time.perf_counter() - start
+            text.append(piece)
+            if chunk.get("done"):
+                final = chunk
+    return {
+        "text": "".join(text),
+        "ttft_s": ttft if ttft is not None else time.perf_counter() - start,
+        "total_s": time.perf_counter() - start,
+        "prompt_eval_count": final.get("prompt_eval_count", 0),
+        "prompt_eval_duration": final.get("prompt_eval_duration", 0),
+        "eval_count": final.get("eval_count", 0),
+        "eval_duration": final.get("eval_duration", 0),
+    }
+
+def post_json(host: str, path: str, payload: dict, timeout: float = 30.0) -> dict:
+    body = json.dumps(payload).encode("utf-8")
+    req = urllib.request.Request(f"{host}{path}", data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read() or b"{}")
+
+def model_blob(host: str, model: str) -> Optional[str]:
+    """モデルの GGUF の実体のパス（/api/show の Modelfile の FROM 行。ランナーのコマンドラインに現れる）"""
+    try:
+        data = post_json(host, "/api/show", {"model": model, "name": model})
+    except (OSError, ValueError):
+        return None
+    for line in data.get("modelfile", "").splitlines():
+        if line.startswith("FROM "):
+            return line[len("FROM "):].strip()
+    return None
+
+def unload(host: str, model: str, wait: float = 30.0):
+    """keep_alive=0 でモデルを降ろし、/api/ps から消えるまで待つ"""
+    try:
+        post_json(host, "/api/generate", {"model": model, "keep_alive": 0, "stream": False})
+    except OSError as e:
+        print(f"  unload {model} failed: {e}")
+        return
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline and loaded_size_mb(host, model) is not None:
+        time.sleep(0.5)
+
+def loaded_size_mb(host: str, model: str) -> Optional[float]:
+    """/api/ps が報告するモデルのメモリ量"""
+    try:
+        with urllib.request.urlopen(f"{host}/api/ps", timeout=5) as resp:
+            data = json.loads(resp.read())
+    except OSError:
+        return None
+    for m in data.get("models", []):
+        if m.get("name", "").split(":")[0] == model.split(":")[0]:
+            return m.get("size", 0) / (1 << 20)
+    return None
+
+def runner_rss_mb(blob: Optional[str]) -> Optional[float]:
+    """blob（GGUF のパス）を読み込んでいるローカルの Ollama ランナープロセスの RSS（Linux のみ）"""
+    if blob is None or not os.path.isdir("/proc"):
+        return None
+    needle = blob.encode()
+    total = 0
+    found = False
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmd = f.read().replace(b"\0", b" ")
+            if needle not in cmd:
+                continue
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        found = True
+                        break
+        except OSError:
+            continue
+    return total / 1024 if found else None
+
+def create_model(gguf: str, modelfile: str) -> str:
+    """GGUF から一時モデルを作る（Modelfile の FROM だけ差し替える）"""
+    m = QUANT_PATTERN.search(os.path.basename(gguf))
+    tag = m.group(1).lower() if m else re.sub(r"[^a-z0-9]+", "-", os.path.basename(gguf).lower())
+    name = f"kurisu-bench-{tag}"
+    with open(modelfile, encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    lines = [f"FROM {os.path.abspath(gguf)}" if l.startswith("FROM ") else l for l in lines]
+    with tempfile.NamedTemporaryFile("w", suffix=".Modelfile", delete=False, encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+        tmp = f.name
+    try:
+        print(f"creating {name} from {gguf}")
+        subprocess.run(["ollama", "create", name, "-f", tmp], check=True)
+    finally:
+        os.remove(tmp)
+    return name
+
+# ==========================================
+# ベンチマーク本体
+# ==========================================
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(q / 100 * (len(s) - 1))))]
+
+def bench_model(host: str, model: str, prompts: List[dict], options: dict,
+                repeat: int, timeout: float) -> dict:
+    blob = model_blob(host, model)
+    try:
+        # ウォームアップ（モデルのロード時間を計測に入れない）
+        chat_stream(host, model, prompts[0]["messages"], options, timeout)
+        rss_peak = runner_rss_mb(blob)
+
+        runs = []
+        for _ in range(repeat):
+            for p in prompts:
+                r = chat_stream(host, model, p["messages"], options, timeout)
+                r.update({"id": p["id"], "kind": p["kind"], "style": style_score(r["text"], p["max_chars"])})
+                runs.append(r)
+                rss = runner_rss_mb(blob)
+                if rss is not None:
+                    rss_peak = max(rss_peak or 0.0, rss)
+        loaded_mb = loaded_size_mb(host, model)
+    finally:
+        # 次のモデルの計測に残らないように降ろす
+        unload(host, model)
+
+    prompt_tokens = sum(r["prompt_eval_count"] for r in runs)
+    prompt_ns = sum(r["prompt_eval_duration"] for r in runs)
+    gen_tokens = sum(r["eval_count"] for r in runs)
+    gen_ns = sum(r["eval_duration"] for r in runs)
+    ttfts = [r["ttft_s"] for r in runs]
+    by_kind = {}
+    for kind in sorted({r["kind"] for r in runs}):
+        scores = [r["style"]["score"] for r in runs if r["kind"] == kind]
+        by_kind[kind] = round(statistics.mean(scores), 3)
+    return {
+        "model": model,
+        "requests": len(runs),
+        "prompt_tok_s": prompt_tokens / (prompt_ns / 1e9) if prompt_ns else 0.0,
+        "gen_tok_s": gen_tokens / (gen_ns / 1e9) if gen_ns else 0.0,
+        "ttft_p50_ms": percentile(ttfts, 50) * 1000,
+        "ttft_p90_ms": percentile(ttfts, 90) * 1000,
+        "rss_mb": rss_peak,
+        "loaded_mb": loaded_mb,
+        "style": round(statistics.mean(r["style"]["score"] for r in runs), 3),
+        "style_by_kind": by_kind,
+        "samples": [{"id": r["id"], "text": r["text"], "style": round(r["style"]["score"], 3)} for r in runs],
+    }
+
+def choose(results: List[dict], tolerance: float = STYLE_TOLERANCE) -> Optional[dict]:
+    """口調スコアが最良から tolerance 以内のもののうち、生成が一番速いもの"""
+    if not results:
+        return None
+    best_style = max(r["style"] for r in results)
+    ok = [r for r in results if r["style"] >= best_style - tolerance]
+    return max(ok, key=lambda r: r["gen_tok_s"])
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--gguf", nargs="*", default=[], help="GGUF files (temporary Ollama models are created)")
+    ap.add_argument("--models", nargs="*", default=[], help="Already registered Ollama model names")
+    ap.add_argument("--host", default=OLLAMA_HOST)
+    ap.add_argument("--modelfile", default=MODELFILE, help="Modelfile whose TEMPLATE/PARAMETER are reused for --gguf")
+    ap.add_argument("--train", default="train.jsonl")
+    ap.add_argument("--n_train", type=int, default=24, help="Prompts drawn from the training data")
+    ap.add_argument("--seed", type=int, default=3407)
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--num_predict", type=int, default=96)
+    ap.add_argument("--num_ctx", type=int, default=2048)
+    ap.add_argument("--threads", type=int, default=None, help="num_thread for the runner")
+    ap.add_argument("--timeout", type=float, default=300.0)
+    ap.add_argument("--keep", action="store_true", help="Keep models created from --gguf")
+    ap.add_argument("--json", default=None, help="Write the full results as JSON")
+    args = ap.parse_args(argv)
+
+    if not args.gguf and not args.models:
+        ap.error("give --gguf and/or --models")
+
+    prompts = train_prompts(args.train, args.n_train, args.seed) + backend_prompts()
+    options = {"temperature": 0, "seed": args.seed, "num_predict": args.num_predict, "num_ctx": args.num_ctx}
+    if args.threads:
+        options["num_thread"] = args.threads
+    print(f"prompts: {len(prompts)} x {args.repeat}, host: {args.host}")
+
+    created = [create_model(g, args.modelfile) for g in args.gguf]
+    results = []
+    try:
+        for model in created + args.models:
+            print(f"benchmarking {model} ...")
+            r = bench_model(args.host, model, prompts, options, args.repeat, args.timeout)
+            results.append(r)
+            print(f"  prompt {r['prompt_tok_s']:.1f} tok/s, gen {r['gen_tok_s']:.1f} tok/s, "
+                  f"ttft p50 {r['ttft_p50_ms']:.0f} ms, style {r['style']:.3f}")
+    finally:
+        if not args.keep:
+            for name in created:
+                subprocess.run(["ollama", "rm", name], check=False)
+
+    def mb(v):
+        return f"{v:.0f}" if v is not None else "-"
+
+    print()
+    print(f"{'model':<28}{'prompt t/s':>11}{'gen t/s':>9}{'ttft p50':>10}{'ttft p90':>10}{'rss MB':>8}{'style':>7}")
+    for r in results:
+        print(f"{r['model']:<28}{r['prompt_tok_s']:>11.1f}{r['gen_tok_s']:>9.1f}{r['ttft_p50_ms']:>10.0f}"
+              f"{r['ttft_p90_ms']:>10.0f}{mb(r['rss_mb'] or r['loaded_mb']):>8}{r['style']:>7.3f}")
+    pick = choose(results)
+    if pick:
+        print(f"recommended: {pick['model']} (fastest generation within {STYLE_TOLERANCE} of the best style score)")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"options": options, "prompts": len(prompts), "results": results,
+                       "recommended": pick["model"] if pick else None}, f, ensure_ascii=False, indent=2)
+        print(f"results -> {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+学習用 JSONL ({"id", "messages"}) のスキーマ検査。学習前にパイプラインで回す想定。
+
+検査内容（1行につき全項目を見る）:
+- JSON として読めるか、messages がリストか
+- 各メッセージが role / content を持ち、role が system/user/assistant のどれか
+- 先頭が system ターン
+- system の後は user → assistant → user ... の交互
+- 最後が assistant ターン
+- 長さ制限（assistant / user の文字数、ターン数）
+
+大きいファイルは mmap して行境界で区切り、チャンクごとにプロセス並列で検査する。
+orjson があれば使う。結果は機械可読なレポート(JSON)にも出せる。
+エラーがあれば終了コード 1。
+
+使い方:
+  python check.py
+  python check.py --in train.jsonl train.fixed.jsonl --workers 4 --report check_report.json
+"""
+
+import argparse
 import json
+import mmap
+import os
+import sys
+from collections import Counter
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _DecodeError = orjson.JSONDecodeError
+except ImportError:
+    _loads = json.loads
+    _DecodeError = json.JSONDecodeError
+
+ROLES = ("system", "user", "assistant")
+CHUNK_BYTES = 8 << 20  # 1チャンクの目安サイズ
+MAX_PRINT = 50  # 画面に出すエラー数
+
+# 検査の設定（ワーカーへは initializer で渡す）
+_limits = {"max_assistant_len": 140, "max_user_len": 200, "max_turns": 12}
+
+def _init_worker(limits: dict):
+    _limits.update(limits)
+
+def validate_record(obj) -> List[Tuple[str, str]]:
+    """1レコードを検査して [(コード, 説明)] を返す（問題が無ければ空）"""
+    errors = []
+    if not isinstance(obj, dict):
+        return [("not_object", "record is not a JSON object")]
+    msgs = obj.get("messages")
+    if not isinstance(msgs, list) or not msgs:
+        return [("no_messages", "messages is missing or empty")]
+
+    roles = []
+    for i, m in enumerate(msgs):
+        if not isinstance(m, dict) or "role" not in m or "content" not in m:
+            errors.append(("bad_message", f"message {i} lacks role/content"))
+            roles.append(None)
+            continue
+        role, content = m["role"], m["content"]
+        if role not in ROLES:
+            errors.append(("bad_role", f"message {i} has role {role!r}"))
+        if not isinstance(content, str) or not content.strip():
+            errors.append(("empty_content", f"message {i} ({role}) has empty content"))
+        elif role == "assistant" and len(content) > _limits["max_assistant_len"]:
+            errors.append(("assistant_too_long", f"message {i} is {len(content)} chars"))
+        elif role == "user" and len(content) > _limits["max_user_len"]:
+            errors.append(("user_too_long", f"message {i} is {len(content)} chars"))
+        roles.append(role)
+
+    if roles[0] != "system":
+        errors.append(("no_system", "first message is not a system turn"))
+    body = roles[1:] if roles[0] == "system" else roles
+    for i, role in enumerate(body):
+        expected = "user" if i % 2 == 0 else "assistant"
+        if role is not None and role != expected:
+            errors.append(("bad_alternation", f"turn {i} is {role}, expected {expected}"))
+            break
+    if roles[-1] != "assistant":
+        errors.append(("last_not_assistant", f"last message is {roles[-1]}"))
+    if len(body) > _limits["max_turns"]:
+        errors.append(("too_many_turns", f"{len(body)} turns"))
+    return errors
+
+def check_chunk(job: Tuple[str, int, int]) -> Tuple[int, List[Tuple[int, str, str]]]:
+    """ファイルの [start, end) を検査して (行数, [(チャンク内行番号, コード, 説明)]) を返す"""
+    path, start, end = job
+    errors = []
+    lines = 0
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = start
+        while pos < end:
+            nl = mm.find(b"\n", pos, end)
+            stop = end if nl < 0 else nl
+            line = mm[pos:stop]
+            pos = stop + 1
+            lines += 1
+            if not line.strip():
+                continue
+            try:
+                obj = _loads(line)
+            except (_DecodeError, ValueError) as e:
+                errors.append((lines, "invalid_json", str(e)))
+                continue
+            for code, msg in validate_record(obj):
+                errors.append((lines, code, msg))
+    return lines, errors
+
+def split_chunks(path: str, chunk_bytes: int) -> List[Tuple[str, int, int]]:
+    """ファイルを行境界で区切った (path, start, end) のリスト"""
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    jobs = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = min(start + chunk_bytes, size)
+            if end < size:
+                nl = mm.find(b"\n", end)
+                end = size if nl < 0 else nl + 1
+            jobs.append((path, start, end))
+            start = end
+    return jobs
+
+def check_files(paths: List[str], limits: dict, workers: int = 1,
+                chunk_bytes: int = CHUNK_BYTES) -> dict:
+    """複数ファイルを検査してレポートを返す"""
+    jobs = [job for p in paths for job in split_chunks(p, chunk_bytes)]
+    if workers > 1 and len(jobs) > 1:
+        with Pool(workers, initializer=_init_worker, initargs=(limits,)) as pool:
+            results = pool.map(check_chunk, jobs)
+    else:
+        _init_worker(limits)
+        results = [check_chunk(job) for job in jobs]
+
+    # チャンク内の行番号をファイル内の行番号に直す
+    errors = []
+    line_base: Dict[str, int] = Counter()
+    totals: Dict[str, int] = Counter()
+    for (path, _, _), (lines, chunk_errors) in zip(jobs, results):
+        for line, code, msg in chunk_errors:
+            errors.append({"file": path, "line": line_base[path] + line, "code": code, "message": msg})
+        line_base[path] += lines
+        totals[path] += lines
+
+    bad_lines = {(e["file"], e["line"]) for e in errors}
+    return {
+        "files": paths,
+        "limits": limits,
+        "total": sum(totals.values()),
+        "bad": len(bad_lines),
+        "per_file": {p: {"total": totals[p], "bad": sum(1 for f, _ in bad_lines if f == p)} for p in paths},
+        "counts_by_code": dict(Counter(e["code"] for e in errors)),
+        "errors": errors,
+    }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--in", dest="inp", nargs="+", default=["train.jsonl"], help="Input JSONL files")
+    ap.add_argument("--report", default=None, help="Write a JSON error report")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--chunk_mb", type=int, default=CHUNK_BYTES >> 20, help="Chunk size in MB")
+    ap.add_argument("--max_assistant_len", type=int, default=_limits["max_assistant_len"])
+    ap.add_argument("--max_user_len", type=int, default=_limits["max_user_len"])
+    ap.add_argument("--max_turns", type=int, default=_limits["max_turns"])
+    args = ap.parse_args(argv)
+
+    limits = {
+        "max_assistant_len": args.max_assistant_len,
+        "max_user_len": args.max_user_len,
+        "max_turns": args.max_turns,
+    }
+    report = check_files(args.inp, limits, args.workers, args.chunk_mb << 20)
+
+    for e in report["errors"][:MAX_PRINT]:
+        print(f"[BAD] {e['file']} line {e['line']}: {e['code']} ({e['message']})")
+    if len(report["errors"]) > MAX_PRINT:
+        print(f"... {len(report['errors']) - MAX_PRINT} more errors")
+    for code, n in sorted(report["counts_by_code"].items()):
+        print(f"  {code:<20}: {n}")
+    print(f"total={report['total']}, bad={report['bad']}")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"report -> {args.report}")
+    return 1 if report["bad"] else 0
 
-bad = 0
-total = 0
-
-with open("train.jsonl", encoding="utf-8") as f:
-    for i, line in enumerate(f, 1):
-        total += 1
-        obj = json.loads(line)
-        msgs = obj.get("messages", [])
-        for m in msgs:
-            if not isinstance(m, dict) or "role" not in m or "content" not in m:
-                bad += 1
-                print(f"[BAD] line {i}: {m}")
-                break
-
-print(f"total={total}, bad={bad}")
+if __name__ == "__main__":
+    sys.exit(main())
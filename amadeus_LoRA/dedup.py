@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+学習用 JSONL ({"id", "messages"}) から完全重複・ほぼ重複の会話を取り除くスクリプト。
+
+特徴:
+- assistant ターンの文字 n-gram（シングル）で MinHash を作り、LSH で候補を絞る
+- 候補は MinHash から推定した Jaccard 類似度が --threshold 以上なら重複とみなす
+- 入力は1行ずつストリーム処理。索引（署名・バケット・完全一致のダイジェスト）は --max_index 件の固定容量で、
+  溢れたら古く残したレコードから忘れる。完全一致のダイジェストは1件あたり自分の分と、
+  ほぼ重複の直近 MAX_NEAR_DIGESTS 件まで（それより古いほぼ重複の再来は MinHash で見つける）。
+  メモリは --max_index で決まり、入力の大きさにはよらない
+  （忘れたレコードとの重複は見逃すので、全件を確実に比べたいときは残る件数より大きくする）
+- 重複クラスタとサイズ削減量をレポート(JSON)に出す
+
+使い方:
+  python dedup.py --in train.fixed.jsonl train.paraphrased.jsonl --out train.dedup.jsonl --report dedup_report.json
+  python dedup.py --in train.jsonl --out train.dedup.jsonl --threshold 0.9 --num_perm 128 --bands 32
+"""
+
+import argparse
+import hashlib
+import heapq
+import json
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# MinHash のハッシュ族 h(x) = (a*x + b) mod P（P はメルセンヌ素数 2^31-1、uint64 で溢れない）
+MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+# レポートに載せるクラスタ数と、1クラスタあたりのID数
+REPORT_TOP_CLUSTERS = 50
+REPORT_MAX_MEMBERS = 20
+# 残したレコード1件が覚えておく、ほぼ重複の完全一致ダイジェストの数
+MAX_NEAR_DIGESTS = 4
+
+def assistant_text(obj: dict) -> str:
+    """重複判定に使うテキスト（assistant ターンを連結）"""
+    return "\n".join(
+        m.get("content", "").strip()
+        for m in obj.get("messages", [])
+        if m.get("role") == "assistant"
+    )
+
+def shingle_hashes(text: str, k: int) -> np.ndarray:
+    """文字 k-gram の集合を 31bit ハッシュ配列にする"""
+    if len(text) <= k:
+        grams = {text}
+    else:
+        grams = {text[i:i + k] for i in range(len(text) - k + 1)}
+    return np.fromiter(
+        (zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams)
+    ) % MERSENNE_PRIME
+
+class MinHashLSH:
+    """
+    MinHash 署名と LSH バケットを管理する（容量 capacity の固定リング）。
+    レコード番号は残した順の通し番号で、番号 % capacity の枠に入る。枠が一周したら前の持ち主を索引から外す
+    """
+
+    def __init__(self, num_perm: int, bands: int, threshold: float, capacity: int, seed: int = 1):
+        if num_perm % bands != 0:
+            raise SystemExit("--num_perm must be divisible by --bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.capacity = capacity
+        rng = np.random.default_rng(seed)
+        p = int(MERSENNE_PRIME)
+        self.a = rng.integers(1, p, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, p, size=num_perm, dtype=np.uint64)
+        # バンドごとの {バケットキー: 代表レコード番号}
+        self.buckets: List[Dict[bytes, int]] = [dict() for _ in range(bands)]
+        # 枠ごとの署名・バンドキー・完全一致のダイジェスト（必要に応じて capacity まで倍々で拡張）
+        self.signatures = np.empty((min(1024, capacity), num_perm), dtype=np.uint32)
+        self.slot_keys: List[Optional[List[bytes]]] = []
+        self.slot_digests: List[List[bytes]] = []
+        # 正規化テキストのダイジェスト -> 代表レコード番号
+        self.exact: Dict[bytes, int] = {}
+        self.size = 0  # これまでに残した数（= 次の番号）
+        self.evicted = 0
+
+    def signature(self, hashes: np.ndarray) -> np.ndarray:
+        # (num_perm, 1) x (1, n) を一度に計算して行ごとの最小値を取る
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+    def band_keys(self, sig: np.ndarray) -> List[bytes]:
+        return [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def lookup_exact(self, digest: bytes) -> int:
+        return self.exact.get(digest, -1)
+
+    def add_digest(self, digest: bytes, rep: int):
+        """
+        rep に重なるテキストのダイジェストを覚える（rep を忘れるときに一緒に消す）。
+        先頭は rep 自身の分で、ほぼ重複の分は直近 MAX_NEAR_DIGESTS 件だけ残す
+        """
+        if digest in self.exact:
+            return
+        digests = self.slot_digests[rep % self.capacity]
+        self.exact[digest] = rep
+        digests.append(digest)
+        if len(digests) > 1 + MAX_NEAR_DIGESTS:
+            old = digests.pop(1)
+            if self.exact.get(old) == rep:
+                del self.exact[old]
+
+    def query(self, sig: np.ndarray, keys: List[bytes]) -> Tuple[int, float]:
+        """最も似ている既存レコード（類似度が閾値以上）を返す。無ければ (-1, 0.0)"""
+        candidates = {self.buckets[i][key] for i, key in enumerate(keys) if key in self.buckets[i]}
+        if not candidates:
+            return -1, 0.0
+        reps = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        sims = (self.signatures[reps % self.capacity] == sig[None, :]).mean(axis=1)
+        best = int(sims.argmax())
+        if sims[best] >= self.threshold:
+            return int(reps[best]), float(sims[best])
+        return -1, 0.0
+
+    def insert(self, sig: np.ndarray, keys: List[bytes], digest: bytes) -> Tuple[int, int]:
+        """
+        残したレコードを索引に入れる。(番号, 追い出した番号) を返す（追い出していなければ -1）
+        """
+        rep = self.size
+        slot = rep % self.capacity
+        evicted = -1
+        if slot < len(self.slot_keys):
+            evicted = rep - self.capacity
+            for i, key in enumerate(self.slot_keys[slot]):
+                if self.buckets[i].get(key) == evicted:
+                    del self.buckets[i][key]
+            for d in self.slot_digests[slot]:
+                if self.exact.get(d) == evicted:
+                    del self.exact[d]
+            self.slot_digests[slot] = []
+            self.evicted += 1
+        else:
+            if slot == len(self.signatures):
+                grown = np.empty((min(len(self.signatures) * 2, self.capacity), self.num_perm), dtype=np.uint32)
+                grown[:slot] = self.signatures[:slot]
+                self.signatures = grown
+            self.slot_keys.append(None)
+            self.slot_digests.append([])
+        self.signatures[slot] = sig
+        self.slot_keys[slot] = keys
+        for i, key in enumerate(keys):
+            self.buckets[i].setdefault(key, rep)
+        self.add_digest(digest, rep)
+        self.size += 1
+        return rep, evicted
+
+class ClusterLog:
+    """
+    重複クラスタの記録。索引にある代表のクラスタだけを手元で数え、代表が索引から外れたら
+    大きい順の上位 top 件だけを残す（クラスタ数が増えてもメモリは一定）
+    """
+
+    def __init__(self, top: int):
+        self.top = top
+        self.active: Dict[int, dict] = {}  # 代表レコード番号 -> クラスタ
+        self.ids: Dict[int, str] = {}  # 索引にある代表のレコードID
+        self.finished: List[Tuple[int, int, dict]] = []  # (重複数, 番号, クラスタ) の最小ヒープ
+        self.count = 0
+
+    def kept(self, rep: int, rec_id: str):
+        self.ids[rep] = rec_id
+
+    def duplicate(self, rep: int, rec_id: str, text: str):
+        c = self.active.get(rep)
+        if c is None:
+            c = self.active[rep] = {"representative": self.ids[rep], "duplicates": 0,
+                                    "sample_ids": [], "sample_text": text}
+            self.count += 1
+        c["duplicates"] += 1
+        if len(c["sample_ids"]) < REPORT_MAX_MEMBERS:
+            c["sample_ids"].append(rec_id)
+
+    def evict(self, rep: int):
+        self.ids.pop(rep, None)
+        c = self.active.pop(rep, None)
+        if c is None:
+            return
+        item = (c["duplicates"], rep, c)
+        if len(self.finished) < self.top:
+            heapq.heappush(self.finished, item)
+        elif item[:2] > self.finished[0][:2]:
+            heapq.heapreplace(self.finished, item)
+
+    def largest(self) -> List[dict]:
+        for rep in list(self.active):
+            self.evict(rep)
+        return [c for _, _, c in sorted(self.finished, key=lambda t: (-t[0], t[1]))]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--in", dest="inp", nargs="+", required=True, help="Input JSONL files (deduplicated together)")
+    ap.add_argument("--out", dest="out", required=True, help="Output JSONL")
+    ap.add_argument("--report", default=None, help="Write duplicate clusters as JSON")
+    ap.add_argument("--threshold", type=float, default=0.8, help="Estimated Jaccard similarity to count as duplicate")
+    ap.add_argument("--shingle", type=int, default=3, help="Character shingle size")
+    ap.add_argument("--num_perm", type=int, default=64, help="Number of MinHash permutations")
+    ap.add_argument("--bands", type=int, default=16, help="LSH bands (num_perm / bands rows each)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--max_index", type=int, default=1000000,
+                    help="Kept records remembered for comparison (memory is bounded by this)")
+    args = ap.parse_args()
+
+    lsh = MinHashLSH(args.num_perm, args.bands, args.threshold, max(1, args.max_index), args.seed)
+    clusters = ClusterLog(REPORT_TOP_CLUSTERS)
+
+    total = exact_dups = near_dups = 0
+    bytes_in = bytes_out = 0
+    with open(args.out, "w", encoding="utf-8") as wf:
+        for path in args.inp:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    total += 1
+                    bytes_in += len(line.encode("utf-8"))
+                    obj = json.loads(line)
+                    rec_id = str(obj.get("id", f"{path}:{total}"))
+                    text = assistant_text(obj)
+
+                    # 1) 完全一致（空白の違いは無視）
+                    digest = hashlib.blake2b("".join(text.split()).encode("utf-8"), digest_size=8).digest()
+                    rep = lsh.lookup_exact(digest)
+                    if rep >= 0:
+                        exact_dups += 1
+                    else:
+                        # 2) ほぼ一致（MinHash + LSH）
+                        sig = lsh.signature(shingle_hashes(text, args.shingle))
+                        keys = lsh.band_keys(sig)
+                        rep, _ = lsh.query(sig, keys)
+                        if rep >= 0:
+                            near_dups += 1
+                            lsh.add_digest(digest, rep)
+                        else:
+                            rep, evicted = lsh.insert(sig, keys, digest)
+                            if evicted >= 0:
+                                clusters.evict(evicted)
+                            clusters.kept(rep, rec_id)
+                            wf.write(line if line.endswith("\n") else line + "\n")
+                            bytes_out += len(line.encode("utf-8"))
+                            continue
+
+                    # 重複: クラスタに記録（IDはサンプルだけ保持）
+                    clusters.duplicate(rep, rec_id, text)
+
+    kept = total - exact_dups - near_dups
+    print(f"records in           : {total}")
+    print(f"exact duplicates     : {exact_dups}")
+    print(f"near duplicates      : {near_dups}")
+    print(f"records out          : {kept}")
+    if total:
+        print(f"reduction            : {1 - kept / total:.2%} records, {1 - bytes_out / max(bytes_in, 1):.2%} bytes")
+    print(f"duplicate clusters   : {clusters.count}")
+    if lsh.evicted:
+        print(f"index evictions      : {lsh.evicted} (raise --max_index to compare against every kept record)")
+
+    if args.report:
+        report = {
+            "params": {
+                "threshold": args.threshold,
+                "shingle": args.shingle,
+                "num_perm": args.num_perm,
+                "bands": args.bands,
+                "max_index": args.max_index,
+            },
+            "records_in": total,
+            "records_out": kept,
+            "exact_duplicates": exact_dups,
+            "near_duplicates": near_dups,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "index_evictions": lsh.evicted,
+            "num_clusters": clusters.count,
+            "clusters": clusters.largest(),
+        }
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"report -> {args.report}")
+
+if __name__ == "__main__":
+    main()
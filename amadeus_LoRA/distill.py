@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+kurisu.json の台詞のまわりに、大きめのローカルモデル（教師）で自然な user 発話を書かせて
+学習データ(train.jsonl と同じ {"id", "messages"} 形式)を作る蒸留スクリプト。
+
+build_train_jsonl.py はテンプレートの部品から user 発話を作るので、「それってどういう意味？」の
+ような同じ言い回しが何度も出る。ここでは会話の型（dialog_templates.json の description）と
+assistant の台詞だけを決め、その前に来る user 発話を教師モデルに考えさせる。
+
+特徴:
+- 1件 = (台詞, テンプレート)。assistant の発話数はテンプレートの assistant_turns の範囲から、
+  2発目以降の台詞は extra プールから、どちらも台詞とテンプレート名のハッシュで選ぶ（毎回同じ）
+- Ollama 互換の /api/chat を asyncio で並列に呼ぶ（同時に投げるのは --concurrency 件まで。
+  未処理の件をまとめてタスクにしないので、10万件でもメモリは増えない）
+- 結果は (台詞, テンプレート, モデル, 教師プロンプト) のハッシュをキーに --cache（JSONL）へ1件ずつ追記する
+  途中で止めても、同じコマンドをもう一度実行すれば終わった件は呼ばずに続きから再開する
+  （モデルを変えればキーが変わるので、同じキャッシュに複数のモデルの結果を置ける）
+- 教師の返答は JSON（{"user": [...]}）で受け取り、数・長さ・台詞の丸写しを確かめる。駄目なら --retries 回まで
+  やり直し、それでも駄目な件はキャッシュに残さない（次回もう一度試す）
+- --mock でプロセス内に Ollama 互換のモックサーバーを立てる（オフラインでの動作確認用）
+
+使い方:
+  python distill.py --in kurisu.json --out train.distilled.jsonl --model qwen2.5:32b --concurrency 32
+  python distill.py --in kurisu.json --out train.distilled.jsonl --model qwen2.5:32b --n 100000   # 中断後も同じコマンドで再開
+  python distill.py --in kurisu.json --out /tmp/distill.jsonl --mock --n 500
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from build_train_jsonl import SYSTEM_PROMPT, TEMPLATES, split_paren_line, is_usable_text, is_holdout
+
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://127.0.0.1:11434")
+# 教師プロンプトを変えたらここも変える（キャッシュのキーに入るので、古い結果は使われなくなる）
+PROMPT_VERSION = 1
+# キャッシュを fsync する間隔（件）
+SYNC_EVERY = 100
+# 出力IDの名前空間（同じ仕事からは毎回同じIDになる）
+DISTILL_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "amadeus_nao/distill")
+
+TEACHER_PROMPT = (
+    "あなたは会話の学習データを作る脚本家です。"
+    "天才肌で皮肉屋の女性研究者（assistant）と、展示会で彼女のロボットに話しかけた来場者（user）の会話を書きます。"
+    "assistant のセリフは決まっているので、その直前に来場者が言ったことを考えてください。\n"
+    "- 来場者の発話は話し言葉で、1文か2文、40文字以内\n"
+    "- 直後の assistant のセリフが自然な返事になるように。セリフの言葉をそのまま繰り返さない\n"
+    "- 毎回違う言い回しにする。「それってどういう意味？」のような決まり文句に頼らない\n"
+    '出力は JSON だけ: {"user": ["1つ目の来場者の発話", ...]}（assistant のセリフと同じ数）'
+)
+
+
+# ==========================================
+# 作る会話の一覧
+# ==========================================
+def load_pools(path: str, max_assistant_len: int, holdout: float) -> Dict[str, List[Tuple[Optional[str], str]]]:
+    """build_train_jsonl.py と同じ絞り込みで台詞プールを作る（(括弧の問い, 台詞)）"""
+    with open(path, encoding="utf-8") as f:
+        quotes = [q for q in json.load(f).get("quotes", []) if isinstance(q, str) and is_usable_text(q)]
+    paren, plain = [], []
+    for q in quotes:
+        pl, txt = split_paren_line(q)
+        if len(txt) > max_assistant_len:
+            continue
+        if pl:
+            if not is_holdout(q, holdout):
+                paren.append((pl, txt))
+        else:
+            plain.append((None, txt))
+    return {"paren": paren, "plain": plain, "all": [(None, t) for _, t in paren] + plain}
+
+
+def hash_index(n: int, *parts: str) -> int:
+    """parts のハッシュで決まる 0〜n-1 の値"""
+    h = hashlib.blake2b("\x1f".join(parts).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(h, "little") % n
+
+
+def pick(pool: List[Tuple[Optional[str], str]], *parts: str) -> str:
+    """プールから、parts のハッシュで決まる台詞を1つ選ぶ"""
+    return pool[hash_index(len(pool), *parts)][1]
+
+
+def turn_count(template: dict, quote: str) -> int:
+    """assistant の発話数。assistant_turns の [最小, 最大] から (台詞, テンプレート名) のハッシュで選ぶ"""
+    bounds = template.get("assistant_turns") or [1]
+    lo, hi = max(1, bounds[0]), max(1, bounds[-1])
+    if hi <= lo:
+        return lo
+    return lo + hash_index(hi - lo + 1, quote, template["name"], "turns")
+
+
+def build_jobs(pools: Dict[str, List[Tuple[Optional[str], str]]], templates: List[dict], model: str,
+               n: int, seed: int) -> List[dict]:
+    """(台詞, テンプレート) ごとの仕事。n > 0 なら seed で混ぜて先頭 n 件"""
+    jobs = []
+    for t in templates:
+        quotes = pools.get(t.get("quote", "all"), [])
+        extra = pools.get(t.get("extra", "all")) or pools["all"]
+        for hint, quote in quotes:
+            turns = turn_count(t, quote)
+            lines = [quote] + [pick(extra, quote, t["name"], str(i)) for i in range(1, turns)]
+            key = hashlib.sha256(json.dumps([lines, hint, t["name"], t.get("description", ""), model, PROMPT_VERSION],
+                                            ensure_ascii=False).encode("utf-8")).hexdigest()
+            jobs.append({"key": key, "template": t["name"], "description": t.get("description", ""),
+                         "hint": hint, "assistant": lines})
+    if n > 0:
+        random.Random(seed).shuffle(jobs)
+        jobs = jobs[:n]
+    return jobs
+
+
+def teacher_messages(job: dict) -> List[dict]:
+    lines = [f"会話の型: {job['description']}" if job["description"] else "会話の型: 雑談"]
+    if job["hint"]:
+        lines.append(f"1つ目のセリフは「{job['hint']}」について聞かれたときの返事")
+    lines.append("assistant のセリフ（この順に言う）:")
+    lines += [f"{i + 1}. {a}" for i, a in enumerate(job["assistant"])]
+    return [{"role": "system", "content": TEACHER_PROMPT}, {"role": "user", "content": "\n".join(lines)}]
+
+
+def parse_teacher(text: str, job: dict, max_user_len: int) -> List[str]:
+    """教師の返答から user 発話を取り出す（使えなければ ValueError）"""
+    data = json.loads(text)
+    users = data.get("user") if isinstance(data, dict) else None
+    if not isinstance(users, list) or len(users) != len(job["assistant"]):
+        raise ValueError(f"expected {len(job['assistant'])} user lines, got {users!r}")
+    out = []
+    for u, a in zip(users, job["assistant"]):
+        u = str(u).strip().replace("\n", "").replace("「", "").replace("」", "")
+        if not is_usable_text(u) or len(u) > max_user_len:
+            raise ValueError(f"bad user line {u!r}")
+        if a in u:
+            raise ValueError(f"user line repeats the quote {u!r}")
+        out.append(u)
+    return out
+
+
+# ==========================================
+# キャッシュ（兼チェックポイント）
+# ==========================================
+def load_cache(path: str) -> Dict[str, List[str]]:
+    cache = {}
+    if not os.path.exists(path):
+        return cache
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # 書き込み途中で止まった最後の行
+            cache[rec["key"]] = rec["user"]
+    return cache
+
+
+# ==========================================
+# 生成
+# ==========================================
+def chat(host: str, model: str, messages: List[dict], options: dict, timeout: float) -> str:
+    body = json.dumps({"model": model, "messages": messages, "stream": False, "format": "json",
+                       "options": options}).encode("utf-8")
+    req = urllib.request.Request(f"{host}/api/chat", data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        data = json.loads(resp.read())
+    if "error" in data:
+        raise RuntimeError(data["error"])
+    return data.get("message", {}).get("content", "")
+
+
+async def distill(jobs: List[dict], cache: Dict[str, List[str]], args: argparse.Namespace, host: str) -> dict:
+    todo: Iterator[dict] = (j for j in jobs if j["key"] not in cache)
+    pending = sum(1 for j in jobs if j["key"] not in cache)
+    stats = {"cached": len(jobs) - pending, "done": 0, "failed": 0, "retries": 0}
+    if not pending:
+        return stats
+
+    loop = asyncio.get_running_loop()
+    # urllib はブロックするので専用のスレッドで呼ぶ（スレッド数 = 同時に投げる数）
+    pool = ThreadPoolExecutor(max_workers=args.concurrency)
+    sem = asyncio.Semaphore(args.concurrency)
+    started = time.perf_counter()
+    cache_file = open(args.cache, "a+", encoding="utf-8")
+    # 前回が行の途中で止まっていたら、その行は捨てて次の行から書く
+    if cache_file.tell() > 0:
+        cache_file.seek(cache_file.tell() - 1)
+        if cache_file.read(1) != "\n":
+            cache_file.write("\n")
+    written = 0
+
+    async def run(job: dict):
+        nonlocal written
+        try:
+            messages = teacher_messages(job)
+            for attempt in range(args.retries + 1):
+                seed = int(job["key"][:8], 16) + attempt
+                options = {"temperature": args.temperature, "seed": seed, "num_predict": args.num_predict}
+                try:
+                    text = await loop.run_in_executor(pool, chat, host, args.model, messages, options, args.timeout)
+                    users = parse_teacher(text, job, args.max_user_len)
+                    break
+                except (OSError, RuntimeError, ValueError) as e:
+                    if attempt == args.retries:
+                        stats["failed"] += 1
+                        print(f"[WARN] {job['template']} {job['assistant'][0][:20]}: {e}")
+                        return
+                    stats["retries"] += 1
+                    await asyncio.sleep(min(2 ** attempt, 10) * 0.5)
+            cache[job["key"]] = users
+            cache_file.write(json.dumps({"key": job["key"], "user": users}, ensure_ascii=False) + "\n")
+            cache_file.flush()
+            written += 1
+            if written % SYNC_EVERY == 0:
+                os.fsync(cache_file.fileno())
+            stats["done"] += 1
+            finished = stats["done"] + stats["failed"]
+            if finished % args.log_every == 0:
+                rate = finished / (time.perf_counter() - started)
+                print(f"  {finished}/{pending} ({rate:.1f}/s, eta {(pending - finished) / rate:.0f}s)")
+        finally:
+            sem.release()
+
+    tasks = set()
+    try:
+        for job in todo:
+            await sem.acquire()
+            task = asyncio.create_task(run(job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        cache_file.flush()
+        os.fsync(cache_file.fileno())
+        cache_file.close()
+        pool.shutdown(wait=False, cancel_futures=True)
+    stats["seconds"] = round(time.perf_counter() - started, 1)
+    return stats
+
+
+def write_output(path: str, jobs: List[dict], cache: Dict[str, List[str]]) -> int:
+    """キャッシュにある件だけを、仕事の順に書く"""
+    n = 0
+    with open(path + ".tmp", "w", encoding="utf-8") as wf:
+        for job in jobs:
+            users = cache.get(job["key"])
+            if users is None:
+                continue
+            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+            for u, a in zip(users, job["assistant"]):
+                messages.append({"role": "user", "content": u})
+                messages.append({"role": "assistant", "content": a})
+            rid = uuid.uuid5(DISTILL_NAMESPACE, job["key"])
+            wf.write(json.dumps({"id": str(rid), "messages": messages}, ensure_ascii=False) + "\n")
+            n += 1
+    os.replace(path + ".tmp", path)
+    return n
+
+
+# ==========================================
+# モックの教師（--mock）
+# ==========================================
+MOCK_OPENERS = ["ねえ、", "ちょっと聞きたいんだけど、", "さっきの話だけど、", "正直に言うと、", "素朴な疑問なんだけど、"]
+MOCK_TOPICS = ["タイムマシン", "この研究", "人工知能", "ロボット", "昨日の実験", "記憶のデータ化"]
+MOCK_ENDINGS = ["ってどう思う？", "って本当にできるの？", "、ちょっと怖くない？", "の話、もっと聞かせて。"]
+
+
+class MockTeacher(BaseHTTPRequestHandler):
+    """Ollama 互換の /api/chat。assistant のセリフの数だけ、それらしい発話を決まった形で返す"""
+    latency = 0.05
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        prompt = body["messages"][-1]["content"]
+        count = sum(1 for line in prompt.splitlines() if re.match(r"\d+\. ", line))
+        rng = random.Random(f"{prompt}/{body.get('options', {}).get('seed')}")
+        users = [rng.choice(MOCK_OPENERS) + rng.choice(MOCK_TOPICS) + rng.choice(MOCK_ENDINGS) for _ in range(count)]
+        time.sleep(self.latency)
+        out = json.dumps({"model": body.get("model"), "done": True,
+                          "message": {"role": "assistant", "content": json.dumps({"user": users}, ensure_ascii=False)}},
+                         ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_mock(latency: float) -> Tuple[ThreadingHTTPServer, str]:
+    MockTeacher.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockTeacher)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--in", dest="inp", default="kurisu.json", help="Input kurisu.json")
+    ap.add_argument("--out", required=True, help="Output JSONL")
+    ap.add_argument("--templates", default=TEMPLATES, help="Dialog template JSON (uses name/description/quote/extra)")
+    ap.add_argument("--cache", default="distill_cache.jsonl", help="Per-call cache / checkpoint (JSONL, appended)")
+    ap.add_argument("--host", default=OLLAMA_HOST)
+    ap.add_argument("--model", default="qwen2.5:14b", help="Teacher model")
+    ap.add_argument("--n", type=int, default=0, help="Number of dialogs (0 = every quote x template)")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--concurrency", type=int, default=16, help="Requests in flight")
+    ap.add_argument("--retries", type=int, default=2, help="Retries per dialog on errors or unusable output")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--temperature", type=float, default=0.8)
+    ap.add_argument("--num_predict", type=int, default=256)
+    ap.add_argument("--max_assistant_len", type=int, default=140, help="Skip quotes longer than this (chars)")
+    ap.add_argument("--max_user_len", type=int, default=60, help="Reject generated user lines longer than this")
+    ap.add_argument("--holdout", type=float, default=0.0,
+                    help="Exclude this fraction of paren pairs (same selection as eval_persona.py --holdout)")
+    ap.add_argument("--log_every", type=int, default=500)
+    ap.add_argument("--mock", action="store_true", help="Use an in-process mock teacher (offline test)")
+    ap.add_argument("--mock_latency", type=float, default=0.05, help="Seconds per mock response")
+    args = ap.parse_args()
+
+    with open(args.templates, encoding="utf-8") as f:
+        templates = json.load(f)["templates"]
+    pools = load_pools(args.inp, args.max_assistant_len, args.holdout)
+    if not pools["all"]:
+        raise SystemExit("No quotes within --max_assistant_len.")
+    model = "mock" if args.mock else args.model
+    jobs = build_jobs(pools, templates, model, args.n, args.seed)
+    cache = load_cache(args.cache)
+
+    server, host = start_mock(args.mock_latency) if args.mock else (None, args.host)
+    args.model = model
+    print(f"{len(jobs)} dialogs, teacher={model} @ {host}, concurrency={args.concurrency}")
+    try:
+        stats = asyncio.run(distill(jobs, cache, args, host))
+    except KeyboardInterrupt:
+        # 終わった件はキャッシュに書いてあるので、同じコマンドで続きから
+        print("interrupted; rerun the same command to resume", file=sys.stderr)
+        raise SystemExit(130)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    n = write_output(args.out, jobs, cache)
+    print(f"wrote {n} records -> {args.out}")
+    print(", ".join(f"{k}={v}" for k, v in stats.items()))
+    if n < len(jobs):
+        print(f"{len(jobs) - n} dialogs failed; rerun to retry them")
+
+
+if __name__ == "__main__":
+    main()
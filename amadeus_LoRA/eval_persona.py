@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+キャラクター口調（紅莉栖らしさ）を保ったまま返答を短くできているかを測る評価スクリプト。
+新しい LoRA やプロンプト変更のたびに回して、前回の結果と比べる回帰テストとして使う。
+
+評価セット:
+- kurisu.json の括弧ありペア（split_paren_line）。"(…)" を問い、本文を参照台詞にする
+- 各ペアを文字数制限 30 / 40 / 50 のシステムプロンプトで、--samples 個の seed ずつ生成
+- 使うのは --holdout（既定は build_train_jsonl.HOLDOUT）の割合のペアだけ。選ばれるペアは文字列のハッシュで決まり、
+  build_train_jsonl.py / pipeline.py は同じ既定値でそのペアを学習データから外す
+  （--holdout 1.0 は学習に使ったペアも含むので、丸暗記が点数に出る。比較用にだけ使う）
+
+生成:
+- Ollama 互換の /api/chat にスレッドで並列に投げる（--concurrency）。温度 0・seed 固定
+
+指標（まとめて NumPy で計算）:
+- 応答率（返答が返ってきた割合）。返答が無かった・失敗したリクエストは、遵守率・n-gram の重なり・
+  persona_score では失敗（0点）として数える（タイムアウトが増えても点が上がらないように）
+- 文字数制限の遵守率（制限ごと）と長さの平均 / p90（長さは返答があったものだけ）
+- 語尾の割合（わね / かしら / よ）と、kurisu.json 全体での割合とのずれ
+- 文字 n-gram の重なり: 参照台詞に対する再現率 / F1 と、台詞コーパス全体に含まれる n-gram の割合
+- 応答時間の平均 / p90（速度と品質を同じレポートで比べられるように）
+
+使い方:
+  python eval_persona.py --model kurisu --json eval.json
+  python eval_persona.py --model kurisu-q4 --samples 8 --concurrency 16 --compare eval.json
+  python eval_persona.py --model kurisu --prompt backend   # バックエンドのシステムプロンプトで評価
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from build_train_jsonl import HOLDOUT, SYSTEM_PROMPT, split_paren_line, is_usable_text, is_holdout, make_user_from_prompt_like
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "back", "src"))
+from prompts import build_amadeus_system_prompt  # noqa: E402
+
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://127.0.0.1:11434")
+LIMITS = (30, 40, 50)
+PARTICLES = ("わね", "かしら", "よ")
+TRAILING = "。、！？!?…‥ 　"
+NGRAM = 2
+NGRAM_BUCKETS = 1 << 16  # n-gram をハッシュで落とす次元数
+# 比較時に「悪化」とみなす差
+REGRESSION_DELTA = 0.05
+
+# ==========================================
+# 評価セット
+# ==========================================
+def load_eval_pairs(path: str, holdout: float) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """(問い, 参照台詞) のリストと、台詞コーパス全体を返す"""
+    with open(path, encoding="utf-8") as f:
+        quotes = [q for q in json.load(f).get("quotes", []) if isinstance(q, str) and is_usable_text(q)]
+    pairs = []
+    corpus = []
+    for q in quotes:
+        pl, txt = split_paren_line(q)
+        corpus.append(txt)
+        if pl and is_holdout(q, holdout):
+            pairs.append((pl, txt))
+    return pairs, corpus
+
+def system_prompt_for(kind: str, limit: int) -> str:
+    if kind == "backend":
+        return re.sub(r"\d+文字以内", f"{limit}文字以内", build_amadeus_system_prompt(1))
+    return SYSTEM_PROMPT + f"返答は{limit}文字以内。"
+
+def build_jobs(pairs: List[Tuple[str, str]], kind: str, samples: int, seed: int) -> List[dict]:
+    jobs = []
+    for i, (pl, ref) in enumerate(pairs):
+        user = make_user_from_prompt_like(pl)
+        for limit in LIMITS:
+            system = system_prompt_for(kind, limit)
+            for s in range(samples):
+                jobs.append({
+                    "pair": i,
+                    "limit": limit,
+                    "seed": seed + s,
+                    "reference": ref,
+                    "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
+                })
+    return jobs
+
+# ==========================================
+# 生成
+# ==========================================
+def chat(host: str, model: str, messages: List[dict], options: dict, timeout: float) -> Tuple[str, float]:
+    body = json.dumps({"model": model, "messages": messages, "stream": False, "options": options}).encode("utf-8")
+    req = urllib.request.Request(f"{host}/api/chat", data=body, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        data = json.loads(resp.read())
+    if "error" in data:
+        raise RuntimeError(data["error"])
+    return data.get("message", {}).get("content", ""), time.perf_counter() - start
+
+def clean_reply(text: str) -> str:
+    """バックエンドと同じ整形（改行と鉤括弧を落とす）"""
+    return text.strip().replace("\n", "").replace("「", "").replace("」", "")
+
+def generate(host: str, model: str, jobs: List[dict], concurrency: int,
+             num_predict: int, timeout: float) -> Tuple[List[str], List[float]]:
+    def run(job):
+        options = {"temperature": 0, "seed": job["seed"], "num_predict": num_predict}
+        try:
+            text, sec = chat(host, model, job["messages"], options, timeout)
+            return clean_reply(text), sec
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f"[WARN] pair {job['pair']} limit {job['limit']}: {e}")
+            return "", float("nan")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(run, jobs))
+    return [t for t, _ in results], [s for _, s in results]
+
+# ==========================================
+# 指標（NumPy でまとめて計算）
+# ==========================================
+def ngram_matrix(texts: List[str], n: int = NGRAM, buckets: int = NGRAM_BUCKETS) -> np.ndarray:
+    """
+    文字 n-gram の出現回数を (テキスト数, buckets) の行列にする。
+    全テキストのコードポイントを1本の配列につなげ、n-gram の ID をずらし足しで一度に出す。
+    """
+    rows = len(texts)
+    out = np.zeros((rows, buckets), dtype=np.int32)
+    lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=rows)
+    if rows == 0 or lengths.sum() == 0:
+        return out
+    codes = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    row_of = np.repeat(np.arange(rows), lengths)
+    pos_in_row = np.arange(len(codes)) - np.repeat(starts, lengths)
+    # 位置 i から始まる n-gram が同じテキスト内に収まるか
+    valid = pos_in_row + n <= np.repeat(lengths, lengths)
+    ids = np.zeros(len(codes), dtype=np.uint64)
+    for k in range(n):
+        shifted = np.zeros(len(codes), dtype=np.uint64)
+        shifted[:len(codes) - k] = codes[k:]
+        ids = ids * np.uint64(0x10FFFF + 1) + shifted
+    ids = (ids % np.uint64(buckets)).astype(np.int64)
+    np.add.at(out, (row_of[valid], ids[valid]), 1)
+    return out
+
+def ending_flags(texts: List[str]) -> np.ndarray:
+    """(テキスト数, 語尾数) の 0/1 行列"""
+    stripped = [t.rstrip(TRAILING) for t in texts]
+    return np.array([[s.endswith(p) for p in PARTICLES] for s in stripped], dtype=bool).reshape(len(texts), len(PARTICLES))
+
+def percentile(a: np.ndarray, q: float) -> float:
+    a = a[~np.isnan(a)]
+    return float(np.percentile(a, q)) if len(a) else 0.0
+
+def score(jobs: List[dict], replies: List[str], seconds: List[float], corpus: List[str]) -> dict:
+    limits = np.array([j["limit"] for j in jobs])
+    lengths = np.fromiter((len(r) for r in replies), dtype=np.int64, count=len(replies))
+    answered = lengths > 0
+    secs = np.asarray(seconds, dtype=np.float64)
+
+    # 語尾（コーパス全体の割合が基準）
+    endings = ending_flags(replies)
+    corpus_endings = ending_flags(corpus).mean(axis=0)
+
+    # n-gram の重なり
+    reply_m = ngram_matrix(replies)
+    ref_m = ngram_matrix([j["reference"] for j in jobs])
+    common = np.minimum(reply_m, ref_m).sum(axis=1)
+    ref_total = np.maximum(ref_m.sum(axis=1), 1)
+    reply_total = np.maximum(reply_m.sum(axis=1), 1)
+    recall = common / ref_total
+    precision = common / reply_total
+    f1 = np.where(common > 0, 2 * precision * recall / np.maximum(precision + recall, 1e-9), 0.0)
+    corpus_vocab = ngram_matrix(["\n".join(corpus)]).ravel() > 0
+    in_corpus = (reply_m * corpus_vocab).sum(axis=1) / reply_total
+
+    # 返答が無いものは制限を守れなかったものとして数える
+    complied = answered & (lengths <= limits)
+
+    per_limit = {}
+    for limit in LIMITS:
+        asked = limits == limit
+        m = asked & answered
+        per_limit[str(limit)] = {
+            "n": int(asked.sum()),
+            "answered": int(m.sum()),
+            "compliance": float(complied[asked].mean()) if asked.any() else 0.0,
+            "mean_len": float(lengths[m].mean()) if m.any() else 0.0,
+            "p90_len": float(np.percentile(lengths[m], 90)) if m.any() else 0.0,
+        }
+
+    ending_ratio = endings[answered].mean(axis=0) if answered.any() else np.zeros(len(PARTICLES))
+    answer_rate = float(answered.mean()) if len(jobs) else 0.0
+    metrics = {
+        "requests": len(jobs),
+        "answered": int(answered.sum()),
+        "answer_rate": answer_rate,
+        "compliance": float(complied.mean()) if len(jobs) else 0.0,
+        "per_limit": per_limit,
+        "endings": {p: float(r) for p, r in zip(PARTICLES, ending_ratio)},
+        "endings_corpus": {p: float(r) for p, r in zip(PARTICLES, corpus_endings)},
+        "ending_any": float(endings[answered].any(axis=1).mean()) if answered.any() else 0.0,
+        "ending_any_corpus": float(ending_flags(corpus).any(axis=1).mean()),
+        # 返答が無いものは重なり 0（空の返答の n-gram は 0 個なので、全件の平均でそうなる）
+        "ref_recall": float(recall.mean()) if len(jobs) else 0.0,
+        "ref_f1": float(f1.mean()) if len(jobs) else 0.0,
+        "corpus_overlap": float(in_corpus.mean()) if len(jobs) else 0.0,
+        "latency_mean_s": float(np.nanmean(secs)) if answered.any() else 0.0,
+        "latency_p90_s": percentile(secs, 90),
+    }
+    # 語尾の出方がコーパスからどれだけずれているか（小さいほど良い）
+    metrics["ending_gap"] = float(np.abs(ending_ratio - corpus_endings).sum())
+    # 一目で比べる用のまとめ（遵守率・語尾の出方・コーパスとの重なり）。語尾は返答があった分だけ点にする
+    metrics["persona_score"] = round(
+        (metrics["compliance"] + max(0.0, 1 - metrics["ending_gap"]) * answer_rate + metrics["corpus_overlap"]) / 3, 4)
+    return metrics
+
+# ==========================================
+# 前回との比較
+# ==========================================
+# (指標, 大きいほど良いか)。応答時間は表示だけで悪化判定には使わない
+COMPARE_KEYS = [
+    ("persona_score", True),
+    ("answer_rate", True),
+    ("compliance", True),
+    ("ending_gap", False),
+    ("ref_f1", True),
+    ("corpus_overlap", True),
+    ("latency_mean_s", None),
+]
+
+def compare(prev: dict, cur: dict) -> List[str]:
+    """主要指標の差を表示用の行にする（品質が REGRESSION_DELTA 以上悪化したら印を付ける）"""
+    lines = []
+    for k, higher_is_better in COMPARE_KEYS:
+        a, b = prev["metrics"].get(k), cur["metrics"].get(k)
+        if a is None or b is None:
+            continue
+        mark = ""
+        if higher_is_better is not None and (b - a if higher_is_better else a - b) < -REGRESSION_DELTA:
+            mark = "  <-- regression"
+        lines.append(f"  {k:<16}: {a:.3f} -> {b:.3f} ({b - a:+.3f}){mark}")
+    return lines
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", required=True, help="Ollama model name")
+    ap.add_argument("--host", default=OLLAMA_HOST)
+    ap.add_argument("--in", dest="inp", default="kurisu.json", help="Input kurisu.json")
+    ap.add_argument("--holdout", type=float, default=HOLDOUT,
+                    help="Fraction of paren pairs to evaluate (hash-based, same as build_train_jsonl.py --holdout)")
+    ap.add_argument("--prompt", choices=["train", "backend"], default="train", help="System prompt to evaluate with")
+    ap.add_argument("--samples", type=int, default=4, help="Seeds per (pair, limit)")
+    ap.add_argument("--seed", type=int, default=3407)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--num_predict", type=int, default=96)
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--json", default=None, help="Write metrics and replies as JSON")
+    ap.add_argument("--compare", default=None, help="Previous --json result to compare against")
+    args = ap.parse_args(argv)
+
+    if args.holdout >= 1.0:
+        print("[WARN] --holdout 1.0 evaluates every pair, including ones in the training data; "
+              "scores reward memorization")
+    pairs, corpus = load_eval_pairs(args.inp, args.holdout)
+    if not pairs:
+        raise SystemExit("No paren pairs selected for evaluation.")
+    jobs = build_jobs(pairs, args.prompt, args.samples, args.seed)
+    print(f"pairs={len(pairs)}, requests={len(jobs)}, model={args.model}, concurrency={args.concurrency}")
+
+    start = time.perf_counter()
+    replies, seconds = generate(args.host, args.model, jobs, args.concurrency, args.num_predict, args.timeout)
+    wall = time.perf_counter() - start
+    metrics = score(jobs, replies, seconds, corpus)
+    metrics["wall_s"] = round(wall, 2)
+
+    print(f"answered        : {metrics['answered']}/{metrics['requests']} ({metrics['answer_rate']:.2%}) in {wall:.1f}s")
+    for limit, m in metrics["per_limit"].items():
+        print(f"  limit {limit:>3}     : compliance {m['compliance']:.2%}, mean {m['mean_len']:.1f}, p90 {m['p90_len']:.0f}")
+    print("endings         : " + ", ".join(
+        f"{p} {metrics['endings'][p]:.2%} (corpus {metrics['endings_corpus'][p]:.2%})" for p in PARTICLES))
+    print(f"ending gap      : {metrics['ending_gap']:.3f}")
+    print(f"ref n-gram      : recall {metrics['ref_recall']:.3f}, f1 {metrics['ref_f1']:.3f}")
+    print(f"corpus overlap  : {metrics['corpus_overlap']:.3f}")
+    print(f"latency         : mean {metrics['latency_mean_s']:.2f}s, p90 {metrics['latency_p90_s']:.2f}s")
+    print(f"persona score   : {metrics['persona_score']:.3f}")
+
+    result = {
+        "config": {k: getattr(args, k) for k in ("model", "inp", "holdout", "prompt", "samples", "seed", "num_predict")},
+        "metrics": metrics,
+        "replies": [
+            {"pair": j["pair"], "limit": j["limit"], "seed": j["seed"], "reference": j["reference"], "reply": r}
+            for j, r in zip(jobs, replies)
+        ],
+    }
+    regressed = False
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            prev = json.load(f)
+        if prev.get("config", {}).get("prompt") != args.prompt or prev.get("config", {}).get("holdout") != args.holdout:
+            print("[WARN] previous run used a different evaluation set")
+        print(f"compare with {args.compare} ({prev['config'].get('model')}):")
+        lines = compare(prev, result)
+        for line in lines:
+            print(line)
+        regressed = any("regression" in line for line in lines)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"result -> {args.json}")
+    return 1 if regressed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+バックエンドが保存した会話ログ（back/src/transcript_store.py の SQLite）を、
+学習データ(train.jsonl と同じ {"id", "messages"} 形式)に書き足すスクリプト。
+
+特徴:
+- 前回どこまで書き出したかを、セッションごとのメッセージID（ウォーターマーク）として --state に残す
+  2回目以降は新しい会話だけを読み、--out の末尾に追記する（イベントの日ごとに流せばよい）
+- 同じセッション（＝ロボット）の発言でも、--idle 秒以上間が空いたら別の会話（別の来場者）とみなす
+  まだ続いているかもしれない最後の会話は書き出さず、次回に回す
+- メッセージは1行ずつ読み、手元に持つのは今まとめている会話1つだけ（ログがいくら大きくてもメモリは一定）
+- 捨てるもの:
+  - 辞書のセリフ（LLM が使えなかった・既出だったので差し替えた返答）と、返答のない発話
+  - --max_user_len / --max_assistant_len を超える発話、1文字以下の発話
+  - 同じ会話の中で同じことを言っている返答と、今回書き出した直近 --recent 件と同じ返答（完全一致、表記揺れは吸収）
+  ほぼ重複まで取り除きたいときは、書き出した後に dedup.py を通す
+- 長い会話は --max_pairs 往復ずつに区切る（build_train_jsonl.py の 2〜6ターンに揃える）
+
+使い方:
+  python export_transcripts.py --db ../back/src/transcripts.sqlite3 --out train.visitors.jsonl
+  python export_transcripts.py --db transcripts.sqlite3 --out train.visitors.jsonl --state visitors.state.json --idle 600
+  python export_transcripts.py --db transcripts.sqlite3 --out train.visitors.jsonl --reset   # 最初から書き出し直す
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from build_train_jsonl import SYSTEM_PROMPT, is_usable_text
+
+# 出力IDの名前空間（同じ会話からは毎回同じIDになる）
+EXPORT_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "amadeus_nao/transcripts")
+
+# (id, role, content, created, source)
+Row = Tuple[int, str, str, float, str]
+
+
+class RecentLines:
+    """直近 capacity 件の返答のハッシュ（古いものから忘れる）"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.seen: "OrderedDict[bytes, None]" = OrderedDict()
+
+    def add(self, text: str) -> bool:
+        """初めてなら覚えて True、既出なら False"""
+        if self.capacity <= 0:
+            return True
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+        if key in self.seen:
+            self.seen.move_to_end(key)
+            return False
+        self.seen[key] = None
+        if len(self.seen) > self.capacity:
+            self.seen.popitem(last=False)
+        return True
+
+
+def normalize(text: str) -> str:
+    """重複判定用（表記の揺れと空白を吸収）"""
+    return "".join(unicodedata.normalize("NFKC", text).split())
+
+
+def load_state(path: str) -> dict:
+    if not os.path.exists(path):
+        return {"sessions": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(path: str, state: dict):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def conversations(conn: sqlite3.Connection, session_id: str, after: int, idle: float,
+                  now: float) -> Iterator[Tuple[List[Row], bool]]:
+    """
+    ウォーターマークより後のメッセージを会話ごとに区切って返す（会話, 終わっているか）。
+    終わっていない（最後の発言から idle 秒経っていない）会話は最後に1つだけ来る
+    """
+    rows = conn.execute(
+        "SELECT id, role, content, created, source FROM messages WHERE session_id = ? AND id > ? ORDER BY id",
+        (session_id, after))
+    current: List[Row] = []
+    for row in rows:
+        if current and row[3] - current[-1][3] >= idle:
+            yield current, True
+            current = []
+        current.append(row)
+    if current:
+        yield current, now - current[-1][3] >= idle
+
+
+def to_pairs(conv: List[Row], args: argparse.Namespace, recent: RecentLines,
+             stats: Dict[str, int]) -> List[Tuple[str, str]]:
+    """会話を user → assistant の組にし、学習に使えない組を捨てる"""
+    pairs = []
+    said = set()
+    user: Optional[str] = None
+    for _, role, content, _, source in conv:
+        content = content.strip()
+        if role == "user":
+            if user is not None:
+                stats["unanswered"] += 1  # 返答がなかった（辞書で答えた）発話
+            user = content
+            continue
+        if role != "assistant":
+            continue
+        if user is None:
+            stats["no_user"] += 1  # 挨拶など、話しかけられずに言ったセリフ
+            continue
+        pair, user = (user, content), None
+        key = normalize(content)
+        if source != "llm":
+            stats["fallback"] += 1
+        elif user_text_unusable(pair[0], args.max_user_len) or not is_usable_text(content) \
+                or len(content) > args.max_assistant_len:
+            stats["length"] += 1
+        elif key in said or not recent.add(key):
+            stats["repeat"] += 1
+        else:
+            said.add(key)
+            pairs.append(pair)
+    if user is not None:
+        stats["unanswered"] += 1
+    return pairs
+
+
+def user_text_unusable(text: str, max_len: int) -> bool:
+    return not is_usable_text(text) or len(text) > max_len
+
+
+def records(session_id: str, conv: List[Row], pairs: List[Tuple[str, str]], max_pairs: int) -> Iterator[dict]:
+    """max_pairs 往復ずつの学習レコードにする"""
+    for start in range(0, len(pairs), max_pairs):
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        for user, assistant in pairs[start:start + max_pairs]:
+            messages.append({"role": "user", "content": user})
+            messages.append({"role": "assistant", "content": assistant})
+        rid = uuid.uuid5(EXPORT_NAMESPACE, f"{session_id}/{conv[0][0]}/{start}")
+        yield {"id": str(rid), "messages": messages}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db", required=True, help="Transcript SQLite file written by the backend (TRANSCRIPT_DB)")
+    ap.add_argument("--out", required=True, help="Output JSONL (appended)")
+    ap.add_argument("--state", default=None, help="Watermark file (default: <out>.state.json)")
+    ap.add_argument("--idle", type=float, default=300, help="Seconds of silence that end a conversation")
+    ap.add_argument("--max_user_len", type=int, default=200, help="Drop turns whose user line is longer (chars)")
+    ap.add_argument("--max_assistant_len", type=int, default=140, help="Drop turns whose reply is longer (chars)")
+    ap.add_argument("--max_pairs", type=int, default=3, help="Split conversations into records of this many turns")
+    ap.add_argument("--recent", type=int, default=100000, help="Drop replies identical to one of the last N exported")
+    ap.add_argument("--reset", action="store_true", help="Ignore the watermark and export everything again")
+    args = ap.parse_args()
+
+    state_path = args.state or args.out + ".state.json"
+    state = {"sessions": {}} if args.reset else load_state(state_path)
+    watermarks: Dict[str, int] = state["sessions"]
+
+    # バックエンドが書き込み中でも読めるように読み取り専用で開く（WAL なので書き込みを止めない）
+    conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    now = time.time()
+    recent = RecentLines(args.recent)
+    stats = {"conversations": 0, "pending": 0, "records": 0, "turns": 0,
+             "fallback": 0, "unanswered": 0, "no_user": 0, "length": 0, "repeat": 0}
+
+    sessions = [row[0] for row in conn.execute("SELECT DISTINCT session_id FROM messages ORDER BY session_id")]
+    with open(args.out, "w" if args.reset else "a", encoding="utf-8") as wf:
+        for sid in sessions:
+            for conv, finished in conversations(conn, sid, watermarks.get(sid, 0), args.idle, now):
+                if not finished:
+                    stats["pending"] += 1
+                    break
+                stats["conversations"] += 1
+                pairs = to_pairs(conv, args, recent, stats)
+                for rec in records(sid, conv, pairs, args.max_pairs):
+                    wf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                    stats["records"] += 1
+                stats["turns"] += len(pairs)
+                watermarks[sid] = conv[-1][0]
+        wf.flush()
+        os.fsync(wf.fileno())
+    conn.close()
+
+    # 書き出しが終わってからウォーターマークを進める（途中で落ちたら次回同じ会話をやり直す）
+    state["updated"] = now
+    save_state(state_path, state)
+
+    print(f"wrote {stats['records']} records ({stats['turns']} turns from {stats['conversations']} conversations) "
+          f"-> {args.out}")
+    print(f"dropped: fallback={stats['fallback']}, unanswered={stats['unanswered']}, no_user={stats['no_user']}, "
+          f"length={stats['length']}, repeat={stats['repeat']}; still open={stats['pending']}")
+
+
+if __name__ == "__main__":
+    main()
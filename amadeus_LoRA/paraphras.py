@@ -1,9 +1,34 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""
+学習用 JSONL の assistant 台詞を一定割合だけ軽く言い換えるスクリプト。
 
+特徴:
+- 言い換え規則は1本の正規表現（名前付きグループの選択）にまとめて事前コンパイル
+  （規則の優先順位は従来通りリストの先頭から）
+- 規則はファイル(JSON)からも読み込める
+- 入力をチャンクに分けてプロセス並列で処理し、出力の行順は入力と同じ
+- どの台詞を言い換えるかは (seed, 行番号, メッセージ番号) で決まるので、
+  ワーカー数やチャンクサイズを変えても出力は同じ
+- 規則ごとのヒット数を集計して表示
+
+使い方:
+  python paraphras.py
+  python paraphras.py --in train.fixed.jsonl --out train.paraphrased.jsonl --rules rules.json --workers 4
+
+rules.json の形式:
+  [{"name": "nai_dangen", "pattern": "ない$", "replacement": "ない。断言する"}, ...]
+  pattern にグループ (...) や (?P<name>...) は使えない（括るだけなら (?:...) を使う）
+"""
+
+import argparse
+import hashlib
 import json
-import random
 import re
+from collections import Counter
+from itertools import islice
+from multiprocessing import Pool
+from typing import Dict, Iterable, List, Optional, Tuple
 
 INP = "train.fixed.jsonl"
 OUT = "train.paraphrased.jsonl"
@@ -11,8 +36,6 @@ OUT = "train.paraphrased.jsonl"
 PARAPHRASE_RATE = 0.10   # 10%
 SEED = 42
 
-random.seed(SEED)
-
 # 軽微な言い換え規則（安全なもののみ）
 REPLACEMENTS = [
     (r"ない$", "ない。断言する"),
@@ -23,34 +46,162 @@ REPLACEMENTS = [
     (r"それ$", "それは"),
 ]
 
-def paraphrase(text: str) -> str:
-    t = text.strip()
-    for pat, rep in REPLACEMENTS:
-        if re.search(pat, t):
-            return re.sub(pat, rep, t)
-    # フォールバック：語順だけ変える（超軽微）
-    if "。" in t:
-        parts = t.split("。")
-        if len(parts) == 2:
-            return f"{parts[1]}。{parts[0]}"
-    return t  # 変えられなければそのまま
-
-total_asst = 0
-changed = 0
-
-with open(INP, encoding="utf-8") as f_in, open(OUT, "w", encoding="utf-8") as f_out:
-    for line in f_in:
+# 規則に当てはまらず、語順を入れ替えた場合の集計名
+FALLBACK_RULE = "swap_sentences"
+
+_encoder = json.JSONEncoder(ensure_ascii=False)
+
+class RuleSet:
+    """
+    言い換え規則をまとめて扱う。
+    どの規則に当たるかは結合した正規表現1回で判定し、置換はその規則だけで行う。
+    """
+
+    def __init__(self, rules: List[Tuple[str, str, str]]):
+        if not rules:
+            raise ValueError("rule set is empty")
+        self.names = [name for name, _, _ in rules]
+        self.patterns = [re.compile(pat) for _, pat, _ in rules]
+        # 規則の中にグループがあると、結合した正規表現の番号や lastgroup がずれる
+        for name, pattern in zip(self.names, self.patterns):
+            if pattern.groups:
+                raise ValueError(f"rule {name!r} has capturing groups; use (?:...) instead: {pattern.pattern}")
+        self.replacements = [rep for _, _, rep in rules]
+        # 各規則を先読みで包んで選択にする。選択肢は先頭から試されるので、
+        # 最初に当たった規則が勝つ（re.search を順に呼ぶのと同じ優先順位）
+        self.combined = re.compile("|".join(
+            f"^(?=(?s:.*?)(?P<r{i}>{pat}))" for i, (_, pat, _) in enumerate(rules)
+        ))
+
+    @classmethod
+    def default(cls) -> "RuleSet":
+        return cls([(f"rule{i}", pat, rep) for i, (pat, rep) in enumerate(REPLACEMENTS)])
+
+    @classmethod
+    def from_file(cls, path: str) -> "RuleSet":
+        """JSON の規則リストを読み込む（{"name","pattern","replacement"} または [pattern, replacement]）"""
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        rules = []
+        for i, r in enumerate(data):
+            if isinstance(r, dict):
+                rules.append((r.get("name", f"rule{i}"), r["pattern"], r["replacement"]))
+            else:
+                pat, rep = r
+                rules.append((f"rule{i}", pat, rep))
+        return cls(rules)
+
+    def match(self, text: str) -> Optional[int]:
+        """当てはまる規則の番号（無ければ None）"""
+        m = self.combined.match(text)
+        if m is None:
+            return None
+        return int(m.lastgroup[1:])
+
+    def apply(self, text: str) -> Tuple[str, Optional[str]]:
+        """言い換え後の文と、使った規則名を返す"""
+        t = text.strip()
+        i = self.match(t)
+        if i is not None:
+            return self.patterns[i].sub(self.replacements[i], t), self.names[i]
+        # フォールバック：語順だけ変える（超軽微）
+        if "。" in t:
+            parts = t.split("。")
+            if len(parts) == 2:
+                return f"{parts[1]}。{parts[0]}", FALLBACK_RULE
+        return t, None  # 変えられなければそのまま
+
+def paraphrase(text: str, rules: Optional[RuleSet] = None) -> str:
+    return (rules or RuleSet.default()).apply(text)[0]
+
+def sample_unit(seed: int, line_no: int, msg_no: int) -> float:
+    """(seed, 行番号, メッセージ番号) から [0, 1) の値を決める"""
+    h = hashlib.blake2b(f"{seed}:{line_no}:{msg_no}".encode(), digest_size=8).digest()
+    return int.from_bytes(h, "little") / 2 ** 64
+
+# ワーカープロセスごとの状態（Pool の initializer で設定）
+_rules: Optional[RuleSet] = None
+_rate = PARAPHRASE_RATE
+_seed = SEED
+
+def _init_worker(rules: RuleSet, rate: float, seed: int):
+    global _rules, _rate, _seed
+    _rules, _rate, _seed = rules, rate, seed
+
+def process_chunk(chunk: Tuple[int, List[str]]) -> Tuple[str, Dict[str, int]]:
+    """チャンク(開始行番号, 行リスト)を処理し、出力テキストと集計を返す"""
+    start, lines = chunk
+    stats: Counter = Counter()
+    out = []
+    for offset, line in enumerate(lines):
+        if not line.strip():
+            continue
         obj = json.loads(line)
-        for m in obj["messages"]:
-            if m["role"] == "assistant":
-                total_asst += 1
-                if random.random() < PARAPHRASE_RATE:
-                    new = paraphrase(m["content"])
-                    if new != m["content"]:
-                        m["content"] = new
-                        changed += 1
-        f_out.write(json.dumps(obj, ensure_ascii=False) + "\n")
-
-print(f"assistant lines total : {total_asst}")
-print(f"paraphrased lines    : {changed}")
-print(f"rate                 : {changed/total_asst:.2%}")
+        for msg_no, m in enumerate(obj["messages"]):
+            if m["role"] != "assistant":
+                continue
+            stats["total_asst"] += 1
+            if sample_unit(_seed, start + offset, msg_no) < _rate:
+                new, rule = _rules.apply(m["content"])
+                if new != m["content"]:
+                    m["content"] = new
+                    stats["changed"] += 1
+                    stats["rule:" + rule] += 1
+        out.append(_encoder.encode(obj))
+    return ("\n".join(out) + "\n") if out else "", dict(stats)
+
+def iter_chunks(lines: Iterable[str], size: int) -> Iterable[Tuple[int, List[str]]]:
+    it = iter(lines)
+    start = 0
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+def run(inp: str, out: str, rules: RuleSet, rate: float = PARAPHRASE_RATE, seed: int = SEED,
+        workers: int = 1, chunk_size: int = 2000) -> Counter:
+    """inp を言い換えて out に書き、集計を返す"""
+    stats: Counter = Counter()
+    with open(inp, encoding="utf-8") as f_in, open(out, "w", encoding="utf-8") as f_out:
+        chunks = iter_chunks(f_in, chunk_size)
+        if workers <= 1:
+            _init_worker(rules, rate, seed)
+            results = map(process_chunk, chunks)
+            for text, s in results:
+                f_out.write(text)
+                stats.update(s)
+        else:
+            # imap は入力順に結果を返すので、出力の行順は保たれる
+            with Pool(workers, initializer=_init_worker, initargs=(rules, rate, seed)) as pool:
+                for text, s in pool.imap(process_chunk, chunks):
+                    f_out.write(text)
+                    stats.update(s)
+    return stats
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--in", dest="inp", default=INP, help="Input JSONL")
+    ap.add_argument("--out", dest="out", default=OUT, help="Output JSONL")
+    ap.add_argument("--rules", default=None, help="Rule set JSON (default: built-in REPLACEMENTS)")
+    ap.add_argument("--rate", type=float, default=PARAPHRASE_RATE, help="Fraction of assistant lines to paraphrase")
+    ap.add_argument("--seed", type=int, default=SEED)
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--chunk", type=int, default=2000, help="Lines per chunk")
+    args = ap.parse_args()
+
+    rules = RuleSet.from_file(args.rules) if args.rules else RuleSet.default()
+    stats = run(args.inp, args.out, rules, args.rate, args.seed, args.workers, args.chunk)
+
+    total_asst = stats["total_asst"]
+    changed = stats["changed"]
+    print(f"assistant lines total : {total_asst}")
+    print(f"paraphrased lines    : {changed}")
+    print(f"rate                 : {changed/max(total_asst, 1):.2%}")
+    print("rule hits:")
+    for name in rules.names + [FALLBACK_RULE]:
+        print(f"  {name:<20}: {stats['rule:' + name]}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+学習データ作成の一連の手順をまとめて実行するパイプライン。
+
+  kurisu.json
+    └─ build      (build_train_jsonl.py + dialog_templates.json)  -> train.jsonl
+        └─ fix    (ターン順の修正)          -> train.fixed.jsonl
+            └─ paraphrase (paraphras.py)   -> train.paraphrased.jsonl
+                └─ dedup  (dedup.py)       -> train.dedup.jsonl
+                    └─ check (check.py)    -> check_report.json
+
+特徴:
+- 各ステージの出力は「入力のハッシュ + コードのハッシュ + パラメータ」で .pipeline_cache/ にキャッシュ
+  （変わっていないステージは実行せず、キャッシュから出力を戻すだけ）
+- build は括弧ありペアの一部（--holdout）を評価用に外す。eval_persona.py の既定と同じ割合なので、
+  評価は学習に使っていないペアだけで行われる
+- fix / paraphrase は行チャンク(シャード)単位でもキャッシュし、中身が変わったシャードだけ計算し直す
+- build は台詞単位に分かれておらず、kurisu.json が変われば毎回全件を作り直す。
+  台詞の文言を直しただけなら乱数の消費順は変わらず、変わるのはその台詞を使うレコードだけだが、
+  そうしたレコードは全体に散らばるので、下流のシャードも大半は計算し直しになる。
+  台詞の追加・削除や、直した結果 --max_assistant_len / --holdout での選別が変わった場合は、
+  台詞プールの並びがずれて全レコードが変わる（シャードのキャッシュは効かない）
+
+使い方:
+  python pipeline.py
+  python pipeline.py --n 20000 --workers 4
+  python pipeline.py --until paraphrase
+  python pipeline.py --force fix
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+from typing import Callable, Dict, List, Optional, Tuple
+
+import paraphras
+from build_train_jsonl import HOLDOUT
+from check import check_files
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(BASE_DIR, ".pipeline_cache")
+SHARD_LINES = 1000  # fix / paraphrase のシャード（行チャンク）サイズ
+
+# ==========================================
+# キャッシュ（内容アドレス）
+# ==========================================
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def combine(*parts: str) -> str:
+    return sha256_bytes("\0".join(parts).encode("utf-8"))
+
+class Cache:
+    """objects/ に内容ハッシュ名で保存し、keys/ にキー -> オブジェクトの対応を持つ"""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "keys"), exist_ok=True)
+
+    def _key_path(self, key: str) -> str:
+        return os.path.join(self.root, "keys", key + ".json")
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest)
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._key_path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        # オブジェクトが消えていたらキャッシュ無し扱い
+        if all(os.path.exists(self.object_path(d)) for d in entry.values()):
+            return entry
+        return None
+
+    def put(self, key: str, entry: Dict[str, str]):
+        tmp = self._key_path(key) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp, self._key_path(key))
+
+    def store_bytes(self, data: bytes) -> str:
+        digest = sha256_bytes(data)
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        return digest
+
+    def store_file(self, path: str) -> str:
+        digest = sha256_file(path)
+        obj = self.object_path(digest)
+        if not os.path.exists(obj):
+            shutil.copyfile(path, obj + ".tmp")
+            os.replace(obj + ".tmp", obj)
+        return digest
+
+    def materialize(self, digest: str, path: str):
+        """作業ディレクトリのファイルがキャッシュと違うときだけ書き戻す"""
+        if os.path.exists(path) and sha256_file(path) == digest:
+            return
+        shutil.copyfile(self.object_path(digest), path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+# ==========================================
+# fix: ターン順の修正
+# ==========================================
+def fix_record(obj: dict, max_assistant_len: int) -> dict:
+    """
+    手作業でやっていた修正を機械的に行う。
+    - 長すぎる assistant 台詞は直前の user ごと落とす
+    - 連続した同じロールのターンは1つにまとめる
+    - 最後が user なら落として assistant で終わらせる
+    """
+    msgs = obj["messages"]
+    system = [m for m in msgs[:1] if m["role"] == "system"]
+    body = msgs[len(system):]
+
+    kept: List[dict] = []
+    for m in body:
+        if m["role"] == "assistant" and len(m["content"]) > max_assistant_len:
+            if kept and kept[-1]["role"] == "user":
+                kept.pop()
+            continue
+        if kept and kept[-1]["role"] == m["role"]:
+            kept[-1] = {"role": m["role"], "content": kept[-1]["content"] + m["content"]}
+        else:
+            kept.append(dict(m))
+    while kept and kept[0]["role"] != "user":
+        kept.pop(0)
+    while kept and kept[-1]["role"] != "assistant":
+        kept.pop()
+    return {"id": obj["id"], "messages": system + kept}
+
+def fix_shard(job: Tuple[int, List[str], dict]) -> str:
+    _, lines, params = job
+    out = []
+    for line in lines:
+        if not line.strip():
+            continue
+        obj = fix_record(json.loads(line), params["max_assistant_len"])
+        # 修正の結果 user/assistant が1往復も残らなければ捨てる
+        if len(obj["messages"]) >= 3:
+            out.append(json.dumps(obj, ensure_ascii=False))
+    return "".join(line + "\n" for line in out)
+
+def paraphrase_shard(job: Tuple[int, List[str], dict]) -> str:
+    start, lines, params = job
+    rules = paraphras.RuleSet.from_file(params["rules"]) if params.get("rules") else paraphras.RuleSet.default()
+    paraphras._init_worker(rules, params["rate"], params["seed"])
+    text, _ = paraphras.process_chunk((start, lines))
+    return text
+
+# ==========================================
+# ステージ定義
+# ==========================================
+class Stage:
+    def __init__(self, name: str, deps: List[str], output: str, code: List[str],
+                 params: Callable[[argparse.Namespace], dict]):
+        self.name = name
+        self.deps = deps
+        self.output = output
+        self.code = code  # ハッシュに含めるソースファイル
+        self.params = params
+
+    def code_hash(self) -> str:
+        return combine(*[sha256_file(os.path.join(BASE_DIR, f)) for f in self.code])
+
+STAGES = [
+    Stage("build", [], "train.jsonl", ["build_train_jsonl.py", "template_engine.py", "dialog_templates.json"],
+          lambda a: {"n": a.n, "seed": a.seed, "max_assistant_len": a.max_assistant_len, "workers": a.workers,
+                     "holdout": a.holdout}),
+    Stage("fix", ["build"], "train.fixed.jsonl", ["pipeline.py"],
+          lambda a: {"max_assistant_len": a.max_assistant_len}),
+    Stage("paraphrase", ["fix"], "train.paraphrased.jsonl", ["paraphras.py"],
+          lambda a: {"rate": a.rate, "seed": a.seed, "rules": a.rules,
+                     "rules_hash": sha256_file(a.rules) if a.rules else ""}),
+    Stage("dedup", ["paraphrase"], "train.dedup.jsonl", ["dedup.py"],
+          lambda a: {"threshold": a.threshold}),
+    Stage("check", ["dedup"], "check_report.json", ["check.py"],
+          lambda a: {"max_assistant_len": a.max_assistant_len}),
+]
+SHARDED = {"fix": fix_shard, "paraphrase": paraphrase_shard}
+
+def iter_shards(path: str, size: int):
+    with open(path, encoding="utf-8") as f:
+        start = 0
+        lines: List[str] = []
+        for line in f:
+            lines.append(line)
+            if len(lines) >= size:
+                yield start, lines
+                start += len(lines)
+                lines = []
+        if lines:
+            yield start, lines
+
+def run_sharded(stage: Stage, cache: Cache, input_path: str, out_path: str,
+                params: dict, code_hash: str, workers: int) -> Tuple[int, int]:
+    """シャードごとにキャッシュを引き、無いものだけ計算する。(計算数, シャード数) を返す"""
+    func = SHARDED[stage.name]
+    pkey = json.dumps(params, sort_keys=True)
+    shards = []
+    for start, lines in iter_shards(input_path, SHARD_LINES):
+        key = combine(stage.name, code_hash, pkey, str(start), sha256_bytes("".join(lines).encode("utf-8")))
+        shards.append((key, start, lines))
+
+    missing = [(key, start, lines) for key, start, lines in shards if cache.get(key) is None]
+    jobs = [(start, lines, params) for _, start, lines in missing]
+    if workers > 1 and len(jobs) > 1:
+        with Pool(workers) as pool:
+            results = pool.map(func, jobs)
+    else:
+        results = [func(job) for job in jobs]
+    for (key, _, _), text in zip(missing, results):
+        cache.put(key, {"out": cache.store_bytes(text.encode("utf-8"))})
+
+    with open(out_path + ".tmp", "wb") as wf:
+        for key, _, _ in shards:
+            with open(cache.object_path(cache.get(key)["out"]), "rb") as rf:
+                shutil.copyfileobj(rf, wf)
+    os.replace(out_path + ".tmp", out_path)
+    return len(missing), len(shards)
+
+def run_stage(stage: Stage, args: argparse.Namespace, input_path: str, out_path: str, workers: int) -> str:
+    """ステージ本体を実行して out_path に書く。ログ用の一言を返す"""
+    params = stage.params(args)
+    if stage.name == "build":
+        subprocess.run([sys.executable, os.path.join(BASE_DIR, "build_train_jsonl.py"),
+                        "--in", input_path, "--out", out_path, "--n", str(params["n"]),
+                        "--seed", str(params["seed"]), "--max_assistant_len", str(params["max_assistant_len"]),
+                        "--workers", str(params["workers"]), "--holdout", str(params["holdout"])], check=True, stdout=subprocess.DEVNULL)
+        return "built"
+    if stage.name in SHARDED:
+        computed, total = run_sharded(stage, Cache(CACHE_DIR), input_path, out_path, params,
+                                      stage.code_hash(), workers)
+        return f"{computed}/{total} shards computed"
+    if stage.name == "dedup":
+        subprocess.run([sys.executable, os.path.join(BASE_DIR, "dedup.py"), "--in", input_path,
+                        "--out", out_path, "--threshold", str(params["threshold"])],
+                       check=True, stdout=subprocess.DEVNULL)
+        return "deduplicated"
+    if stage.name == "check":
+        limits = {"max_assistant_len": params["max_assistant_len"], "max_user_len": 200, "max_turns": 12}
+        report = check_files([input_path], limits, workers)
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        if report["bad"]:
+            raise SystemExit(f"check failed: {report['bad']} bad records (see {out_path})")
+        return f"{report['total']} records ok"
+    raise ValueError(stage.name)
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--in", dest="inp", default="kurisu.json", help="Source quotes JSON")
+    ap.add_argument("--n", type=int, default=2000)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--max_assistant_len", type=int, default=140)
+    ap.add_argument("--holdout", type=float, default=HOLDOUT, help="Fraction of paren pairs kept out for eval_persona.py")
+    ap.add_argument("--rate", type=float, default=paraphras.PARAPHRASE_RATE)
+    ap.add_argument("--rules", default=None, help="Paraphrase rule set JSON")
+    ap.add_argument("--threshold", type=float, default=0.8, help="Dedup similarity threshold")
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--until", default=None, help="Stop after this stage")
+    ap.add_argument("--force", nargs="*", default=[], help="Re-run these stages even if cached")
+    args = ap.parse_args(argv)
+
+    cache = Cache(CACHE_DIR)
+    names = [s.name for s in STAGES]
+    if args.until and args.until not in names:
+        raise SystemExit(f"unknown stage: {args.until}")
+
+    # 各ステージの出力ハッシュ（下流のキャッシュキーに使う）
+    produced: Dict[str, str] = {}
+    source_hash = sha256_file(args.inp)
+    for stage in STAGES:
+        t0 = time.time()
+        input_path = args.inp if not stage.deps else os.path.join(BASE_DIR, STAGES[names.index(stage.deps[0])].output)
+        input_hash = source_hash if not stage.deps else produced[stage.deps[0]]
+        params = stage.params(args)
+        key = combine(stage.name, stage.code_hash(), json.dumps(params, sort_keys=True), input_hash)
+        out_path = os.path.join(BASE_DIR, stage.output)
+
+        entry = None if stage.name in args.force else cache.get(key)
+        if entry is not None:
+            cache.materialize(entry["out"], out_path)
+            note = "cached"
+        else:
+            note = run_stage(stage, args, input_path, out_path, args.workers)
+            entry = {"out": cache.store_file(out_path)}
+            cache.put(key, entry)
+        produced[stage.name] = entry["out"]
+        print(f"[{stage.name:<10}] {note:<28} -> {stage.output} ({time.time() - t0:.2f}s)")
+
+        if stage.name == args.until:
+            break
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+学習用 JSONL を一度だけトークナイズしてキャッシュし、長さでまとめて詰め込んだ(packing)バッチを作るスクリプト。
+
+特徴:
+- チャットテンプレート(Llama-3)の適用とトークナイズは1回だけ
+- トークンIDは NumPy の memmap に保存。キャッシュのキーは
+  トークナイザー・チャットテンプレート・入力ファイルのハッシュ
+- 短い会話を max_seq_length の行に詰め込む（Best-Fit Decreasing、空き容量の二分探索）。
+  position_ids を会話ごとに 0 から振り直し、会話の先頭トークンは labels=-100 にする
+- 同じ行の別の会話には注意が向かないようにする（PackedCollator の attention）:
+  - varlen: FlashAttention があれば attention_mask を渡さず、position_ids の区切りで可変長モードにする
+  - block: 会話ごとのブロック対角（かつ因果）の4次元マスクを渡す。モデルの実装によって4次元マスクの
+    扱いが違うので、--check_mask で確かめたモデルでだけ明示的に使う
+  - padded: 詰め込まない（1行1会話、普通の attention_mask）。FlashAttention が無いときの既定
+- 詰め込み前後のパディング効率を表示
+- GPU は不要。小さいトークナイザーで CPU だけで試せる
+
+使い方:
+  python pretokenize.py --tokenizer unsloth/llama-3-8b-Instruct-bnb-4bit --in train.jsonl
+  python pretokenize.py --check_mask hf-internal-testing/tiny-random-LlamaForCausalLM   # block マスクの確認
+  python pretokenize.py --tokenizer hf-internal-testing/llama-tokenizer --in train.jsonl --max_seq_length 512 --batch_size 2
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import random
+import shutil
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+CACHE_ROOT = ".token_cache"
+TOKEN_DTYPE = np.uint32
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def cache_key(tokenizer, data_path: str) -> str:
+    """トークナイザー + チャットテンプレート + 入力データのハッシュ"""
+    h = hashlib.sha256()
+    h.update(str(getattr(tokenizer, "name_or_path", "")).encode("utf-8"))
+    h.update(str(len(tokenizer)).encode("utf-8"))
+    h.update(str(getattr(tokenizer, "chat_template", "") or "").encode("utf-8"))
+    h.update(file_sha256(data_path).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+class TokenCache:
+    """memmap されたトークン列（tokens.bin を offsets で区切る）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.tokens = np.memmap(os.path.join(path, "tokens.bin"), dtype=TOKEN_DTYPE, mode="r")
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+def build_or_load_cache(tokenizer, data_path: str, cache_root: str = CACHE_ROOT) -> TokenCache:
+    """キャッシュがあれば読み込み、無ければトークナイズして作る"""
+    key = cache_key(tokenizer, data_path)
+    path = os.path.join(cache_root, key)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return TokenCache(path)
+
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    offsets = [0]
+    with open(data_path, encoding="utf-8") as f, open(os.path.join(tmp, "tokens.bin"), "wb") as wf:
+        for line in f:
+            if not line.strip():
+                continue
+            conversation = json.loads(line)["messages"]
+            ids = tokenizer.apply_chat_template(conversation, tokenize=True, add_generation_prompt=False)
+            arr = np.asarray(ids, dtype=TOKEN_DTYPE)
+            wf.write(arr.tobytes())
+            offsets.append(offsets[-1] + len(arr))
+    np.save(os.path.join(tmp, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    meta = {
+        "tokenizer": str(getattr(tokenizer, "name_or_path", "")),
+        "data": os.path.abspath(data_path),
+        "records": len(offsets) - 1,
+        "tokens": offsets[-1],
+    }
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    # 書き終わってから置き換える（途中で落ちても壊れたキャッシュを残さない）
+    os.replace(tmp, path)
+    return TokenCache(path)
+
+def pack_sequences(lengths: np.ndarray, max_len: int) -> List[List[int]]:
+    """
+    Best-Fit Decreasing で会話を max_len の行に詰める。
+    (残り容量, 行番号) の整列済みリストを二分探索し、収まる中で一番空きの少ない行に入れる。
+    """
+    order = np.argsort(-lengths, kind="stable")
+    rows: List[List[int]] = []
+    spaces: List[Tuple[int, int]] = []  # (残り容量, 行番号) の昇順。空きの無い行は持たない
+    for i in order:
+        n = min(int(lengths[i]), max_len)
+        k = bisect.bisect_left(spaces, (n, -1))
+        if k < len(spaces):
+            space, row = spaces.pop(k)
+        else:
+            rows.append([])
+            space, row = max_len, len(rows) - 1
+        rows[row].append(int(i))
+        if space - n > 0:
+            bisect.insort(spaces, (space - n, row))
+    return rows
+
+def plan_batches(row_lengths: List[int], batch_size: int, seed: int = 3407) -> List[List[int]]:
+    """長さの近い行を同じバッチにまとめ（パディング最小化）、バッチ順はシャッフル"""
+    order = sorted(range(len(row_lengths)), key=lambda r: row_lengths[r])
+    batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    random.Random(seed).shuffle(batches)
+    return batches
+
+def padding_efficiency(batches: List[List[int]], lengths) -> float:
+    """実トークン数 / (バッチ内最大長 x バッチサイズ) の合計"""
+    real = padded = 0
+    for b in batches:
+        lens = [int(lengths[i]) for i in b]
+        real += sum(lens)
+        padded += max(lens) * len(lens)
+    return real / max(padded, 1)
+
+class PackedDataset:
+    """詰め込んだ行を input_ids / labels / position_ids として返す（torch Dataset 互換）"""
+
+    def __init__(self, cache: TokenCache, max_seq_length: int, batch_size: int, seed: int = 3407,
+                 pack: bool = True):
+        self.cache = cache
+        self.max_seq_length = max_seq_length
+        # pack=False なら1行1会話（注意を会話内に閉じる手段が無いとき用）
+        self.rows = pack_sequences(cache.lengths, max_seq_length) if pack else [[i] for i in range(len(cache))]
+        row_lengths = [sum(min(int(cache.lengths[i]), max_seq_length) for i in row) for row in self.rows]
+        # 長さの近い行が同じバッチに来るよう、バッチ計画の順に並べておく
+        batches = plan_batches(row_lengths, batch_size, seed)
+        self.order = [r for b in batches for r in b]
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __getitem__(self, idx: int) -> dict:
+        input_ids, labels, position_ids = [], [], []
+        for i in self.rows[self.order[idx]]:
+            ids = self.cache[i][:self.max_seq_length].tolist()
+            input_ids.extend(ids)
+            # 会話の先頭トークンは前の会話の続きとして予測させない
+            labels.extend([-100] + ids[1:])
+            position_ids.extend(range(len(ids)))
+        return {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+
+def segment_ids(position_ids: np.ndarray) -> np.ndarray:
+    """position_ids が 0 に戻るところで区切った会話番号（(batch, len) -> (batch, len)）"""
+    return np.cumsum(np.asarray(position_ids) == 0, axis=-1)
+
+def block_causal_mask(position_ids: np.ndarray) -> np.ndarray:
+    """
+    注意してよい位置の真偽値マスク (batch, 1, len, len)。
+    同じ会話の中の、自分より前（自分を含む）のトークンだけが True
+    """
+    seg = segment_ids(position_ids)
+    length = seg.shape[-1]
+    causal = np.tril(np.ones((length, length), dtype=bool))
+    return ((seg[:, :, None] == seg[:, None, :]) & causal)[:, None, :, :]
+
+def flash_attention_available() -> bool:
+    try:
+        import flash_attn  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def default_attention() -> str:
+    """詰め込めるのは FlashAttention の可変長モードがあるときだけ（block は明示的に選ぶ）"""
+    return "varlen" if flash_attention_available() else "padded"
+
+def check_block_mask(model_name: str) -> bool:
+    """
+    小さいモデルを CPU で動かして、block マスクで2会話を詰めた行の2つ目の会話の logits が、
+    その会話だけを流したときと一致するかを確かめる
+    """
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32, attn_implementation="eager")
+    model.eval()
+    g = torch.Generator().manual_seed(0)
+    a = torch.randint(3, model.config.vocab_size, (7,), generator=g).tolist()
+    b = torch.randint(3, model.config.vocab_size, (5,), generator=g).tolist()
+    collator = PackedCollator(0, attention="block", dtype=torch.float32)
+    packed = collator([{"input_ids": a + b, "labels": a + b, "position_ids": list(range(len(a))) + list(range(len(b)))}])
+    alone = collator([{"input_ids": b, "labels": b, "position_ids": list(range(len(b)))}])
+    with torch.no_grad():
+        out_packed = model(input_ids=packed["input_ids"], attention_mask=packed["attention_mask"],
+                           position_ids=packed["position_ids"]).logits[0, len(a):]
+        out_alone = model(input_ids=alone["input_ids"], attention_mask=alone["attention_mask"],
+                          position_ids=alone["position_ids"]).logits[0]
+    diff = float((out_packed - out_alone).abs().max())
+    ok = diff < 1e-4
+    print(f"block mask check ({model_name}): max |logit diff| = {diff:.2e} -> {'OK' if ok else 'LEAKS ACROSS DIALOGS'}")
+    return ok
+
+class PackedCollator:
+    """
+    バッチ内の最大長までパディングして torch テンソルにする。
+    attention="varlen" は attention_mask を付けない（FlashAttention が position_ids の区切りを会話の境界として使う）。
+    attention="block" は会話ごとのブロック対角マスクを加算形式（0 / dtype の最小値）の4次元で付ける
+    （--check_mask で確かめたモデルでだけ使う）。
+    attention="padded" は普通の2次元 attention_mask を付ける。1行に2会話以上あるとエラー（PackedDataset(pack=False) 用）。
+    "auto" は FlashAttention が入っていれば varlen、無ければ padded
+    """
+
+    def __init__(self, pad_token_id: int, attention: str = "auto", dtype=None):
+        if attention == "auto":
+            attention = default_attention()
+        if attention not in ("varlen", "block", "padded"):
+            raise ValueError(f"unknown attention mode: {attention}")
+        self.pad_token_id = pad_token_id
+        self.attention = attention
+        self.dtype = dtype  # block マスクの dtype（モデルの dtype に合わせる。None なら float32）
+
+    def __call__(self, features: List[dict]) -> dict:
+        import torch
+
+        max_len = max(len(f["input_ids"]) for f in features)
+        batch = {"input_ids": [], "labels": [], "position_ids": []}
+        for f in features:
+            pad = max_len - len(f["input_ids"])
+            batch["input_ids"].append(f["input_ids"] + [self.pad_token_id] * pad)
+            batch["labels"].append(f["labels"] + [-100] * pad)
+            # パディングも独立した1区間にする（どの会話からも見えない）
+            batch["position_ids"].append(f["position_ids"] + list(range(pad)))
+        if self.attention == "padded":
+            if any(sum(1 for p in f["position_ids"] if p == 0) > 1 for f in features):
+                raise ValueError("attention='padded' cannot isolate packed dialogs; use PackedDataset(pack=False)")
+            batch["attention_mask"] = [[1] * len(f["input_ids"]) + [0] * (max_len - len(f["input_ids"]))
+                                       for f in features]
+        out = {k: torch.tensor(v, dtype=torch.long) for k, v in batch.items()}
+        if self.attention == "block":
+            allowed = torch.from_numpy(block_causal_mask(np.asarray(batch["position_ids"])))
+            dtype = self.dtype or torch.float32
+            mask = torch.zeros(allowed.shape, dtype=dtype)
+            out["attention_mask"] = mask.masked_fill(~allowed, torch.finfo(dtype).min)
+        return out
+
+def report(cache: TokenCache, max_seq_length: int, batch_size: int, seed: int = 3407) -> dict:
+    """詰め込みなし（ランダムなバッチでパディング）と詰め込みありの効率を比べる"""
+    lengths = np.minimum(cache.lengths, max_seq_length)
+    idx = list(range(len(lengths)))
+    random.Random(seed).shuffle(idx)
+    naive = [idx[i:i + batch_size] for i in range(0, len(idx), batch_size)]
+
+    rows = pack_sequences(cache.lengths, max_seq_length)
+    row_lengths = [int(sum(lengths[i] for i in row)) for row in rows]
+    packed = plan_batches(row_lengths, batch_size, seed)
+
+    return {
+        "records": len(lengths),
+        "tokens": int(lengths.sum()),
+        "truncated": int((cache.lengths > max_seq_length).sum()),
+        # max_seq_length まで固定長でパディングした場合
+        "fixed_efficiency": float(lengths.sum()) / max(len(lengths) * max_seq_length, 1),
+        "naive_batches": len(naive),
+        "naive_efficiency": padding_efficiency(naive, lengths),
+        "packed_rows": len(rows),
+        "packed_batches": len(packed),
+        "packed_efficiency": padding_efficiency(packed, row_lengths),
+    }
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--tokenizer", default=None, help="HF tokenizer name or path (must have a chat template)")
+    ap.add_argument("--in", dest="inp", default="train.jsonl", help="Input JSONL")
+    ap.add_argument("--cache", default=CACHE_ROOT, help="Cache directory")
+    ap.add_argument("--max_seq_length", type=int, default=2048)
+    ap.add_argument("--batch_size", type=int, default=2, help="per_device_train_batch_size")
+    ap.add_argument("--check_mask", default=None, metavar="MODEL",
+                    help="Run a CPU forward pass with a small HF model (e.g. hf-internal-testing/tiny-random-LlamaForCausalLM) "
+                         "to check that the block mask isolates packed dialogs, then exit")
+    args = ap.parse_args(argv)
+
+    if args.check_mask:
+        raise SystemExit(0 if check_block_mask(args.check_mask) else 1)
+    if not args.tokenizer:
+        ap.error("--tokenizer is required")
+
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    cache = build_or_load_cache(tokenizer, args.inp, args.cache)
+    r = report(cache, args.max_seq_length, args.batch_size)
+
+    print(f"cache                : {cache.path}")
+    print(f"records / tokens     : {r['records']} / {r['tokens']}")
+    print(f"truncated records    : {r['truncated']}")
+    print(f"fixed-length padding : efficiency {r['fixed_efficiency']:.2%}")
+    print(f"no packing           : {r['naive_batches']} batches, efficiency {r['naive_efficiency']:.2%}")
+    print(f"packed               : {r['packed_rows']} rows, {r['packed_batches']} batches, efficiency {r['packed_efficiency']:.2%}")
+    print(f"steps per epoch      : {r['naive_batches']} -> {r['packed_batches']}")
+
+if __name__ == "__main__":
+    main()
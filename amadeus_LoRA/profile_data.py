@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+学習用 JSONL (train*.jsonl) の統計を取り、学習設定の目安を出すスクリプト。
+
+集計内容:
+- ロール別・会話単位の長さヒストグラム（トークン数。--tokenizer が無ければ文字数）
+- ターン数の分布
+- assistant 台詞の再利用回数（同じ台詞が何レコードに出るか）
+- max_seq_length / packing / per_device_train_batch_size / --max_assistant_len の推奨値
+  （max_seq_length・packing・バッチはトークン数で決まるので --tokenizer を付けたときだけ出す）
+
+レコードはストリームで読み、長さなどはチャンクごとに NumPy の bincount でまとめて数えるので、
+100万件規模でも数秒で終わる（トークナイザー使用時はトークナイズが律速）。
+
+使い方:
+  python profile_data.py --in train.jsonl train.paraphrased.jsonl
+  python profile_data.py --in train.jsonl --tokenizer unsloth/llama-3-8b-Instruct-bnb-4bit --json profile.json
+"""
+
+import argparse
+import hashlib
+import json
+import math
+from typing import Dict, List, Optional
+
+import numpy as np
+
+ROLES = ["system", "user", "assistant"]
+CHUNK = 8192  # この件数ごとに NumPy でまとめて集計
+# Llama-3 テンプレートの1メッセージあたりのヘッダー分（<|start_header_id|>role<|end_header_id|>\n\n ... <|eot_id|>）
+TEMPLATE_OVERHEAD = 5
+
+class Histogram:
+    """非負整数のヒストグラム（必要に応じて伸ばす）"""
+
+    def __init__(self):
+        self.counts = np.zeros(256, dtype=np.int64)
+
+    def add(self, values: np.ndarray):
+        if len(values) == 0:
+            return
+        binned = np.bincount(values)
+        if len(binned) > len(self.counts):
+            grown = np.zeros(len(binned), dtype=np.int64)
+            grown[:len(self.counts)] = self.counts
+            self.counts = grown
+        self.counts[:len(binned)] += binned
+
+    @property
+    def total(self) -> int:
+        return int(self.counts.sum())
+
+    def percentile(self, q: float) -> int:
+        if self.total == 0:
+            return 0
+        cum = np.cumsum(self.counts)
+        return int(np.searchsorted(cum, math.ceil(self.total * q / 100)))
+
+    def mean(self) -> float:
+        if self.total == 0:
+            return 0.0
+        return float((np.arange(len(self.counts)) * self.counts).sum() / self.total)
+
+    def summary(self) -> dict:
+        return {
+            "count": self.total,
+            "mean": round(self.mean(), 1),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": int(np.flatnonzero(self.counts)[-1]) if self.total else 0,
+        }
+
+    def buckets(self, edges: List[int]) -> Dict[str, int]:
+        """表示用にまとめた区間ごとの件数"""
+        cum = np.concatenate([[0], np.cumsum(self.counts)])
+        out = {}
+        lo = 0
+        for hi in edges:
+            if hi >= len(self.counts):
+                break
+            if hi > lo:
+                out[f"{lo}-{hi - 1}"] = int(cum[hi] - cum[lo])
+            lo = hi
+        # 最後の区間は上限なし（配列の長さは伸ばした都合で決まるだけなので、ラベルに使わない）
+        out[f"{lo}+"] = int(cum[-1] - cum[lo])
+        return out
+
+class Profiler:
+    def __init__(self, tokenizer=None, overhead: int = 0):
+        self.tokenizer = tokenizer
+        self.overhead = overhead
+        self.role_hist = {r: Histogram() for r in ROLES}
+        self.dialog_hist = Histogram()
+        self.assistant_chars = Histogram()
+        self.turn_hist = Histogram()
+        self.quote_hashes: List[np.ndarray] = []
+        self.records = 0
+        self.bad = 0
+        self._reset_chunk()
+
+    def _reset_chunk(self):
+        self._texts: List[str] = []
+        self._roles: List[int] = []
+        self._record_of: List[int] = []
+        self._turns: List[int] = []
+
+    def add(self, obj: dict):
+        msgs = obj.get("messages")
+        if not isinstance(msgs, list):
+            self.bad += 1
+            return
+        rec = len(self._turns)
+        turns = 0
+        for m in msgs:
+            if not isinstance(m, dict) or m.get("role") not in ROLES:
+                continue
+            self._texts.append(str(m.get("content", "")))
+            self._roles.append(ROLES.index(m["role"]))
+            self._record_of.append(rec)
+            turns += m["role"] != "system"
+        self._turns.append(turns)
+        self.records += 1
+        if len(self._turns) >= CHUNK:
+            self.flush()
+
+    def _lengths(self, texts: List[str]) -> np.ndarray:
+        if self.tokenizer is None:
+            return np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+        ids = self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+        return np.fromiter((len(x) for x in ids), dtype=np.int64, count=len(ids))
+
+    def flush(self):
+        if not self._turns:
+            return
+        roles = np.asarray(self._roles, dtype=np.int64)
+        record_of = np.asarray(self._record_of, dtype=np.int64)
+        lengths = self._lengths(self._texts) + self.overhead
+        for i, r in enumerate(ROLES):
+            self.role_hist[r].add(lengths[roles == i])
+        # 会話単位の長さ = メッセージ長の合計
+        self.dialog_hist.add(np.bincount(record_of, weights=lengths, minlength=len(self._turns)).astype(np.int64))
+        self.turn_hist.add(np.asarray(self._turns, dtype=np.int64))
+
+        asst = [t for t, r in zip(self._texts, self._roles) if r == 2]
+        self.assistant_chars.add(np.fromiter((len(t) for t in asst), dtype=np.int64, count=len(asst)))
+        self.quote_hashes.append(np.fromiter(
+            (int.from_bytes(hashlib.blake2b(t.strip().encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+             for t in asst),
+            dtype=np.int64, count=len(asst),
+        ))
+        self._reset_chunk()
+
+    def quote_reuse(self) -> dict:
+        if not self.quote_hashes:
+            return {"assistant_lines": 0, "unique": 0}
+        _, counts = np.unique(np.concatenate(self.quote_hashes), return_counts=True)
+        reuse = Histogram()
+        reuse.add(counts)
+        return {
+            "assistant_lines": int(counts.sum()),
+            "unique": int(len(counts)),
+            "unique_ratio": round(len(counts) / max(int(counts.sum()), 1), 4),
+            "max_reuse": int(counts.max()),
+            "reuse_distribution": reuse.buckets([2, 3, 5, 10, 50, 100]),
+        }
+
+def recommend(p: Profiler, tokens_per_step: int, device_tokens: int) -> dict:
+    """
+    集計から学習設定の目安を出す。
+    長さが文字数のとき（トークナイザー無し）は、トークン単位の設定（max_seq_length・packing・バッチ）は出さない
+    """
+    if p.tokenizer is None:
+        return {
+            "max_assistant_len": p.assistant_chars.percentile(99),
+            "note": "lengths are in characters; rerun with --tokenizer for max_seq_length / packing / batch size",
+        }
+    dialog = p.dialog_hist
+    # ほぼ全ての会話が切れずに入る長さ（64単位で切り上げ）
+    fit_len = max(64, int(math.ceil(dialog.percentile(99.9) / 64) * 64))
+    # 詰め込むなら1行はデバイスに載る範囲で長め（最大2048）にしてステップ数を減らす
+    row_len = max(fit_len, min(2048, device_tokens))
+    mean = max(dialog.mean(), 1.0)
+    # 1行に4会話以上入るなら詰め込み(packing)の効果が大きい
+    use_packing = mean * 4 <= row_len
+    if use_packing:
+        max_seq_length = row_len
+        per_row = row_len
+    else:
+        # 詰め込まない場合はバッチ内の最大長までの動的パディングを想定
+        max_seq_length = fit_len
+        per_row = max(dialog.percentile(90), 1)
+    per_device = max(1, device_tokens // per_row)
+    grad_accum = max(1, int(math.ceil(tokens_per_step / (per_device * per_row))))
+    return {
+        "max_seq_length": max_seq_length,
+        "packing": use_packing,
+        "dialogs_per_packed_row": round(max_seq_length / mean, 1) if use_packing else 1.0,
+        "per_device_train_batch_size": per_device,
+        "gradient_accumulation_steps": grad_accum,
+        "max_assistant_len": p.assistant_chars.percentile(99),
+    }
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--in", dest="inp", nargs="+", default=["train.jsonl"], help="Input JSONL files")
+    ap.add_argument("--tokenizer", default=None, help="HF tokenizer for token lengths (default: characters)")
+    ap.add_argument("--tokens_per_step", type=int, default=16384, help="Target tokens per optimizer step")
+    ap.add_argument("--device_tokens", type=int, default=4096, help="Tokens that fit in one device batch")
+    ap.add_argument("--json", default=None, help="Write the full profile as JSON")
+    args = ap.parse_args(argv)
+
+    tokenizer = None
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    unit = "tokens" if tokenizer else "chars"
+    p = Profiler(tokenizer, TEMPLATE_OVERHEAD if tokenizer else 0)
+
+    for path in args.inp:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    p.add(json.loads(line))
+                except json.JSONDecodeError:
+                    p.bad += 1
+    p.flush()
+
+    edges = [16, 32, 64, 128, 256, 512, 1024, 2048]
+    profile = {
+        "files": args.inp,
+        "unit": unit,
+        "records": p.records,
+        "bad_records": p.bad,
+        "roles": {r: p.role_hist[r].summary() for r in ROLES},
+        "dialog": p.dialog_hist.summary(),
+        "dialog_histogram": p.dialog_hist.buckets(edges),
+        "turns": p.turn_hist.summary(),
+        "turn_distribution": {str(i): int(c) for i, c in enumerate(p.turn_hist.counts) if c},
+        "assistant_chars": p.assistant_chars.summary(),
+        "quote_reuse": p.quote_reuse(),
+        "recommendation": recommend(p, args.tokens_per_step, args.device_tokens),
+    }
+
+    print(f"records={p.records}, bad={p.bad}, unit={unit}")
+    for r in ROLES:
+        print(f"  {r:<10}: {profile['roles'][r]}")
+    print(f"  dialog    : {profile['dialog']}")
+    print(f"  turns     : {profile['turn_distribution']}")
+    print(f"dialog length histogram ({unit}):")
+    for k, v in profile["dialog_histogram"].items():
+        if v:
+            print(f"  {k:>10}: {v}")
+    print(f"quote reuse: {profile['quote_reuse']}")
+    print("recommendation:")
+    for k, v in profile["recommendation"].items():
+        print(f"  {k:<28}: {v}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(profile, f, ensure_ascii=False, indent=2)
+        print(f"profile -> {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+会話テンプレート（dialog_templates.json）から学習用の会話をまとめて作るエンジン。
+build_train_jsonl.py から使う。
+
+テンプレートの形式:
+  {
+    "pools": {"follow_up": [...], "topic": [...], ...},      # user 発話の部品
+    "templates": [{
+      "name": "simple_smalltalk",
+      "weight": 12,                    # 出現比率（件数は重みに比例して決まる）
+      "quote": "plain",                # 最初の assistant 台詞を取る台詞プール（paren / plain / all）
+      "extra": "all",                  # 2発目以降の assistant 台詞のプール（省略時 all）
+      "opener": ["{smalltalk_opener}{topic}のことなんだけど"],  # 最初の user 発話
+      "reaction": ["{follow_up}"],     # 1発目の assistant への反応（省略時 {follow_up}）
+      "continue": ["{follow_up}"],     # 3往復目以降の user 発話（省略時 {follow_up}）
+      "assistant_turns": [2, 3]        # assistant のターン数の範囲
+    }]
+  }
+  {pool名} は pools の中から1つ選んで埋める。"{prompt}" だけは特別で、
+  括弧ありペアの "(…)" から作った問いをその台詞と対にして使う。
+
+会話の形は常に user → assistant の交互で、assistant で終わる。
+新しい会話パターンは JSON にテンプレートを足すだけで増やせる。
+
+速さのための工夫:
+- user 発話は部品の全組み合わせを事前に展開・整形し、JSON 文字列にエンコードしておく
+- 台詞も読み込み時に分割・長さで絞り込み、同じく事前にエンコード
+- テンプレート・台詞・追い質問の選択はバッチ単位で NumPy の乱数配列として一度に引く
+  （1件ごとの処理は事前エンコード済みの断片をつなぐだけ）
+"""
+
+import json
+import string
+from itertools import product
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# 1つの発話スロットで展開する組み合わせ数の上限
+MAX_VARIANTS = 100000
+# assistant のターン数の上限（user と合わせて12ターン。NAO 雑談用に長くしない）
+MAX_ASSISTANT_TURNS = 6
+DEFAULT_USER_SLOT = ["{follow_up}"]
+PROMPT_SLOT = "{prompt}"
+
+_encoder = json.JSONEncoder(ensure_ascii=False)
+
+def encode_message(role: str, content: str) -> str:
+    return _encoder.encode({"role": role, "content": content})
+
+def expand(alternatives: List[str], pools: Dict[str, List[str]], where: str) -> List[str]:
+    """"{pool}" を含む発話テンプレートを、全組み合わせの文字列に展開する"""
+    out = []
+    for alt in alternatives:
+        # parse は (直前の文字列, フィールド名) の組を返す（末尾の文字列だけならフィールドは None）
+        parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(alt)]
+        fields = [field for _, field in parts if field is not None]
+        for field in fields:
+            if field not in pools:
+                raise ValueError(f"{where}: unknown pool {{{field}}}")
+        combos = 1
+        for f in fields:
+            combos *= len(pools[f])
+        if combos > MAX_VARIANTS:
+            raise ValueError(f"{where}: {alt!r} expands to {combos} variants (max {MAX_VARIANTS})")
+        for values in product(*(pools[f] for f in fields)):
+            it = iter(values)
+            out.append("".join(literal + (next(it) if field is not None else "") for literal, field in parts))
+    if not out:
+        raise ValueError(f"{where}: no utterances")
+    return out
+
+class Template:
+    """1つの会話パターン（発話は全て事前エンコード済み）"""
+
+    def __init__(self, spec: dict, pools: Dict[str, List[str]], normalize: Callable[[str], str]):
+        self.name = spec["name"]
+        self.weight = float(spec.get("weight", 1))
+        self.quote = spec.get("quote", "all")
+        self.extra = spec.get("extra", "all")
+        lo, hi = spec.get("assistant_turns", [2, 2])
+        if not 1 <= lo <= hi <= MAX_ASSISTANT_TURNS:
+            raise ValueError(f"{self.name}: assistant_turns must be within 1..{MAX_ASSISTANT_TURNS}")
+        self.turns = (int(lo), int(hi))
+
+        opener = spec.get("opener")
+        if not opener:
+            raise ValueError(f"{self.name}: opener is required")
+        self.opener_from_prompt = PROMPT_SLOT in "".join(opener)
+        if self.opener_from_prompt:
+            if opener != [PROMPT_SLOT]:
+                raise ValueError(f"{self.name}: {PROMPT_SLOT} must be the whole opener")
+            self.openers: List[str] = []
+        else:
+            self.openers = [encode_message("user", normalize(s)) for s in expand(opener, pools, f"{self.name}.opener")]
+        self.reactions = [encode_message("user", normalize(s)) for s in
+                          expand(spec.get("reaction", DEFAULT_USER_SLOT), pools, f"{self.name}.reaction")]
+        self.continues = [encode_message("user", normalize(s)) for s in
+                          expand(spec.get("continue", DEFAULT_USER_SLOT), pools, f"{self.name}.continue")]
+
+class QuotePool:
+    """台詞プール（assistant 用の断片と、あれば "(…)" から作った user の問い）"""
+
+    def __init__(self, pairs: List[Tuple[Optional[str], str]]):
+        self.texts = [encode_message("assistant", t) for _, t in pairs]
+        self.prompts = [encode_message("user", p) if p else None for p, _ in pairs]
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+class TemplateEngine:
+    def __init__(self, spec: dict, quote_pools: Dict[str, List[Tuple[Optional[str], str]]],
+                 normalize: Callable[[str], str], system_prompt: str):
+        pools = spec.get("pools", {})
+        self.quotes = {name: QuotePool(pairs) for name, pairs in quote_pools.items()}
+        self.system = encode_message("system", system_prompt)
+        self.templates: List[Template] = []
+        self.skipped: List[str] = []
+        for t_spec in spec.get("templates", []):
+            t = Template(t_spec, pools, normalize)
+            for pool in (t.quote, t.extra):
+                if pool not in self.quotes:
+                    raise ValueError(f"{t.name}: unknown quote pool {pool!r}")
+            if t.opener_from_prompt and any(p is None for p in self.quotes[t.quote].prompts):
+                raise ValueError(f"{t.name}: {PROMPT_SLOT} needs a quote pool where every line has a prompt")
+            # 台詞が無いテンプレートは使わない（例: --holdout で括弧ありペアを全部取り分けた）
+            if len(self.quotes[t.quote]) == 0 or len(self.quotes[t.extra]) == 0 or t.weight <= 0:
+                self.skipped.append(t.name)
+                continue
+            self.templates.append(t)
+        if not self.templates:
+            raise ValueError("no usable templates")
+
+    @classmethod
+    def from_file(cls, path: str, quote_pools: Dict[str, List[Tuple[Optional[str], str]]],
+                  normalize: Callable[[str], str], system_prompt: str) -> "TemplateEngine":
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f), quote_pools, normalize, system_prompt)
+
+    @property
+    def names(self) -> List[str]:
+        return [t.name for t in self.templates]
+
+    def allocate(self, n: int) -> List[int]:
+        """n 件をテンプレートの重みに比例して割り振る（端数は大きい順に配る）"""
+        w = np.array([t.weight for t in self.templates], dtype=np.float64)
+        exact = n * w / w.sum()
+        counts = np.floor(exact).astype(np.int64)
+        rest = n - int(counts.sum())
+        order = np.argsort(-(exact - counts), kind="stable")
+        counts[order[:rest]] += 1
+        return counts.tolist()
+
+    def render_batch(self, rng: np.random.Generator, template_ids: np.ndarray) -> List[str]:
+        """テンプレート番号の配列から、JSONL の行をまとめて作る"""
+        size = len(template_ids)
+        ids = random_uuids(rng, size)
+        lines: List[Optional[str]] = [None] * size
+        for ti in np.unique(template_ids):
+            t = self.templates[ti]
+            rows = np.flatnonzero(template_ids == ti)
+            m = len(rows)
+            quote = self.quotes[t.quote]
+            extra = self.quotes[t.extra]
+            lo, hi = t.turns
+
+            # このテンプレートの分をまとめて引き、断片そのものの列にしておく
+            q_idx = rng.integers(len(quote), size=m).tolist()
+            n_asst = rng.integers(lo, hi + 1, size=m).tolist()
+            if t.opener_from_prompt:
+                openers = [quote.prompts[q] for q in q_idx]
+            else:
+                openers = [t.openers[i] for i in rng.integers(len(t.openers), size=m).tolist()]
+            reactions = [t.reactions[i] for i in rng.integers(len(t.reactions), size=m).tolist()]
+            # 追加の往復: (user, assistant) の断片を交互に並べた行列
+            users = [[t.continues[i] for i in row] for row in rng.integers(len(t.continues), size=(m, max(hi - 2, 0))).tolist()]
+            extras = [[extra.texts[i] for i in row] for row in rng.integers(len(extra), size=(m, max(hi - 1, 0))).tolist()]
+
+            system = self.system
+            for j, row in enumerate(rows.tolist()):
+                frags = [system, openers[j], quote.texts[q_idx[j]]]
+                turns = n_asst[j] - 1
+                if turns:
+                    ex = extras[j]
+                    frags.append(reactions[j])
+                    frags.append(ex[0])
+                    for k in range(1, turns):
+                        frags.append(users[j][k - 1])
+                        frags.append(ex[k])
+                lines[row] = '{"id": "' + ids[row] + '", "messages": [' + ", ".join(frags) + "]}"
+        return lines
+
+# UUID の16進表記（バージョン4の形式）を配列でまとめて作る
+_HEX = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+_DASHES = [8, 12, 16, 20]
+
+def random_uuids(rng: np.random.Generator, size: int) -> List[str]:
+    """rng から uuid4 と同じ形式の文字列を size 個作る（uuid.UUID を1件ずつ作るより速い）"""
+    b = np.frombuffer(rng.bytes(16 * size), dtype=np.uint8).reshape(size, 16).copy()
+    b[:, 6] = (b[:, 6] & 0x0F) | 0x40  # version 4
+    b[:, 8] = (b[:, 8] & 0x3F) | 0x80  # RFC 4122 variant
+    nibbles = np.stack([b >> 4, b & 0x0F], axis=-1).reshape(size, 32)
+    chars = np.insert(_HEX[nibbles], _DASHES, ord("-"), axis=1)
+    text = chars.tobytes().decode("ascii")
+    return [text[i:i + 36] for i in range(0, 36 * size, 36)]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""pretokenize.py の詰め込み: 同じ行の別の会話に注意が漏れないこと"""
+
+import numpy as np
+
+from pretokenize import block_causal_mask, pack_sequences, segment_ids
+
+
+def attend(x: np.ndarray, allowed: np.ndarray) -> np.ndarray:
+    """1ヘッドの自己注意（重みは固定の乱数）。allowed は (len, len) の真偽値"""
+    rng = np.random.default_rng(0)
+    wq, wk, wv = (rng.standard_normal((x.shape[-1], x.shape[-1])) for _ in range(3))
+    scores = (x @ wq) @ (x @ wk).T / np.sqrt(x.shape[-1])
+    scores = np.where(allowed, scores, -np.inf)
+    weights = np.exp(scores - scores.max(axis=-1, keepdims=True))
+    weights /= weights.sum(axis=-1, keepdims=True)
+    return weights @ (x @ wv)
+
+
+def test_tokens_cannot_attend_across_dialogs():
+    # 1行に 3 / 4 / 2 トークンの会話と、パディング 3
+    position_ids = np.array([[0, 1, 2, 0, 1, 2, 3, 0, 1, 0, 1, 2]])
+    allowed = block_causal_mask(position_ids)[0, 0]
+    seg = segment_ids(position_ids)[0]
+
+    # 別の会話の位置は一つも許されていない
+    assert not (allowed & (seg[:, None] != seg[None, :])).any()
+    # 会話の中は因果マスクそのもの
+    for s in np.unique(seg):
+        idx = np.flatnonzero(seg == s)
+        assert (allowed[np.ix_(idx, idx)] == np.tril(np.ones((len(idx), len(idx)), dtype=bool))).all()
+
+    # 2つ目の会話以外を書き換えても、2つ目の会話の出力は変わらない
+    rng = np.random.default_rng(1)
+    x = rng.standard_normal((position_ids.shape[1], 8))
+    y = x.copy()
+    other = seg != 2
+    y[other] = rng.standard_normal((int(other.sum()), 8))
+    out_x, out_y = attend(x, allowed), attend(y, allowed)
+    assert np.allclose(out_x[seg == 2], out_y[seg == 2])
+    assert not np.allclose(out_x[other], out_y[other])
+
+
+def test_pack_sequences_fits_and_keeps_every_dialog():
+    rng = np.random.default_rng(2)
+    lengths = rng.integers(1, 300, size=500)
+    lengths[:3] = [600, 512, 1]  # 1行より長い会話は切り詰めて1行を占める
+    rows = pack_sequences(lengths, 512)
+    assert sorted(i for row in rows for i in row) == list(range(len(lengths)))
+    for row in rows:
+        assert sum(min(int(lengths[i]), 512) for i in row) <= 512
+    # Best-Fit Decreasing なら下限の 11/9 倍 + 1 行以内
+    lower = int(np.ceil(np.minimum(lengths, 512).sum() / 512))
+    assert len(rows) <= lower * 11 / 9 + 1
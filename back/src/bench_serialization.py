@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+バックエンドのシリアライズ経路のマイクロベンチマーク。
+NAO からのリクエスト解析・NAO への応答・ダッシュボードへの Socket.IO 通知を、
+旧来の経路と高速な経路で比べる（1回あたりの時間とバイト数）。
+
+比べるもの:
+- リクエスト: dict のまま .get('x') で読む / NaoData.model_validate(dict) / NaoData.model_validate_json(bytes)
+  （顔の数を変えて。model_validate_json は JSON の解析と検証を pydantic-core で一度に行う）
+- 応答: FastAPI 既定（jsonable_encoder + json.dumps） / json.dumps のみ / orjson.dumps
+- Socket.IO: JSON パケット（既定） / msgpack パケット（serializer='msgpack'）
+
+--fixtures を付けると計測はせず、上の Socket.IO パケットを python-socketio で msgpack にしたバイト列を
+フロントエンドのパーサー（front/src/msgpackParser.ts）の往復テスト用に書き出す。
+
+使い方:
+  python bench_serialization.py
+  python bench_serialization.py --faces 1 4 16 --number 20000 --json bench_serialization.json
+  python bench_serialization.py --fixtures ../../front/tests/fixtures/msgpack_packets.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import timeit
+from typing import Callable, Dict, List, Optional
+
+from models import NaoData
+
+try:
+    from fastapi.encoders import jsonable_encoder
+except ImportError:
+    jsonable_encoder = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from socketio import packet as sio_packet
+    from socketio import msgpack_packet
+except ImportError:
+    sio_packet = msgpack_packet = None
+
+def nao_request(faces: int) -> dict:
+    """nao_eye.py が送るのと同じ形のリクエスト"""
+    return {
+        "message": "conversation",
+        "face_count": faces,
+        "face_positions": [{"x": -0.6 + 1.2 * i / max(faces - 1, 1), "y": 0.05 * i, "size": 0.02}
+                           for i in range(faces)],
+        "robot_id": "amadeus-01",
+        "user_speech": "タイムマシンって作れると思う？",
+    }
+
+def nao_response() -> dict:
+    text = "理論上は否定できないわ。でも、あなたが考えているような形では無理ね。"
+    return {
+        "status": "ok",
+        "action": "say",
+        "text": text,
+        "chunks": ["理論上は否定できないわ。", "でも、あなたが考えているような形では無理ね。"],
+        "face_count": 2,
+        "vocabulary": ["そうだね", "ちがう", "わからない", "タイムマシン", "理論"],
+    }
+
+def status_snapshot(robots: int = 10) -> dict:
+    """/api/status と同じくらいの大きさのダッシュボード向けデータ"""
+    return {
+        "llm_available": True,
+        "model": "gemma3:4b",
+        "active_sessions": robots,
+        "robots": {
+            f"amadeus-{i:02d}": {"robot_id": f"amadeus-{i:02d}", "mode": "conversation", "loop_hz": 9.8,
+                                 "last_latency_ms": 840 + i, "age": 1.2, "alive": True}
+            for i in range(robots)
+        },
+    }
+
+def socketio_events() -> List[tuple]:
+    """ダッシュボードへ送るイベント（ベンチマークと fixture で共通）"""
+    return [
+        ("nao_event", {"message": "hi", "text": nao_response()["text"], "face_count": 2, "session_id": "amadeus-01"}),
+        ("nao_heartbeat", status_snapshot()["robots"]["amadeus-00"]),
+    ]
+
+def _expected(value):
+    """fixture の期待値を JSON で書ける形にする（bigint は {"$bigint"}、日時は {"$date": ミリ秒}）"""
+    if isinstance(value, dict):
+        return {k: _expected(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_expected(v) for v in value]
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and abs(value) > 2 ** 53 - 1:
+        return {"$bigint": str(value)}
+    if isinstance(value, datetime.datetime):
+        return {"$date": round(value.timestamp() * 1000)}
+    return value
+
+def msgpack_fixtures() -> List[Dict]:
+    """
+    python-socketio（serializer='msgpack'）が送るパケットのバイト列と、デコード結果の期待値。
+    ダッシュボード向けのイベントに加えて、64bit 整数・str8/16・タイムスタンプ拡張型と、
+    パーサーが受け付けない拡張型（期待値は error）を含める。str32 は大きいのでテスト側で作る
+    """
+    import msgpack
+    # 日時はタイムスタンプ拡張型(-1)で送る
+    packet_cls = msgpack_packet.MsgPackPacket.configure(
+        dumps_default=lambda o: msgpack.Timestamp.from_datetime(o) if isinstance(o, datetime.datetime) else o)
+    utc = datetime.timezone.utc
+    events = socketio_events() + [
+        ("status", status_snapshot()),
+        ("int64", {"u32": 4000000000, "u64": 1760000000000, "i64": -1760000000000,
+                   "u64_max": 2 ** 64 - 1, "i64_min": -2 ** 63}),
+        ("strings", {"fixstr": "ね", "str8": "あ" * 20, "str16": "あ" * 100}),
+        ("timestamps", {"ts32": datetime.datetime(2026, 10, 19, tzinfo=utc),
+                        "ts64": datetime.datetime(2026, 10, 19, 12, 34, 56, 789000, tzinfo=utc),
+                        "ts96": datetime.datetime(1960, 1, 1, 0, 0, 0, 500000, tzinfo=utc)}),
+    ]
+    fixtures = []
+    # 名前空間はサーバーの emit と同じく "/"
+    for event, obj in events:
+        pkt = packet_cls(sio_packet.EVENT, data=[event, obj], namespace="/")
+        fixtures.append({"name": event, "hex": pkt.encode().hex(), "expected": _expected(pkt._to_dict())})
+    pkt = packet_cls(sio_packet.EVENT, data=["ext", {"blob": msgpack.ExtType(5, b"abc")}], namespace="/")
+    fixtures.append({"name": "unknown ext", "hex": pkt.encode().hex(), "error": "unsupported ext type 5"})
+    return fixtures
+
+def read_positions_untyped(payload: dict) -> float:
+    return sum(pos.get("x", 0) for pos in payload["face_positions"])
+
+def read_positions_typed(data: NaoData) -> float:
+    return sum(pos.x for pos in data.face_positions)
+
+def measure(fn: Callable[[], object], number: int) -> float:
+    """1回あたりのマイクロ秒（3回測って最小）"""
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+def run(faces_list: List[int], number: int) -> List[Dict]:
+    rows = []
+
+    def add(group: str, name: str, fn: Callable[[], object], size: Optional[int] = None):
+        rows.append({"group": group, "name": name, "us": round(measure(fn, number), 2), "bytes": size})
+
+    for faces in faces_list:
+        payload = nao_request(faces)
+        raw = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        group = f"request ({faces} faces)"
+        add(group, "json.loads + dict.get", lambda: read_positions_untyped(json.loads(raw)), len(raw))
+        add(group, "json.loads + model_validate", lambda: read_positions_typed(NaoData.model_validate(json.loads(raw))))
+        add(group, "model_validate_json", lambda: read_positions_typed(NaoData.model_validate_json(raw)))
+
+    for group, obj in (("response (nao)", nao_response()), ("response (status)", status_snapshot())):
+        plain = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if jsonable_encoder is not None:
+            add(group, "jsonable_encoder + json.dumps",
+                lambda: json.dumps(jsonable_encoder(obj), ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+                len(plain))
+        add(group, "json.dumps", lambda: json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+            len(plain))
+        if orjson is not None:
+            add(group, "orjson.dumps", lambda: orjson.dumps(obj), len(orjson.dumps(obj)))
+
+    if sio_packet is not None:
+        for event, obj in socketio_events():
+            group = f"socket.io ({event})"
+            js = sio_packet.Packet(sio_packet.EVENT, data=[event, obj])
+            add(group, "json packet", js.encode, len(js.encode().encode("utf-8")))
+            try:
+                mp = msgpack_packet.MsgPackPacket(sio_packet.EVENT, data=[event, obj])
+            except ImportError:
+                continue  # msgpack が入っていない
+            add(group, "msgpack packet", mp.encode, len(mp.encode()))
+    return rows
+
+def print_table(rows: List[Dict]):
+    group = None
+    for r in rows:
+        if r["group"] != group:
+            group = r["group"]
+            base = r["us"]
+            print(f"\n[{group}]")
+        size = f"{r['bytes']:>6} B" if r["bytes"] is not None else " " * 8
+        print(f"  {r['name']:<32} {r['us']:>9.2f} us  {size}  x{base / r['us']:.2f}")
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--faces", type=int, nargs="*", default=[1, 4, 16], help="Face counts in the request payload")
+    ap.add_argument("--number", type=int, default=10000, help="Iterations per measurement")
+    ap.add_argument("--json", default=None, help="Write the results as JSON")
+    ap.add_argument("--fixtures", default=None, help="Write msgpack packet fixtures for the frontend tests and exit")
+    args = ap.parse_args(argv)
+
+    if args.fixtures:
+        if msgpack_packet is None:
+            raise SystemExit("python-socketio and msgpack are required for --fixtures")
+        fixtures = msgpack_fixtures()
+        os.makedirs(os.path.dirname(os.path.abspath(args.fixtures)), exist_ok=True)
+        with open(args.fixtures, "w", encoding="utf-8") as f:
+            json.dump(fixtures, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"{len(fixtures)} fixtures -> {args.fixtures}")
+        return
+
+    print(f"python {sys.version.split()[0]} / orjson: {'yes' if orjson else 'no'} / "
+          f"socketio: {'yes' if sio_packet else 'no'}")
+    rows = run(args.faces, args.number)
+    print_table(rows)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# src/diagnostics.py
+"""
+本番のバックエンドをその場で調べるための道具（main.py の /api/debug/* から使う）。
+
+- SamplingProfiler: 別スレッドから一定間隔で全スレッドのスタック（sys._current_frames）を覗き、
+  同じスタックを数え上げるサンプリングプロファイラ。対象のコードには何も仕込まないので、
+  動かしている間もイベントループはほぼそのまま動く（既定 100Hz）
+  出力は collapsed stack（flamegraph.pl / speedscope で読める）か speedscope の JSON
+- LoopLagMonitor: 一定間隔で眠って、予定より何ミリ秒遅れて起きたか（＝イベントループが
+  他の処理で塞がっていた時間）をヒストグラムに数える
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Dict, List, Optional, Tuple
+
+# スタックの1段（関数名, ファイル名, 関数の先頭行）。行ではなく関数単位でまとめる
+Frame = Tuple[str, str, int]
+
+# ループ遅延のヒストグラムの区切り（ミリ秒、最後は上限なし）
+LAG_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+class SamplingProfiler:
+    """指定した秒数だけ全スレッドのスタックを一定間隔で集める"""
+
+    def __init__(self, interval: float = 0.01, loop_thread_id: Optional[int] = None):
+        self.interval = interval
+        self.loop_thread_id = loop_thread_id  # イベントループのスレッド（表示名を分かりやすくする）
+        self.stacks: Counter = Counter()  # {(スレッド名, (フレーム, ...)): 回数}（根 → 葉の順）
+        self.samples = 0
+        self.elapsed = 0.0
+        self._frames: Dict[object, Frame] = {}
+
+    def _frame(self, code) -> Frame:
+        frame = self._frames.get(code)
+        if frame is None:
+            frame = self._frames[code] = (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+        return frame
+
+    def _thread_names(self) -> Dict[int, str]:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        if self.loop_thread_id is not None:
+            names[self.loop_thread_id] = "event-loop"
+        return names
+
+    def sample(self, me: int):
+        names = self._thread_names()
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[(names.get(ident, f"thread-{ident}"), tuple(stack))] += 1
+        self.samples += 1
+
+    def run(self, seconds: float):
+        """この呼び出しのスレッドで seconds 秒サンプリングする（別スレッドで呼ぶ）"""
+        me = threading.get_ident()
+        start = time.perf_counter()
+        deadline = start + seconds
+        next_at = start
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            if now >= next_at:
+                self.sample(me)
+                next_at += self.interval
+                if next_at < now:
+                    next_at = now + self.interval  # 遅れた分は取り戻さない
+            time.sleep(max(0.0, min(next_at, deadline) - time.perf_counter()))
+        self.elapsed = time.perf_counter() - start
+
+    def collapsed(self) -> str:
+        """collapsed stack 形式（1行1スタック: "スレッド;根;...;葉 回数"）"""
+        lines = [";".join([thread] + [f"{name} ({file}:{line})" for name, file, line in stack]) + f" {count}"
+                 for (thread, stack), count in self.stacks.most_common()]
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name: str = "amadeus backend") -> dict:
+        """speedscope の JSON 形式（スレッドごとに1プロファイル、同じスタックはまとめて重み付け）"""
+        frames: List[dict] = []
+        index: Dict[Frame, int] = {}
+        per_thread: Dict[str, List[Tuple[List[int], int]]] = {}
+        for (thread, stack), count in self.stacks.items():
+            ids = []
+            for frame in stack:
+                i = index.get(frame)
+                if i is None:
+                    i = index[frame] = len(frames)
+                    frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                ids.append(i)
+            per_thread.setdefault(thread, []).append((ids, count))
+        profiles = []
+        for thread, entries in sorted(per_thread.items(), key=lambda kv: kv[0] != "event-loop"):
+            weights = [count * self.interval for _, count in entries]
+            profiles.append({
+                "type": "sampled",
+                "name": thread,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": [ids for ids, _ in entries],
+                "weights": weights,
+            })
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "amadeus diagnostics",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+
+class LoopLagMonitor:
+    """イベントループの遅れを測り続ける（start はイベントループ上で呼ぶ）"""
+
+    def __init__(self, interval: float = 0.1, recent: int = 600):
+        self.interval = interval
+        self.counts = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.recent = deque(maxlen=recent)  # 直近の遅れ（ミリ秒。既定で直近1分）
+        self.max_ms = 0.0
+        self.started_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (loop.time() - expected) * 1000)
+            self.record(lag_ms)
+
+    def record(self, lag_ms: float):
+        i = next((i for i, edge in enumerate(LAG_BUCKETS_MS) if lag_ms <= edge), len(LAG_BUCKETS_MS))
+        self.counts[i] += 1
+        self.recent.append(lag_ms)
+        self.max_ms = max(self.max_ms, lag_ms)
+
+    def start(self):
+        if self._task is None:
+            self.started_at = time.time()
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def snapshot(self) -> dict:
+        recent = sorted(self.recent)
+
+        def pct(p: float) -> float:
+            return round(recent[min(len(recent) - 1, int(p * len(recent)))], 2) if recent else 0.0
+
+        labels = [f"<={edge}ms" for edge in LAG_BUCKETS_MS] + [f">{LAG_BUCKETS_MS[-1]}ms"]
+        return {
+            "interval_ms": self.interval * 1000,
+            "uptime_s": round(time.time() - self.started_at, 1) if self.started_at else 0.0,
+            "samples": sum(self.counts),
+            "histogram": dict(zip(labels, self.counts)),
+            "max_ms": round(self.max_ms, 2),
+            "recent": {"samples": len(recent), "p50_ms": pct(0.5), "p90_ms": pct(0.9),
+                       "p99_ms": pct(0.99), "max_ms": round(recent[-1], 2) if recent else 0.0},
+        }
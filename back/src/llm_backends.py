@@ -0,0 +1,495 @@
+# src/llm_backends.py
+"""
+推論サーバー（LLM）の切り替え・分散・フェイルオーバー。
+
+対応するバックエンド:
+  ollama    ローカル/LAN の Ollama（keep-alive の非同期HTTP接続を使い回す）
+  llamacpp  llama.cpp の llama-server（会話はセッションごとに同じスロットを使い、KVキャッシュを残す）
+  gemini    Google Gemini（google-generativeai、要 GEMINI_API_KEY）
+  mock      決まった返事を返すだけ（推論サーバー無しでの動作確認用）
+
+LLM_BACKENDS で「種類=接続先@重み」をカンマ区切りで並べる:
+  LLM_BACKENDS=ollama=http://localhost:11434@2,ollama=http://192.168.10.3:11434,gemini=gemini-1.5-flash@0
+
+- セッションはどのバックエンドを使うかを重み付きのハッシュ（rendezvous hashing）で決める。
+  同じセッションは同じサーバーに行くので、固定プロンプトのKVキャッシュがそのまま効く
+- 失敗したバックエンドは不調扱いにして次の候補へ回す（その分のセッションだけが移る）
+- 重み 0 は予備（他が全部使えないときだけ使う）
+
+バックエンドごとにサーキットブレーカーを持つ:
+  closed     普通に使う。連続して失敗・遅延したら open にする
+  open       使わない（待たずに次の候補か辞書の返事になる）。ヘルスチェックで落ちていても open
+  half_open  一定時間後に試しの問い合わせを1つだけ送る。成功すれば closed、失敗すれば
+             待ち時間を倍にして open に戻る（試している間も普段の問い合わせは送らない）
+
+先読み（外れたら捨てる返答）は LLMRouter.speculate から送る。ブレーカーの成功・失敗・遅延には数えない。
+問い合わせには purpose（"dialog" / "speculative" / "proactive"）を付け、llama.cpp では会話以外を
+予備のスロットに回して、会話用スロットのKVキャッシュを上書きしないようにする
+"""
+
+import asyncio
+import hashlib
+import math
+import time
+from typing import Awaitable, Callable, List, NamedTuple, Optional
+
+import httpx
+
+try:
+    import google.generativeai as genai
+except ImportError:
+    genai = None
+
+
+class LLMReply(NamedTuple):
+    text: str
+    prompt_tokens: Optional[int]  # 実際に評価したプロンプトのトークン数（KVキャッシュ分を除く。不明なら None）
+    backend: str
+
+
+class BackendError(Exception):
+    """バックエンドが使えなかった（接続失敗・HTTPエラー・空の返答）"""
+
+
+class CircuitBreaker:
+    """1つのバックエンド（接続先とモデルの組）の開閉状態"""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 3, slow_call: float = 15.0, slow_threshold: int = 3,
+                 cooldown: float = 10.0, max_cooldown: float = 120.0):
+        self.failure_threshold = failure_threshold
+        self.slow_call = slow_call  # これより時間がかかった返答は「遅い」とみなす（秒）
+        self.slow_threshold = slow_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = self.CLOSED
+        self.cooldown = cooldown
+        self.failures = 0  # 連続した失敗
+        self.slow = 0  # 連続した遅い返答
+        self.opened_at = 0.0
+        self.reason = ""
+        self.trips = 0
+        # 状態が変わったときに (古い状態, 新しい状態) で呼ばれる
+        self.on_change: Optional[Callable[[str, str], None]] = None
+
+    def _set(self, state: str):
+        old, self.state = self.state, state
+        if old != state and self.on_change is not None:
+            self.on_change(old, state)
+
+    def allow(self) -> bool:
+        return self.state == self.CLOSED
+
+    def record_success(self, elapsed: float):
+        self.failures = 0
+        if elapsed <= self.slow_call:
+            self.slow = 0
+            return
+        self.slow += 1
+        if self.slow >= self.slow_threshold:
+            self.trip(f"{self.slow} slow calls (last {elapsed:.1f}s)")
+
+    def record_failure(self, reason: str):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.trip(f"{self.failures} failures: {reason}")
+
+    def trip(self, reason: str):
+        self.reason = reason
+        self.opened_at = time.time()
+        self.trips += 1
+        self._set(self.OPEN)
+
+    def probe_due(self) -> bool:
+        return self.state == self.OPEN and time.time() - self.opened_at >= self.cooldown
+
+    def begin_probe(self):
+        self._set(self.HALF_OPEN)
+
+    def end_probe(self, ok: bool, reason: str = ""):
+        if ok:
+            self.failures = self.slow = 0
+            self.cooldown = self.base_cooldown
+            self.reason = ""
+            self._set(self.CLOSED)
+        else:
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self.trip(reason)
+
+    def status(self) -> dict:
+        info = {"state": self.state, "trips": self.trips}
+        if self.state != self.CLOSED:
+            info["reason"] = self.reason
+            info["retry_in"] = round(max(0.0, self.opened_at + self.cooldown - time.time()), 1)
+        return info
+
+
+class LLMBackend:
+    """推論サーバー1台分。chat と health を実装する"""
+
+    kind = "base"
+
+    def __init__(self, target: str, weight: float = 1.0):
+        self.target = target
+        self.weight = weight
+        self.breaker = CircuitBreaker()
+        self.last_error = ""
+        self.stats = {"requests": 0, "failures": 0}
+
+    @property
+    def healthy(self) -> bool:
+        return self.breaker.allow()
+
+    @property
+    def name(self) -> str:
+        return f"{self.kind}={self.target}"
+
+    async def chat(self, messages: List[dict], session_id: Optional[str] = None,
+                   num_predict: Optional[int] = None, purpose: str = "dialog") -> LLMReply:
+        """purpose は何のための問い合わせか（"dialog" / "speculative" / "proactive"）。スロットを持つバックエンドだけが見る"""
+        raise NotImplementedError
+
+    async def health(self) -> bool:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "weight": self.weight,
+            "breaker": self.breaker.status(),
+            "last_error": self.last_error,
+            **self.stats,
+        }
+
+
+class OllamaBackend(LLMBackend):
+    """Ollama の /api/chat。接続はバックエンドごとに1つのクライアントで使い回す"""
+
+    kind = "ollama"
+
+    def __init__(self, target: str, weight: float, model: str, keep_alive: str, timeout: float):
+        if "://" not in target:
+            target = "http://" + target  # OLLAMA_HOST は "host:port" だけでもよい
+        super().__init__(target.rstrip("/"), weight)
+        self.model = model
+        self.keep_alive = keep_alive
+        self.client = httpx.AsyncClient(
+            base_url=self.target,
+            timeout=httpx.Timeout(timeout, connect=3.0),
+            limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=120),
+        )
+
+    async def chat(self, messages, session_id=None, num_predict=None, purpose="dialog"):
+        body = {"model": self.model, "messages": messages, "stream": False, "keep_alive": self.keep_alive}
+        if num_predict:
+            body["options"] = {"num_predict": num_predict}
+        try:
+            r = await self.client.post("/api/chat", json=body)
+            r.raise_for_status()
+            data = r.json()
+        except (httpx.HTTPError, ValueError) as e:
+            raise BackendError(f"{self.name}: {e}") from e
+        return LLMReply(data.get("message", {}).get("content", ""), data.get("prompt_eval_count"), self.name)
+
+    async def health(self):
+        # サーバーが応答し、かつモデルが入っていること
+        r = await self.client.get("/api/tags", timeout=3.0)
+        r.raise_for_status()
+        names = {m.get("name") for m in r.json().get("models", [])}
+        model = self.model if ":" in self.model else self.model + ":latest"
+        if model not in names:
+            raise BackendError(f"model {self.model} not found")
+        return True
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class LlamaCppBackend(LLMBackend):
+    """
+    llama.cpp の llama-server（OpenAI 互換の /v1/chat/completions）。
+    セッションを決まったスロットに割り当てて、スロットに残ったKVキャッシュを再利用させる。
+    スロット数はサーバーの --parallel に合わせる。
+    スロットが2つ以上あれば最後の1つは予備にして、先読みや話しかけ（purpose が "dialog" 以外）はそこに回す。
+    会話用のスロットはセッションの会話だけが使うので、固定プロンプトのキャッシュが他の用途で追い出されない
+    （スロットが1つだけのときは分けられないので、全部そのスロットを使う）
+    """
+
+    kind = "llamacpp"
+
+    def __init__(self, target: str, weight: float, slots: int, timeout: float):
+        super().__init__(target.rstrip("/"), weight)
+        self.slots = max(1, slots)
+        self.client = httpx.AsyncClient(
+            base_url=self.target,
+            timeout=httpx.Timeout(timeout, connect=3.0),
+            limits=httpx.Limits(max_keepalive_connections=self.slots, keepalive_expiry=120),
+        )
+
+    @property
+    def dialog_slots(self) -> int:
+        return self.slots - 1 if self.slots >= 2 else self.slots
+
+    def slot_for(self, session_id: Optional[str], purpose: str = "dialog") -> int:
+        if purpose != "dialog":
+            return self.slots - 1  # 予備のスロット
+        if not session_id:
+            return -1  # 空いているスロットに任せる
+        digest = hashlib.blake2b(session_id.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % self.dialog_slots
+
+    async def chat(self, messages, session_id=None, num_predict=None, purpose="dialog"):
+        body = {"messages": messages, "stream": False, "cache_prompt": True, "id_slot": self.slot_for(session_id, purpose)}
+        if num_predict:
+            body["max_tokens"] = num_predict
+        try:
+            r = await self.client.post("/v1/chat/completions", json=body)
+            r.raise_for_status()
+            data = r.json()
+            text = data["choices"][0]["message"]["content"]
+        except (httpx.HTTPError, ValueError, KeyError, IndexError) as e:
+            raise BackendError(f"{self.name}: {e}") from e
+        # timings.prompt_n はキャッシュに無かった分だけ（無ければ全体の数）
+        evaluated = data.get("timings", {}).get("prompt_n", data.get("usage", {}).get("prompt_tokens"))
+        return LLMReply(text, evaluated, self.name)
+
+    async def health(self):
+        # モデル読み込み中は 503 が返る
+        r = await self.client.get("/health", timeout=3.0)
+        r.raise_for_status()
+        return True
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class GeminiBackend(LLMBackend):
+    """Google Gemini。system は system_instruction に、assistant は model ロールにする"""
+
+    kind = "gemini"
+
+    def __init__(self, target: str, weight: float, api_key: str):
+        super().__init__(target, weight)
+        self.api_key = api_key
+        if genai is not None and api_key:
+            genai.configure(api_key=api_key)
+
+    async def chat(self, messages, session_id=None, num_predict=None, purpose="dialog"):
+        if genai is None or not self.api_key:
+            raise BackendError(f"{self.name}: google-generativeai or GEMINI_API_KEY is missing")
+        system = "\n".join(m["content"] for m in messages if m["role"] == "system")
+        contents = [{"role": "model" if m["role"] == "assistant" else "user", "parts": [m["content"]]}
+                    for m in messages if m["role"] != "system"]
+        config = {"max_output_tokens": num_predict} if num_predict else None
+        try:
+            model = genai.GenerativeModel(self.target, system_instruction=system or None)
+            response = await model.generate_content_async(contents, generation_config=config)
+            text = response.text
+        except Exception as e:
+            raise BackendError(f"{self.name}: {e}") from e
+        return LLMReply(text, None, self.name)
+
+    async def health(self):
+        if genai is None or not self.api_key:
+            raise BackendError("google-generativeai or GEMINI_API_KEY is missing")
+        return True
+
+
+class MockBackend(LLMBackend):
+    """最後の user 発話から決まった返事を選ぶ（同じ入力には必ず同じ返事）"""
+
+    kind = "mock"
+    REPLIES = [
+        "ふーん、そういうこと。",
+        "非論理的ね。",
+        "それで、根拠は？",
+        "悪くない仮説ね。",
+        "……別に、興味ないけど。",
+    ]
+
+    async def chat(self, messages, session_id=None, num_predict=None, purpose="dialog"):
+        last = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        digest = hashlib.blake2b(last.encode("utf-8"), digest_size=4).digest()
+        return LLMReply(self.REPLIES[int.from_bytes(digest, "big") % len(self.REPLIES)], 0, self.name)
+
+    async def health(self):
+        return True
+
+
+class LLMRouter:
+    """複数のバックエンドからセッションごとに1つを選び、失敗したら次へ回す"""
+
+    # half_open で送る試しの問い合わせ
+    PROBE_MESSAGES = [{"role": "user", "content": "ping"}]
+
+    def __init__(self, backends: List[LLMBackend], probe_interval: float = 15.0, **breaker_options):
+        if not backends:
+            raise ValueError("no LLM backends configured")
+        self.backends = backends
+        self.probe_interval = probe_interval
+        self.stats = {"failovers": 0, "exhausted": 0, "short_circuited": 0, "speculative": 0}
+        # ブレーカーの状態が変わったら呼ぶ（ダッシュボードへの通知用）
+        self.listener: Optional[Callable[[dict], Awaitable[None]]] = None
+        self._notify_tasks = set()
+        self._probe_task: Optional[asyncio.Task] = None
+        for b in backends:
+            b.breaker = CircuitBreaker(**breaker_options)
+            b.breaker.on_change = lambda old, new, b=b: self._breaker_changed(b, old, new)
+
+    def _breaker_changed(self, backend: LLMBackend, old: str, new: str):
+        print(f"★LLM Breaker: {backend.name} {old} -> {new} {backend.breaker.reason}")
+        if self.listener is None:
+            return
+        task = asyncio.get_running_loop().create_task(self.listener(backend.status()))
+        self._notify_tasks.add(task)
+        task.add_done_callback(self._notify_tasks.discard)
+
+    def candidates(self, session_id: Optional[str]) -> List[LLMBackend]:
+        """
+        試す順に並べたバックエンド（ブレーカーが closed のものだけ）。
+        重み付きのハッシュ順なのでセッションごとに固定。重み 0 の予備は最後。
+        """
+        key = session_id or ""
+
+        def score(b: LLMBackend) -> float:
+            if b.weight <= 0:
+                return -math.inf
+            h = hashlib.blake2b(f"{key}|{b.name}".encode("utf-8"), digest_size=8).digest()
+            u = (int.from_bytes(h, "big") + 1) / 2.0 ** 64  # (0, 1]
+            return -b.weight / math.log(u) if u < 1 else math.inf
+
+        return sorted((b for b in self.backends if b.healthy), key=lambda b: -score(b))
+
+    async def chat(self, messages: List[dict], session_id: Optional[str] = None,
+                   num_predict: Optional[int] = None, purpose: str = "dialog") -> LLMReply:
+        candidates = self.candidates(session_id)
+        if not candidates:
+            # 全部 open なら待たずに諦める（呼び出し側は辞書の返事にする）
+            self.stats["short_circuited"] += 1
+            raise BackendError("all LLM circuits are open")
+        errors = []
+        for i, backend in enumerate(candidates):
+            if not backend.healthy:
+                continue  # 前の候補を待っている間に open になった
+            backend.stats["requests"] += 1
+            started = time.monotonic()
+            try:
+                reply = await backend.chat(messages, session_id=session_id, num_predict=num_predict, purpose=purpose)
+            except BackendError as e:
+                backend.stats["failures"] += 1
+                backend.last_error = str(e)
+                backend.breaker.record_failure(str(e))
+                errors.append(str(e))
+                print(f"LLM Backend Error: {e}")
+                continue
+            backend.breaker.record_success(time.monotonic() - started)
+            if i > 0:
+                self.stats["failovers"] += 1
+            return reply
+        self.stats["exhausted"] += 1
+        raise BackendError("all LLM backends failed: " + " / ".join(errors))
+
+    async def speculate(self, messages: List[dict], session_id: Optional[str] = None,
+                        num_predict: Optional[int] = None) -> LLMReply:
+        """
+        先読み用の問い合わせ。セッションの第1候補にだけ送り、フェイルオーバーもブレーカーの記録もしない
+        （捨てるかもしれない返答の遅さや失敗で、会話の経路を open にしない）
+        """
+        candidates = self.candidates(session_id)
+        if not candidates:
+            raise BackendError("all LLM circuits are open")
+        self.stats["speculative"] += 1
+        return await candidates[0].chat(messages, session_id=session_id, num_predict=num_predict,
+                                        purpose="speculative")
+
+    async def check(self, backend: LLMBackend):
+        """closed のバックエンドのヘルスチェック（落ちていればすぐ open にする）"""
+        try:
+            await backend.health()
+        except Exception as e:
+            backend.last_error = str(e)
+            if backend.healthy:
+                backend.breaker.trip(f"health check: {e}")
+
+    async def probe(self, backend: LLMBackend):
+        """open のバックエンドに試しの問い合わせを1つだけ送る（half_open）"""
+        breaker = backend.breaker
+        breaker.begin_probe()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(backend.chat(self.PROBE_MESSAGES, num_predict=1), timeout=breaker.slow_call)
+        except (BackendError, asyncio.TimeoutError) as e:
+            backend.last_error = str(e) or "probe timed out"
+            breaker.end_probe(False, f"probe: {backend.last_error}")
+            return
+        breaker.end_probe(True)
+        backend.last_error = ""
+        print(f"  - {backend.name}: 復帰 ({time.monotonic() - started:.1f}s)")
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check(b) for b in self.backends if b.healthy))
+
+    async def _probe_loop(self, tick: float = 1.0):
+        last_check = 0.0
+        while True:
+            if time.monotonic() - last_check >= self.probe_interval:
+                last_check = time.monotonic()
+                await self.check_all()
+            due = [b for b in self.backends if b.breaker.probe_due()]
+            if due:
+                await asyncio.gather(*(self.probe(b) for b in due))
+            await asyncio.sleep(tick)
+
+    def start(self):
+        """定期ヘルスチェックと half_open の試しを始める（イベントループ上で呼ぶ）"""
+        if self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+        for b in self.backends:
+            await b.close()
+
+    @property
+    def available(self) -> bool:
+        return any(b.healthy for b in self.backends)
+
+    def status(self) -> dict:
+        return {"backends": [b.status() for b in self.backends], **self.stats}
+
+
+def parse_backends(spec: str, model: str, keep_alive: str, gemini_api_key: str = "",
+                   llamacpp_slots: int = 4, timeout: float = 60.0) -> List[LLMBackend]:
+    """LLM_BACKENDS の文字列からバックエンドを作る（例: "ollama=http://localhost:11434@2,mock"）"""
+    backends = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        weight = 1.0
+        head, sep, tail = item.rpartition("@")
+        if sep:
+            try:
+                weight = float(tail)
+                item = head
+            except ValueError:
+                pass  # URL の一部だった
+        kind, _, target = item.partition("=")
+        kind = kind.strip().lower()
+        if kind == "ollama":
+            backends.append(OllamaBackend(target or "http://localhost:11434", weight, model, keep_alive, timeout))
+        elif kind == "llamacpp":
+            backends.append(LlamaCppBackend(target or "http://localhost:8080", weight, llamacpp_slots, timeout))
+        elif kind == "gemini":
+            backends.append(GeminiBackend(target or "gemini-1.5-flash", weight, gemini_api_key))
+        elif kind == "mock":
+            backends.append(MockBackend(target or "default", weight))
+        else:
+            raise ValueError(f"unknown LLM backend: {item}")
+    return backends
@@ -1,35 +1,96 @@
 # src/main.py
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, List
+from fastapi.responses import JSONResponse, PlainTextResponse
+from typing import Optional, List, Tuple
+from contextlib import asynccontextmanager
 import socketio
+import asyncio
+import json
 import random
+import re
+import secrets
+import threading
 import time
 import os
 from datetime import datetime
 from collections import defaultdict
 from dotenv import load_dotenv
 
+from prompts import describe_visual_scene, build_amadeus_system_prompt, build_greeting_prompt
+from llm_backends import LLMRouter, BackendError, parse_backends
+from repetition import RepetitionGuard
+from models import FacePosition, NaoData, NaoHeartbeat, NaoScene
+from diagnostics import SamplingProfiler, LoopLagMonitor
+from transcript_store import TranscriptStore
+from proactive import ProactiveEngine
+
 # 環境変数を読み込み
 load_dotenv()
 
+# orjson があれば NAO 向けの応答はそれで返す（標準の json より速い）
+try:
+    import orjson
+
+    class NaoResponse(JSONResponse):
+        def render(self, content) -> bytes:
+            return orjson.dumps(content)
+except ImportError:
+    NaoResponse = JSONResponse
+
+# msgpack があれば、ダッシュボード向けに msgpack の Socket.IO も用意する
+try:
+    import msgpack  # noqa: F401
+    msgpack_available = True
+except ImportError:
+    msgpack_available = False
+
 # ==========================================
 # ★設定エリア
 # ==========================================
 # OllamaのモデルNAME（ローカルで動くモデル）
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "gemma3:4b")
+# モデルをメモリに載せておく時間（アンロードされるとKVキャッシュも消える）
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# 推論サーバー（種類=接続先@重み をカンマ区切り。詳しくは llm_backends.py）
+LLM_BACKENDS = os.getenv("LLM_BACKENDS", "ollama=" + os.getenv("OLLAMA_HOST", "http://localhost:11434"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLAMACPP_SLOTS = int(os.getenv("LLAMACPP_SLOTS", "4"))  # llama-server の --parallel と同じにする
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
+# サーキットブレーカー（落ちた・固まった推論サーバーを待たずに辞書の返事へ切り替える）
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "3"))  # 連続でこの回数失敗したら open
+BREAKER_SLOW_CALL = float(os.getenv("BREAKER_SLOW_CALL", "15"))  # これより遅い返答が続いても open（秒）
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "10"))  # open から試しを送るまで（失敗するたび倍）
+
+# 会話プロンプトの固定（セッションごとに追記のみのプロンプトを持ち、KVキャッシュを再利用させる）
+PIN_MAX_MESSAGES = 24  # これを超えたら直近だけ残して作り直す（num_ctx に収めるため）
+PIN_CARRY_MESSAGES = 4  # 作り直すときに引き継ぐ直近のやり取り
+
+# 応答の先読み（NAOが話している間に、次に言われそうな語への返事を作っておく）
+SPECULATION_TOP_K = int(os.getenv("SPECULATION_TOP_K", "3"))  # 0 で無効
+SPEECH_STATS_PATH = os.getenv("SPEECH_STATS_PATH", "speech_stats.json")  # 発話頻度の記録
+
+# こちらからの話しかけ（/api/nao/scene）
+PROACTIVE_MIN_INTERVAL = float(os.getenv("PROACTIVE_MIN_INTERVAL", "20"))  # セッションごとの最短間隔（秒）
+PROACTIVE_SILENCE = float(os.getenv("PROACTIVE_SILENCE", "8"))  # これだけ沈黙したら話しかける（NAO の会話タイムアウトより短く）
+
+# 会話ログの保存先（SQLite）。空なら保存しない
+TRANSCRIPT_DB = os.getenv("TRANSCRIPT_DB", "transcripts.sqlite3")
+SESSION_TIMEOUT = 300  # これだけ話しかけられなければセッションを閉じる（再起動時もこの範囲を読み戻す）
+
+# 本番での診断（/api/debug/*）。トークンが空ならエンドポイントごと無効
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+PROFILE_MAX_SECONDS = 60
 
 # ==========================================
-# Ollama セットアップ
+# LLM セットアップ
 # ==========================================
-ollama_available = False
-try:
-    import ollama
-    ollama_available = True
-    print(f"★Ollama Mode: ON (Model: {OLLAMA_MODEL})")
-except ImportError:
-    print("★ollama library not found. Using dictionary fallback.")
+llm = LLMRouter(parse_backends(LLM_BACKENDS, OLLAMA_MODEL, OLLAMA_KEEP_ALIVE,
+                               gemini_api_key=GEMINI_API_KEY, llamacpp_slots=LLAMACPP_SLOTS,
+                               timeout=LLM_TIMEOUT),
+                failure_threshold=BREAKER_FAILURES, slow_call=BREAKER_SLOW_CALL,
+                cooldown=BREAKER_COOLDOWN)
+print(f"★LLM Backends: {', '.join(b.name for b in llm.backends)} (Model: {OLLAMA_MODEL})")
 
 # ==========================================
 # 会話履歴管理（複数人対応）
@@ -37,8 +98,10 @@ except ImportError:
 class ConversationManager:
     """複数人との会話履歴を管理するクラス"""
     
-    def __init__(self, max_history: int = 10):
+    def __init__(self, max_history: int = 10, store: Optional[TranscriptStore] = None):
         self.max_history = max_history
+        # 会話ログの保存先（キューに積むだけで、書き込みは後でまとめて行う）
+        self.store = store
         # セッション別の会話履歴 {session_id: [messages]}
         self.conversations = defaultdict(list)
         # 最後のアクティビティ時刻
@@ -47,15 +110,23 @@ class ConversationManager:
         self.people_count_history = []
         # 現在の視覚情報
         self.current_visual_context = ""
+        # セッション別の文脈語彙（NAOに最後に送ったもの）
+        self.session_vocabulary = {}
+        # セッション別の固定プロンプト {session_id: {"messages", "face_count", "visual_context"}}
+        self.pinned_contexts = {}
+        self.pin_stats = {"reused": 0, "pinned": 0}
     
-    def add_message(self, session_id: str, role: str, content: str):
-        """会話履歴にメッセージを追加"""
-        self.conversations[session_id].append({
+    def add_message(self, session_id: str, role: str, content: str, source: str = ""):
+        """会話履歴にメッセージを追加（source は assistant の発話の出どころ。会話ログにだけ残す）"""
+        message = {
             "role": role,
             "content": content,
             "timestamp": datetime.now().isoformat()
-        })
+        }
+        self.conversations[session_id].append(message)
         self.last_activity[session_id] = time.time()
+        if self.store is not None:
+            self.store.append(session_id, role, content, message["timestamp"], source)
         
         # 履歴が長すぎる場合は古いものを削除
         if len(self.conversations[session_id]) > self.max_history * 2:
@@ -73,23 +144,129 @@ class ConversationManager:
         """現在の視覚情報を取得"""
         return self.current_visual_context
     
-    def cleanup_old_sessions(self, timeout: float = 300):
-        """古いセッションを削除（5分でタイムアウト）"""
+    def restore(self, restored: dict):
+        """保存してあった会話を読み戻す（再起動直後。固定プロンプトは次の発話のときに作り直される）"""
+        now = time.time()
+        for sid, messages in restored.items():
+            self.conversations[sid] = messages
+            self.last_activity[sid] = now
+
+    def cleanup_old_sessions(self, timeout: float = SESSION_TIMEOUT) -> List[str]:
+        """古いセッションを削除（5分でタイムアウト）。削除したセッションIDを返す"""
         current_time = time.time()
         expired = [sid for sid, last in self.last_activity.items() 
                    if current_time - last > timeout]
         for sid in expired:
             del self.conversations[sid]
             del self.last_activity[sid]
+            self.session_vocabulary.pop(sid, None)
+            self.pinned_contexts.pop(sid, None)
+        return expired
+
+    def update_vocabulary(self, session_id: str, words: List[str]) -> Optional[List[str]]:
+        """文脈語彙を更新し、前回から変わったときだけ返す（変化なしは None）"""
+        if self.session_vocabulary.get(session_id) == words:
+            return None
+        self.session_vocabulary[session_id] = words
+        return words
+
+    def get_pinned_context(self, session_id: str, face_count: int, visual_context: str) -> dict:
+        """
+        会話用の固定プロンプトを返す。
+        システムプロンプトは固定した時点のまま変えず、以降はやり取りを末尾に足すだけにする。
+        前回と先頭が同じプロンプトなら、推論サーバーは新しいターンの分だけ評価すればよい。
+        人数が変わったとき（グループ/個人の切り替え）と、長くなりすぎたときだけ作り直す。
+        """
+        pin = self.pinned_contexts.get(session_id)
+        if pin is not None and pin["face_count"] == face_count and len(pin["messages"]) <= PIN_MAX_MESSAGES:
+            self.pin_stats["reused"] += 1
+            return pin
+
+        if pin is not None:
+            carry = pin["messages"][1:][-PIN_CARRY_MESSAGES:]
+        else:
+            carry = [{"role": m["role"], "content": m["content"]}
+                     for m in self.conversations[session_id][-PIN_CARRY_MESSAGES:]]
+        # 先頭は user から始める
+        while carry and carry[0]["role"] != "user":
+            carry.pop(0)
+        pin = {
+            "messages": [{"role": "system", "content": build_amadeus_system_prompt(face_count, visual_context)}] + carry,
+            "face_count": face_count,
+            "visual_context": visual_context,
+        }
+        self.pinned_contexts[session_id] = pin
+        self.pin_stats["pinned"] += 1
+        return pin
 
 # グローバルな会話マネージャー
-conversation_manager = ConversationManager()
+transcript_store = TranscriptStore(TRANSCRIPT_DB) if TRANSCRIPT_DB else None
+conversation_manager = ConversationManager(store=transcript_store)
+
+
+# ==========================================
+# ロボット監視（フリート対応）
+# ==========================================
+class RobotMonitor:
+    """各ロボットのハートビート（ループ周期・応答遅延）を保持するクラス"""
+
+    def __init__(self, stale_after: float = 15.0):
+        self.stale_after = stale_after
+        # {robot_id: 最新のハートビート}
+        self.robots = {}
+
+    def update(self, robot_id: str, beat: dict):
+        """ハートビートを記録"""
+        beat["received_at"] = time.time()
+        self.robots[robot_id] = beat
+
+    def snapshot(self) -> dict:
+        """監視情報を取得（最終受信からの経過秒と生死判定付き）"""
+        now = time.time()
+        result = {}
+        for robot_id, beat in self.robots.items():
+            age = now - beat["received_at"]
+            info = {k: v for k, v in beat.items() if k != "received_at"}
+            info["age"] = round(age, 1)
+            info["alive"] = age <= self.stale_after
+            result[robot_id] = info
+        return result
+
+robot_monitor = RobotMonitor()
 
 
 # ==========================================
 # サーバー設定
 # ==========================================
-fastapi_app = FastAPI()
+# イベントループの遅れ（/api/debug/loop-lag）
+loop_lag = LoopLagMonitor()
+loop_thread_id = None
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global loop_thread_id
+    # 起動時に一度ヘルスチェックしてから定期チェックを始める
+    await llm.check_all()
+    for b in llm.backends:
+        print(f"  - {b.name}: {'OK' if b.healthy else 'NG ' + b.last_error}")
+    llm.start()
+    loop_thread_id = threading.get_ident()
+    loop_lag.start()
+    if transcript_store is not None:
+        # 再デプロイ前に話していたセッションを続けられるように読み戻す
+        restored = transcript_store.restore(SESSION_TIMEOUT, conversation_manager.max_history * 2)
+        conversation_manager.restore(restored)
+        if restored:
+            print(f"★Restored Sessions: {', '.join(restored)}")
+        transcript_store.start()
+    yield
+    loop_lag.stop()
+    await llm.close()
+    await speech_model.close()
+    if transcript_store is not None:
+        await transcript_store.close()
+
+fastapi_app = FastAPI(lifespan=lifespan)
 
 # CORS（ブラウザからの接続許可）
 fastapi_app.add_middleware(
@@ -100,99 +277,183 @@ fastapi_app.add_middleware(
     allow_headers=["*"],
 )
 
-# Socket.IOサーバー
+# Socket.IOサーバー（JSON と、使えれば msgpack の2つ。クライアントは /api/socket/config で選ぶ）
+SOCKETIO_MSGPACK_PATH = "socket.io-msgpack"
 sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
 app = socketio.ASGIApp(sio, fastapi_app)
+socket_servers = [sio]
+if msgpack_available:
+    sio_msgpack = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*', serializer='msgpack')
+    app = socketio.ASGIApp(sio_msgpack, app, socketio_path=SOCKETIO_MSGPACK_PATH)
+    socket_servers.append(sio_msgpack)
 
-# データモデル
-class NaoData(BaseModel):
-    message: str
-    target_value: Optional[int] = None
-    # 複数人対応用の追加フィールド
-    face_count: Optional[int] = 1  # 検出された顔の数
-    face_positions: Optional[List[dict]] = None  # 顔の位置情報 [{x, y, size}]
-    session_id: Optional[str] = "default"  # セッション識別子
-    user_speech: Optional[str] = None  # ユーザーの発話（音声認識結果）
+async def broadcast(event: str, data: dict):
+    """全てのダッシュボードへ通知（JSON と msgpack の両方の接続へ）"""
+    await asyncio.gather(*(server.emit(event, data) for server in socket_servers))
+
+async def notify_breaker(status: dict):
+    """ブレーカーの状態が変わったらダッシュボードへ通知"""
+    await broadcast('llm_breaker', status)
+
+llm.listener = notify_breaker
+
+def resolve_session_id(data: NaoData) -> str:
+    """ロボットIDがあればそれでセッションを振り分ける"""
+    return data.robot_id or data.session_id or "default"
 
 # ==========================================
-# 視覚情報を言語化するヘルパー
+# 発話の分割
 # ==========================================
-def describe_visual_scene(face_count: int, face_positions: list = None) -> str:
-    """Naoが見ている情報を自然言語で表現"""
-    if face_count == 0:
-        return "（周囲を見回しているが、誰もいないようだ）"
-    elif face_count == 1:
-        pos_desc = ""
-        if face_positions and len(face_positions) > 0:
-            pos = face_positions[0]
-            x = pos.get('x', 0)
-            if x < -0.2:
-                pos_desc = "左の方に"
-            elif x > 0.2:
-                pos_desc = "右の方に"
-            else:
-                pos_desc = "正面に"
-        return f"（{pos_desc}1人の人物がこちらを見ている）"
-    else:
-        pos_desc = f"{face_count}人"
-        if face_positions:
-            positions = []
-            for i, pos in enumerate(face_positions):
-                x = pos.get('x', 0)
-                if x < -0.2:
-                    positions.append("左")
-                elif x > 0.2:
-                    positions.append("右")
-                else:
-                    positions.append("正面")
-            unique_pos = list(set(positions))
-            if len(unique_pos) > 1:
-                pos_desc += f"（{'と'.join(unique_pos)}に分散）"
-        return f"（{pos_desc}の人々がこちらを見ている。グループでの会話だ）"
+def split_speech_chunks(text: str) -> List[str]:
+    """発話用に文単位で区切る（NAO側の発話キューに1文ずつ積めるように）"""
+    chunks = []
+    current = ""
+    for ch in text:
+        current += ch
+        if ch in "。！？!?":
+            chunks.append(current)
+            current = ""
+    if current.strip():
+        chunks.append(current)
+    return [c.strip() for c in chunks if c.strip()]
+
+# ==========================================
+# 音声認識語彙（NAOの ASR 用）
+# ==========================================
+# NAO側が常に持っている基本語彙。ここに無い語だけを文脈語彙として送る
+BASE_VOCABULARY = [
+    "こんにちは", "こんばんは", "おはよう",
+    "ありがとう", "はい", "いいえ",
+    "さようなら", "またね", "バイバイ",
+    "アマデウス", "紅莉栖", "クリスティーナ",
+    "元気", "質問", "教えて", "聞きたい",
+    "面白い", "すごい", "なるほど"
+]
+MAX_CONTEXT_WORDS = 8  # ASR の再設定コストを抑えるため文脈語彙は少なく
+
+# 問いかけへの返事として追加する語
+ANSWER_WORDS = ["わからない", "そうだね", "ちがう"]
+# 話題語として拾ってよい語（辞書のセリフ・キャラクター設定に出てくる語）。
+# 文字種だけで切り出すと「計算合ってる」から「計算合」のような語でない断片が ASR に入るので、ここにある語に限る
+TOPIC_VOCABULARY = frozenset([
+    "タイムマシン", "タイムリープ", "タイムトラベル", "ラボ", "ラボメン", "ティーナ", "ドクペ",
+    "ツンデレ", "ロボット", "プリン", "データ", "サイエンス",
+    "実験", "実験台", "被験者", "仮説", "論理", "理論", "根拠", "計算", "科学", "研究", "論文", "学会",
+    "観測", "観測者", "事象", "確率", "世界線", "因果律", "相対性理論", "物理", "数学", "量子", "宇宙",
+    "脳科学", "神経科学", "前頭葉", "記憶", "意識", "感情", "天才", "助手", "陰謀", "未来", "過去", "時間",
+])
+# カタカナ・漢字の切れ目のない並び全体を候補にする（語の途中で切らない）
+KEYWORD_PATTERN = re.compile(r"[ァ-ヴー]+|[一-龥々]+")
+
+def derive_context_vocabulary(text: str) -> List[str]:
+    """アマデウスの発話から、相手が次に言いそうな語を抜き出す（TOPIC_VOCABULARY にある語だけ）"""
+    words = []
+    if text.rstrip().endswith(("？", "?", "かしら", "の")):
+        words.extend(ANSWER_WORDS)
+    for w in KEYWORD_PATTERN.findall(text):
+        if w in TOPIC_VOCABULARY and w not in BASE_VOCABULARY and w not in words:
+            words.append(w)
+    return sorted(words[:MAX_CONTEXT_WORDS])
+
+def vocabulary_update(session_id: str, text: str, force: bool = False) -> Optional[List[str]]:
+    """セッションの文脈語彙が変わったときだけ NAO へ返す語彙を作る（force なら必ず返す）"""
+    if force:
+        conversation_manager.session_vocabulary.pop(session_id, None)
+    return conversation_manager.update_vocabulary(session_id, derive_context_vocabulary(text))
 
 # ==========================================
 # 思考エンジン (Amadeus Logic)
 # ==========================================
-def build_amadeus_system_prompt(face_count: int = 1, visual_context: str = "") -> str:
-    """状況に応じたシステムプロンプトを生成"""
-    
-    base_prompt = """あなたは『Steins;Gate』の牧瀬紅莉栖（通称：クリスティーナ、助手）のAI『アマデウス』です。
-    
-【キャラクター設定】
-- 天才神経科学者。ヴィクトル・コンドリア大学の研究員。
-- IQ170以上の天才だが、感情的になりやすい一面も。
-- 語尾は「～わね」「～かしら」「～よ」「～わ」等の女性言葉。
-- ツンデレ気味。科学的・論理的な発言を好む。
-- @ちゃんねらーで、ネットスラングも理解している。
-- 「クリスティーナ」「助手」と呼ばれると怒る（「ティーナって言うな！」）。
-
-【現在の状況】
-あなたはNAOロボットの中で動作しており、カメラを通じて人を見ることができます。
-"""
-    
-    if face_count == 0:
-        situation = "今は誰もいないようです。待機中です。"
-    elif face_count == 1:
-        situation = "1人の人物があなたの前にいます。個人的な対話をしてください。"
-    else:
-        situation = f"{face_count}人のグループがあなたの前にいます。全員に話しかけるように、グループ向けの対話をしてください。"
-    
-    visual_info = visual_context if visual_context else describe_visual_scene(face_count)
-    
-    return base_prompt + f"""
-{visual_info}
-{situation}
+# 直近に言ったセリフ（「毎回違うセリフ」を守る）
+repetition_guard = RepetitionGuard()
 
-【制約】
-- 50文字以内の自然な話し言葉（ロボットの発話用）。
-- 毎回違うセリフを生成すること。鉤括弧「」は不要。
-- 相手の人数に合わせた呼びかけをすること。
-"""
+def dictionary_lines(face_count: int, greeting: bool = False) -> List[str]:
+    """LLM が使えないとき・返事が既出のときに使う辞書のセリフ"""
+    if greeting:
+        if face_count >= 2:
+            return [
+                "あら、賑やかね。みんなで何の用？",
+                "ふーん、グループで来たの。面白そうね。",
+                "複数人？実験の被験者が増えたのかしら。",
+                "何、集団で来て。私を囲む気？",
+            ]
+        return [
+            "……あら、誰かと思えば。何か用？",
+            "ふーん、また来たの。今日は何の話？",
+            "あなたね。待ってたわけじゃないけど。",
+            "珍しい。私に会いに来たの？",
+            "観測者が現れたわね。今日の実験は？",
+        ]
+    if face_count >= 2:
+        return [
+            "あら、今日は賑やかね。実験台が増えたのかしら。",
+            f"ふーん、{face_count}人もいるのね。何か用？",
+            "グループで来るなんて珍しいわね。学会発表でもするの？",
+            "みんな揃って…何か陰謀でも企んでるのかしら？",
+            "複数人で来ても、私の論理は変わらないわよ。",
+        ]
+    return [
+        "……あら、また来たの？暇人ね。",
+        "私の仮説が正しければ、あなたは今そこにいるはずよ。",
+        "ティーナって言うな！",
+        "ふん、別に待ってたわけじゃないから。",
+        "非論理的ね。",
+        "ねえ、今の計算合ってる？",
+        "エル・プサイ・コングルゥ……なんてね。",
+        "前頭葉が活発ね。何か悩みでも？",
+        "観測者がいないと事象は確定しないわ。",
+        "あなた、実験台になりたいの？"
+    ]
 
-def generate_amadeus_response(
+def choose_fresh_line(session_id: str, first: Optional[str], face_count: int, greeting: bool = False) -> str:
+    """
+    最近言っていないセリフを選ぶ。first（LLM の返事）が既出なら辞書のセリフに差し替える。
+    生成し直しはしないので、待ち時間は増えない。
+    """
+    lines = dictionary_lines(face_count, greeting)
+    random.shuffle(lines)
+    return repetition_guard.pick(session_id, ([first] if first else []) + lines)
+
+def prepare_conversation_turn(session_id: str, face_count: int, visual_context: str,
+                              user_input: Optional[str]) -> Tuple[dict, dict]:
+    """固定プロンプトと、その末尾に足す今回の user メッセージを作る（やり取りはまだ追記しない）"""
+    pin = conversation_manager.get_pinned_context(session_id, face_count, visual_context)
+    if user_input:
+        # 人数が同じまま位置だけ変わった場合は、システムプロンプトを変えずに状況を添える
+        if visual_context != pin["visual_context"]:
+            return pin, {'role': 'user', 'content': f"[状況: {visual_context}] {user_input}"}
+        return pin, {'role': 'user', 'content': user_input}
+    # 入力がない場合は状況説明をユーザーメッセージとして追加
+    return pin, {'role': 'user', 'content': f"[状況: {visual_context}] 何か一言話しかけて。"}
+
+def clean_reply(text: str) -> str:
+    """発話に向かない改行とカギ括弧を取る"""
+    return text.strip().replace("\n", "").replace("「", "").replace("」", "")
+
+async def llm_conversation_reply(messages: List[dict], session_id: str,
+                                 purpose: str = "dialog") -> Tuple[str, Optional[int]]:
+    """LLM で返答を作る（返答と、評価したプロンプトのトークン数）"""
+    reply = await llm.chat(messages, session_id=session_id, purpose=purpose)
+    text = clean_reply(reply.text)
+    if not text:
+        raise BackendError(f"{reply.backend}: empty reply")
+    return text, reply.prompt_tokens
+
+def reply_source(generated: str, text: str) -> str:
+    """発話の出どころ（LLM の返事がそのまま使われたか、既出だったので辞書のセリフに差し替えたか）"""
+    return "llm" if text == generated else "dictionary"
+
+def commit_conversation_turn(session_id: str, pin: dict, user_msg: dict, text: str, visual_context: str,
+                             source: str):
+    """返答が確定したら固定プロンプトと履歴に追記する"""
+    pin["messages"].extend([user_msg, {'role': 'assistant', 'content': text}])
+    pin["visual_context"] = visual_context
+    conversation_manager.add_message(session_id, 'assistant', text, source)
+
+async def generate_amadeus_response(
     user_input: str = None,
     face_count: int = 1,
-    face_positions: list = None,
+    face_positions: Optional[List[FacePosition]] = None,
     session_id: str = "default",
     is_greeting: bool = False
 ) -> str:
@@ -204,132 +465,249 @@ def generate_amadeus_response(
     
     # 挨拶モードの場合は特別なプロンプト
     if is_greeting or (user_input and "初めまして" in user_input):
-        if face_count >= 2:
-            greeting_prompt = """あなたは牧瀬紅莉栖のAI『アマデウス』です。
-今、複数の人があなたの前に現れました。グループに向けて挨拶をしてください。
-
-【制約】
-- 40文字以内の挨拶。
-- 明るく、少しツンデレ気味に。
-- 例: 「あら、賑やかね。みんなで何の用？」「ふーん、グループで来たの。面白い実験でもするのかしら。」
-"""
-        else:
-            greeting_prompt = """あなたは牧瀬紅莉栖のAI『アマデウス』です。
-今、1人の人があなたの前に現れました。挨拶をしてください。
-
-【制約】
-- 40文字以内の挨拶。
-- 少しツンデレ気味に、でも好奇心を持って。
-- 例: 「……あら、誰かと思えば。何か用？」「ふーん、また来たの。今日は何の話？」
-"""
+        greeting_prompt = build_greeting_prompt(face_count)
         
-        if ollama_available:
-            try:
-                response = ollama.chat(model=OLLAMA_MODEL, messages=[
-                    {'role': 'system', 'content': greeting_prompt},
-                    {'role': 'user', 'content': visual_context}
-                ])
-                text = response['message']['content']
-                text = text.strip().replace("\n", "").replace("「", "").replace("」", "")
-                conversation_manager.add_message(session_id, 'assistant', text)
-                return text
-            except Exception as e:
-                print(f"Ollama Error: {e}")
+        try:
+            generated, _ = await llm_conversation_reply([
+                {'role': 'system', 'content': greeting_prompt},
+                {'role': 'user', 'content': visual_context}
+            ], session_id)
+            text = choose_fresh_line(session_id, generated, face_count, greeting=True)
+            conversation_manager.add_message(session_id, 'assistant', text, reply_source(generated, text))
+            return text
+        except BackendError as e:
+            print(f"LLM Error: {e}")
         
         # 辞書による挨拶
-        if face_count >= 2:
-            greetings = [
-                "あら、賑やかね。みんなで何の用？",
-                "ふーん、グループで来たの。面白そうね。",
-                "複数人？実験の被験者が増えたのかしら。",
-                "何、集団で来て。私を囲む気？",
-            ]
-        else:
-            greetings = [
-                "……あら、誰かと思えば。何か用？",
-                "ふーん、また来たの。今日は何の話？",
-                "あなたね。待ってたわけじゃないけど。",
-                "珍しい。私に会いに来たの？",
-                "観測者が現れたわね。今日の実験は？",
-            ]
-        return random.choice(greetings)
+        return choose_fresh_line(session_id, None, face_count, greeting=True)
     
     # 通常の会話モード
-    # システムプロンプトを状況に応じて生成
-    system_prompt = build_amadeus_system_prompt(face_count, visual_context)
+    # セッションの固定プロンプト（システムプロンプト + これまでのやり取り）と今回の発話
+    pin, user_msg = prepare_conversation_turn(session_id, face_count, visual_context, user_input)
     
-    # 会話履歴を取得
-    history = conversation_manager.get_history(session_id)
-    
-    # Ollamaで生成
-    if ollama_available:
+    # LLMで生成
+    if user_input:
+        conversation_manager.add_message(session_id, 'user', user_input)
+    try:
+        # LLMに問い合わせ（固定プロンプトの末尾に今回の発話だけを足す）
+        generated, evaluated = await llm_conversation_reply(pin["messages"] + [user_msg], session_id)
+        # 実際に評価したプロンプトのトークン数（KVキャッシュが効いていれば今回の発話分だけ）
+        print(f"  - 評価トークン: {evaluated}（メッセージ {len(pin['messages']) + 1} 件）")
+        
+        text = choose_fresh_line(session_id, generated, face_count)
+        commit_conversation_turn(session_id, pin, user_msg, text, visual_context, reply_source(generated, text))
+        return text
+        
+    except BackendError as e:
+        print(f"LLM Error: {e}")
+        # どのバックエンドも使えないときは辞書にフォールバック
+
+    # LLMが使えない場合は「ランダム辞書」を使う（複数人対応）
+    return choose_fresh_line(session_id, None, face_count)
+
+# ==========================================
+# 応答の先読み（投機的生成）
+# ==========================================
+class SpeechFrequencyModel:
+    """
+    実際の会話から「直前のアマデウスの発話の種類 → 次にユーザーが言った語」を数える。
+    NAO は決まった語彙しか認識しないので、候補の中から次に来そうな語を順位付けできる。
+    """
+
+    def __init__(self, path: str, save_every: int = 10):
+        self.path = path
+        self.save_every = save_every
+        self.counts = defaultdict(lambda: defaultdict(int))  # {種類: {語: 回数}}
+        self.unsaved = 0
+        self._save_task: Optional[asyncio.Task] = None
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for kind, words in json.load(f).items():
+                        self.counts[kind].update(words)
+            except (OSError, ValueError) as e:
+                print(f"Speech stats load error: {e}")
+
+    @staticmethod
+    def kind(prev_text: str) -> str:
+        """直前の発話の種類（問いかけかどうかで次の語の傾向が大きく変わる）"""
+        t = (prev_text or "").rstrip("。！!…")
+        if not t:
+            return "none"
+        if t.endswith(("？", "?", "かしら", "の")):
+            return "question"
+        return "statement"
+
+    def observe(self, prev_text: str, word: str):
+        self.counts[self.kind(prev_text)][word] += 1
+        self.counts["all"][word] += 1
+        self.unsaved += 1
+        if self.unsaved >= self.save_every and (self._save_task is None or self._save_task.done()):
+            # ファイルへの書き込みはイベントループの外で（書いている間に増えた分は次の回にまとめる）
+            self._save_task = asyncio.create_task(self.save_async())
+
+    def rank(self, prev_text: str, candidates: List[str], k: int) -> List[str]:
+        """候補語を次に言われそうな順に k 個（同じ種類での回数 > 全体での回数 > 候補の並び順）"""
+        by_kind = self.counts.get(self.kind(prev_text), {})
+        overall = self.counts.get("all", {})
+        order = {w: i for i, w in enumerate(candidates)}
+        ranked = sorted(set(candidates), key=lambda w: (-by_kind.get(w, 0), -overall.get(w, 0), order[w]))
+        return ranked[:k]
+
+    def _write(self, data: str):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    async def save_async(self):
+        # 数え上げの途中を書かないよう、ループ上で文字列にしてから渡す
+        data = json.dumps(self.counts, ensure_ascii=False, indent=2)
+        saved = self.unsaved
         try:
-            # メッセージを構築
-            messages = [{'role': 'system', 'content': system_prompt}]
-            
-            # 履歴を追加（最新5件）
-            for msg in history[-5:]:
-                messages.append({
-                    'role': msg['role'],
-                    'content': msg['content']
-                })
-            
-            # ユーザー入力があれば追加
-            if user_input:
-                messages.append({'role': 'user', 'content': user_input})
-                conversation_manager.add_message(session_id, 'user', user_input)
-            else:
-                # 入力がない場合は状況説明をユーザーメッセージとして追加
-                context_msg = f"[状況: {visual_context}] 何か一言話しかけて。"
-                messages.append({'role': 'user', 'content': context_msg})
-            
-            # Ollamaに問い合わせ
-            response = ollama.chat(model=OLLAMA_MODEL, messages=messages)
-            text = response['message']['content']
-            text = text.strip().replace("\n", "").replace("「", "").replace("」", "")
-            
-            # 応答を履歴に追加
-            conversation_manager.add_message(session_id, 'assistant', text)
-            
-            return text
-            
+            await asyncio.to_thread(self._write, data)
+            self.unsaved -= saved
+        except OSError as e:
+            print(f"Speech stats save error: {e}")
+
+    async def close(self):
+        """終了時に残りを書き出す"""
+        if self._save_task is not None:
+            await asyncio.gather(self._save_task, return_exceptions=True)
+        if self.unsaved:
+            await self.save_async()
+
+class Speculator:
+    """
+    NAO が話している間に、次に言われそうな語への返答を先に作っておく。
+    返答はセッションの固定プロンプトに対して作るので、そのセッション専用の返事になる。
+    先読みは取り消し可能なタスクとして持ち、セッションの状態が変わったら捨てる。
+    """
+
+    def __init__(self, top_k: int, concurrency: int = 1):
+        self.top_k = top_k
+        # 先読み同士で推論サーバーを奪い合わないよう、同時に走らせる数を絞る
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # {session_id: {"pin", "length", "face_count", "visual_context", "tasks": {語: Task}}}
+        self.sessions = {}
+        self.stats = {"started": 0, "hits": 0, "misses": 0, "dropped": 0}
+
+    async def _generate(self, session_id: str, messages: List[dict]) -> str:
+        async with self.semaphore:
+            # 取り消されると HTTP 接続ごと切れるので、推論サーバー側の生成も止まる
+            # 会話とは別の入口から送る（ブレーカーに数えず、セッションのスロットも使わない）
+            reply = await llm.speculate(messages, session_id=session_id)
+        text = clean_reply(reply.text)
+        if not text:
+            raise BackendError(f"{reply.backend}: empty reply")
+        return text
+
+    def drop(self, session_id: str):
+        """セッションの先読みを全て取り消す"""
+        entry = self.sessions.pop(session_id, None)
+        if entry is None:
+            return
+        for task in entry["tasks"].values():
+            if not task.done():
+                task.cancel()
+                self.stats["dropped"] += 1
+
+    def schedule(self, session_id: str, face_count: int, visual_context: str, last_text: str):
+        """今のセッション状態に対して、上位 top_k 語への返答を作り始める"""
+        self.drop(session_id)
+        if not llm.available or self.top_k <= 0:
+            return
+        candidates = BASE_VOCABULARY + conversation_manager.session_vocabulary.get(session_id, [])
+        words = speech_model.rank(last_text, candidates, self.top_k)
+        pin = conversation_manager.get_pinned_context(session_id, face_count, visual_context)
+        tasks = {}
+        for word in words:
+            messages = pin["messages"] + [{'role': 'user', 'content': word}]
+            tasks[word] = asyncio.create_task(self._generate(session_id, messages))
+        self.sessions[session_id] = {
+            "pin": pin,
+            "length": len(pin["messages"]),
+            "face_count": face_count,
+            "visual_context": visual_context,
+            "tasks": tasks,
+        }
+        self.stats["started"] += len(tasks)
+
+    async def claim(self, session_id: str, word: str, face_count: int, visual_context: str) -> Optional[str]:
+        """
+        実際の発話が先読みと一致すれば、その返答を確定して返す（無ければ None）。
+        どちらにしても、このセッションの他の先読みはここで捨てる。
+        """
+        entry = self.sessions.get(session_id)
+        task = entry["tasks"].pop(word, None) if entry else None
+        self.drop(session_id)
+        if task is None:
+            if entry is not None:
+                self.stats["misses"] += 1
+            return None
+
+        pin = conversation_manager.pinned_contexts.get(session_id)
+        if (pin is not entry["pin"] or len(pin["messages"]) != entry["length"]
+                or face_count != entry["face_count"] or visual_context != entry["visual_context"]):
+            # 先読みした後に状態が変わっていたら使えない
+            task.cancel()
+            self.stats["misses"] += 1
+            return None
+        try:
+            # まだ作っている途中なら、そのまま待つ（最初から作るより早い）
+            generated = await task
         except Exception as e:
-            print(f"Ollama Error: {e}")
-            # エラー時は辞書にフォールバック
+            print(f"Speculation Error: {e}")
+            self.stats["misses"] += 1
+            return None
 
-    # Ollamaが使えない場合は「ランダム辞書」を使う（複数人対応）
-    if face_count >= 2:
-        responses = [
-            "あら、今日は賑やかね。実験台が増えたのかしら。",
-            f"ふーん、{face_count}人もいるのね。何か用？",
-            "グループで来るなんて珍しいわね。学会発表でもするの？",
-            "みんな揃って…何か陰謀でも企んでるのかしら？",
-            "複数人で来ても、私の論理は変わらないわよ。",
-        ]
-    else:
-        responses = [
-            "……あら、また来たの？暇人ね。",
-            "私の仮説が正しければ、あなたは今そこにいるはずよ。",
-            "ティーナって言うな！",
-            "ふん、別に待ってたわけじゃないから。",
-            "非論理的ね。",
-            "ねえ、今の計算合ってる？",
-            "エル・プサイ・コングルゥ……なんてね。",
-            "前頭葉が活発ね。何か悩みでも？",
-            "観測者がいないと事象は確定しないわ。",
-            "あなた、実験台になりたいの？"
-        ]
-    return random.choice(responses)
+        self.stats["hits"] += 1
+        text = choose_fresh_line(session_id, generated, face_count)
+        conversation_manager.update_visual_context(visual_context)
+        conversation_manager.add_message(session_id, 'user', word)
+        commit_conversation_turn(session_id, pin, {'role': 'user', 'content': word}, text, visual_context,
+                                 reply_source(generated, text))
+        return text
+
+speech_model = SpeechFrequencyModel(SPEECH_STATS_PATH)
+speculator = Speculator(SPECULATION_TOP_K)
+
+# ==========================================
+# こちらからの話しかけ（場面の変化）
+# ==========================================
+PROACTIVE_PROMPTS = {
+    "joined": "新しく人が加わった。その人にも一言話しかけて。",
+    "left": "誰かが離れていった。残った人に一言。",
+    "split": "みんなが左右に分かれた。それについて一言。",
+    "silence": "しばらく誰も話していない。会話が続くように一言話しかけて。",
+}
+
+async def generate_proactive_remark(session_id: str, event: str, face_count: int,
+                                    face_positions: List[FacePosition]) -> dict:
+    """場面の変化に合わせた話しかけを作る（履歴への追記は渡すときに行う）"""
+    visual_context = describe_visual_scene(face_count, face_positions)
+    pin = conversation_manager.get_pinned_context(session_id, face_count, visual_context)
+    user_msg = {'role': 'user', 'content': f"[状況: {visual_context}] {PROACTIVE_PROMPTS[event]}"}
+    # 先読みと同じ枠を使い、会話への返答より推論サーバーを取り合わないようにする
+    async with speculator.semaphore:
+        text, _ = await llm_conversation_reply(pin["messages"] + [user_msg], session_id, purpose="proactive")
+    return {"text": text, "user_msg": user_msg, "face_count": face_count, "visual_context": visual_context}
+
+proactive = ProactiveEngine(generate_proactive_remark, silence_after=PROACTIVE_SILENCE,
+                            min_interval=PROACTIVE_MIN_INTERVAL)
 
 # ==========================================
 # APIエンドポイント
 # ==========================================
-@fastapi_app.post("/api/nao/trigger")
+@fastapi_app.post("/api/nao/trigger", response_class=NaoResponse)
 async def trigger_nao(data: NaoData):
     face_count = data.face_count or 1
     face_positions = data.face_positions or []
-    session_id = data.session_id or "default"
+    session_id = resolve_session_id(data)
     user_speech = data.user_speech
+    # 会話ログの書き込みが詰まっていたら待つ
+    if transcript_store is not None:
+        await transcript_store.backpressure()
     
     print(f"【受信】NAOから: {data.message}")
     print(f"  - 検出人数: {face_count}人")
@@ -337,11 +715,17 @@ async def trigger_nao(data: NaoData):
     if user_speech:
         print(f"  - ユーザー発話: {user_speech}")
     
-    # 古いセッションをクリーンアップ
-    conversation_manager.cleanup_old_sessions()
+    # 古いセッションをクリーンアップ（先読みも捨てる）
+    for expired in conversation_manager.cleanup_old_sessions():
+        speculator.drop(expired)
+        repetition_guard.drop(expired)
+        proactive.drop(expired)
+    # 会話の始まりなので、このセッションの先読みは使わない
+    speculator.drop(session_id)
+    proactive.note_activity(session_id)
     
     # AI思考（複数人対応）
-    ai_text = generate_amadeus_response(
+    ai_text = await generate_amadeus_response(
         user_input=user_speech,
         face_count=face_count,
         face_positions=face_positions,
@@ -350,7 +734,7 @@ async def trigger_nao(data: NaoData):
     print(f"【思考】Amadeus: {ai_text}")
 
     # フロントエンド(React)へ通知 -> 画面演出用
-    await sio.emit('nao_event', {
+    await broadcast('nao_event', {
         'message': data.message, 
         'text': ai_text,
         'face_count': face_count,
@@ -358,62 +742,232 @@ async def trigger_nao(data: NaoData):
     })
     
     # NAOへレスポンス -> 読み上げ用
-    return {
+    response = {
         "status": "ok",
         "action": "say",
         "text": ai_text,
+        "chunks": split_speech_chunks(ai_text),
         "face_count": face_count
     }
+    # 文脈語彙は変わったときだけ送る（NAO側の ASR 再設定を減らす）
+    # trigger は会話の始まりなので、NAO側と状態を揃えるため必ず送る
+    vocabulary = vocabulary_update(session_id, ai_text, force=True)
+    if vocabulary is not None:
+        response["vocabulary"] = vocabulary
+    # NAOが話している間に、次に言われそうな語への返答を作っておく
+    speculator.schedule(session_id, face_count, describe_visual_scene(face_count, face_positions), ai_text)
+    # 応答クラスを直接返して、FastAPI の汎用エンコーダ（jsonable_encoder）を通さない
+    return NaoResponse(response)
 
-@fastapi_app.post("/api/nao/chat")
+@fastapi_app.post("/api/nao/chat", response_class=NaoResponse)
 async def chat_with_nao(data: NaoData):
     """ユーザーからの音声入力に応答する（対話モード）"""
     face_count = data.face_count or 1
     face_positions = data.face_positions or []
-    session_id = data.session_id or "default"
+    session_id = resolve_session_id(data)
     user_speech = data.user_speech or data.message
+    if transcript_store is not None:
+        await transcript_store.backpressure()
     
     print(f"【対話】ユーザー: {user_speech}")
     print(f"  - 検出人数: {face_count}人")
+    # 話しかけられたので、こちらからの話しかけは取りやめる
+    proactive.note_activity(session_id)
     
-    # AI応答生成
-    ai_text = generate_amadeus_response(
-        user_input=user_speech,
-        face_count=face_count,
-        face_positions=face_positions,
-        session_id=session_id
-    )
+    # 直前のアマデウスの発話に対して何と言われたかを記録（先読みの順位付けに使う）
+    history = conversation_manager.get_history(session_id)
+    last_text = next((m["content"] for m in reversed(history) if m["role"] == "assistant"), "")
+    speech_model.observe(last_text, user_speech)
+    
+    # 先読みが当たっていればそれを使い、無ければ生成する
+    visual_context = describe_visual_scene(face_count, face_positions)
+    ai_text = await speculator.claim(session_id, user_speech, face_count, visual_context)
+    if ai_text is not None:
+        print("  - 先読みの返答を使用")
+    else:
+        ai_text = await generate_amadeus_response(
+            user_input=user_speech,
+            face_count=face_count,
+            face_positions=face_positions,
+            session_id=session_id
+        )
     print(f"【応答】Amadeus: {ai_text}")
     
     # フロントエンドへ通知
-    await sio.emit('nao_chat', {
+    await broadcast('nao_chat', {
         'user': user_speech,
         'assistant': ai_text,
         'face_count': face_count,
         'session_id': session_id
     })
     
-    return {
+    response = {
         "status": "ok",
         "action": "say",
-        "text": ai_text
+        "text": ai_text,
+        "chunks": split_speech_chunks(ai_text)
     }
+    vocabulary = vocabulary_update(session_id, ai_text)
+    if vocabulary is not None:
+        response["vocabulary"] = vocabulary
+    speculator.schedule(session_id, face_count, visual_context, ai_text)
+    return NaoResponse(response)
+
+async def commit_proactive_remark(session_id: str, event: str, prepared: dict):
+    """NAO が言い終えた話しかけを履歴に確定する"""
+    text = prepared["text"]
+    repetition_guard.pick(session_id, [text])
+    face_count, visual_context = prepared["face_count"], prepared["visual_context"]
+    pin = conversation_manager.get_pinned_context(session_id, face_count, visual_context)
+    conversation_manager.update_visual_context(visual_context)
+    commit_conversation_turn(session_id, pin, prepared["user_msg"], text, visual_context, "llm")
+    print(f"【話しかけ】({event}) Amadeus: {text}")
+
+    await broadcast('nao_event', {
+        'message': f"proactive:{event}",
+        'text': text,
+        'face_count': face_count,
+        'session_id': session_id
+    })
+    speculator.schedule(session_id, face_count, visual_context, text)
+
+@fastapi_app.post("/api/nao/scene", response_class=NaoResponse)
+async def nao_scene(data: NaoScene):
+    """
+    会話中の場面（人数・顔の位置）を受け取り、話しかけるべきときだけ返答を返す。
+    返した話しかけは、NAO が言い終えて spoke で知らせてきたときに履歴へ確定する
+    （知らせが来るまで次の話しかけは作らない）
+    """
+    session_id = data.robot_id or data.session_id or "default"
+    if data.spoke:
+        confirmed = proactive.confirm(session_id, data.spoke)
+        if confirmed is not None:
+            await commit_proactive_remark(session_id, *confirmed)
+    remark = await proactive.observe(session_id, data.face_count, data.face_positions or [], data.speaking)
+    if remark is None:
+        return NaoResponse({"status": "ok"})
+    event, prepared = remark
+    text = prepared["text"]
+    # 最近言ったことと同じなら、辞書で置き換えずに黙っておく（話しかけは必須ではない）
+    if repetition_guard.is_repeat(session_id, text):
+        print(f"【話しかけ】({event}) 最近言ったばかりなので見送り: {text}")
+        return NaoResponse({"status": "ok"})
+    remark_id = proactive.sent(session_id, event, prepared)
+    print(f"【話しかけ】({event}) 送信 #{remark_id}: {text}")
+
+    response = {
+        "status": "ok",
+        "action": "say",
+        "text": text,
+        "chunks": split_speech_chunks(text),
+        "event": event,
+        "remark_id": remark_id
+    }
+    vocabulary = vocabulary_update(session_id, text)
+    if vocabulary is not None:
+        response["vocabulary"] = vocabulary
+    return NaoResponse(response)
+
+@fastapi_app.post("/api/nao/heartbeat", response_class=NaoResponse)
+async def nao_heartbeat(data: NaoHeartbeat):
+    """ロボットからのハートビートを受け取る（ループ周期・応答遅延）"""
+    beat = data.model_dump()
+    robot_monitor.update(data.robot_id, beat)
+
+    # フロントエンドへ通知
+    await broadcast('nao_heartbeat', beat)
+
+    return NaoResponse({"status": "ok"})
 
 @fastapi_app.get("/api/status")
 async def get_status():
     """サーバー状態を取得"""
     return {
-        "ollama_available": ollama_available,
+        "llm_available": llm.available,
         "model": OLLAMA_MODEL,
+        "llm": llm.status(),
         "active_sessions": len(conversation_manager.conversations),
-        "visual_context": conversation_manager.get_visual_context()
+        "pinned_contexts": {
+            "sessions": len(conversation_manager.pinned_contexts),
+            **conversation_manager.pin_stats,
+        },
+        "speculation": {
+            "pending": sum(len(e["tasks"]) for e in speculator.sessions.values()),
+            **speculator.stats,
+        },
+        "repetition": repetition_guard.stats,
+        "proactive": proactive.stats,
+        "transcripts": {"pending": len(transcript_store.queue), **transcript_store.stats} if transcript_store else None,
+        "visual_context": conversation_manager.get_visual_context(),
+        "robots": robot_monitor.snapshot()
     }
 
+# ==========================================
+# デバッグ（本番での診断）
+# ==========================================
+profile_lock = asyncio.Lock()
+
+def require_debug_token(authorization: Optional[str] = Header(None),
+                        x_debug_token: Optional[str] = Header(None)):
+    """Authorization: Bearer <DEBUG_TOKEN> か X-Debug-Token ヘッダで認証する"""
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="debug endpoints are disabled")
+    token = x_debug_token
+    if authorization and authorization.startswith("Bearer "):
+        token = authorization[len("Bearer "):]
+    if not token or not secrets.compare_digest(token, DEBUG_TOKEN):
+        raise HTTPException(status_code=401, detail="invalid debug token")
+
+@fastapi_app.get("/api/debug/profile", dependencies=[Depends(require_debug_token)])
+async def debug_profile(seconds: float = 10, format: str = "collapsed", interval_ms: float = 10):
+    """
+    seconds 秒だけ全スレッド（イベントループ含む）をサンプリングして返す。
+    format=collapsed は flamegraph.pl / speedscope 用のテキスト、format=speedscope は speedscope の JSON。
+    サンプリングは別スレッドで行うので、その間もリクエストは普通に処理される。
+    """
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS}]")
+    if format not in ("collapsed", "speedscope"):
+        raise HTTPException(status_code=400, detail="format must be collapsed or speedscope")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be in [1, 1000]")
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="a profile is already running")
+
+    async with profile_lock:
+        profiler = SamplingProfiler(interval_ms / 1000, loop_thread_id)
+        print(f"【診断】プロファイル開始: {seconds}秒 ({interval_ms}ms 間隔)")
+        await asyncio.to_thread(profiler.run, seconds)
+        print(f"【診断】プロファイル終了: {profiler.samples} サンプル")
+
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    if format == "speedscope":
+        return JSONResponse(profiler.speedscope(f"amadeus backend {stamp}"), headers={
+            "Content-Disposition": f'attachment; filename="amadeus-{stamp}.speedscope.json"'})
+    return PlainTextResponse(profiler.collapsed(), headers={
+        "Content-Disposition": f'attachment; filename="amadeus-{stamp}.collapsed.txt"'})
+
+@fastapi_app.get("/api/debug/loop-lag", dependencies=[Depends(require_debug_token)])
+async def debug_loop_lag():
+    """イベントループの遅れのヒストグラム（起動から）と直近の分布"""
+    return loop_lag.snapshot()
+
+@fastapi_app.get("/api/socket/config")
+async def get_socket_config():
+    """ダッシュボードが使える Socket.IO の形式（msgpack があればそちらを使ってもらう）"""
+    config = {"serializers": ["json"]}
+    if msgpack_available:
+        config["serializers"].append("msgpack")
+        config["msgpack_path"] = f"/{SOCKETIO_MSGPACK_PATH}/"
+    return config
+
 # Socket.IO 接続ログ
-@sio.event
 async def connect(sid, environ):
     print(f"Client Connected: {sid}")
 
-@sio.event
 async def disconnect(sid):
-    print(f"Client Disconnected: {sid}")
\ No newline at end of file
+    print(f"Client Disconnected: {sid}")
+
+for server in socket_servers:
+    server.on('connect', connect)
+    server.on('disconnect', disconnect)
\ No newline at end of file
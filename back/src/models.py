@@ -0,0 +1,40 @@
+# src/models.py
+"""
+NAO とやり取りするリクエストのデータモデル。
+ベンチマーク（bench_serialization.py）からも使うので、サーバーの起動処理とは分けておく。
+"""
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class FacePosition(BaseModel):
+    x: float = 0.0  # 水平位置（alpha、左が負）
+    y: float = 0.0  # 垂直位置（beta）
+    size: float = 0.0  # 幅 × 高さ
+
+class NaoData(BaseModel):
+    message: str
+    target_value: Optional[int] = None
+    # 複数人対応用の追加フィールド
+    face_count: Optional[int] = 1  # 検出された顔の数
+    face_positions: Optional[List[FacePosition]] = None  # 顔の位置情報（リクエストの解析時にまとめて検証）
+    session_id: Optional[str] = "default"  # セッション識別子
+    robot_id: Optional[str] = None  # ロボットの固定ID（フリート運用時）
+    user_speech: Optional[str] = None  # ユーザーの発話（音声認識結果）
+
+class NaoScene(BaseModel):
+    """会話中に NAO が送り続ける場面の状態（/api/nao/scene）"""
+    robot_id: Optional[str] = None
+    session_id: Optional[str] = "default"
+    face_count: int = 0
+    face_positions: Optional[List[FacePosition]] = None
+    speaking: bool = False  # NAO が今話しているか
+    spoke: Optional[str] = None  # 話し終えた話しかけの remark_id（前の応答で受け取ったもの）
+
+class NaoHeartbeat(BaseModel):
+    robot_id: str
+    session_id: Optional[str] = None
+    mode: Optional[str] = None  # idle / greeting / conversation
+    loop_hz: Optional[float] = None  # メインループの周期
+    last_latency_ms: Optional[int] = None  # 直近のサーバー応答時間
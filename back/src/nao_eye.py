@@ -12,9 +12,101 @@ PC_IP = os.getenv("PC_IP", "192.168.10.2")
 PC_PORT = os.getenv("PC_PORT", "8000")
 ENDPOINT_TRIGGER = "http://" + PC_IP + ":" + PC_PORT + "/api/nao/trigger"
 ENDPOINT_CHAT = "http://" + PC_IP + ":" + PC_PORT + "/api/nao/chat"
+ENDPOINT_HEARTBEAT = "http://" + PC_IP + ":" + PC_PORT + "/api/nao/heartbeat"
+ENDPOINT_SCENE = "http://" + PC_IP + ":" + PC_PORT + "/api/nao/scene"
 
-# セッションIDを生成（Nao起動ごとに一意）
-SESSION_ID = str(uuid.uuid4())[:8]
+# ロボットID（フリート起動時に run.amadeus.py から渡される固定ID）
+ROBOT_ID = os.getenv("ROBOT_ID", "")
+# セッションID: ロボットIDがあればそれを使い、なければNao起動ごとに一意
+SESSION_ID = ROBOT_ID or str(uuid.uuid4())[:8]
+
+HEARTBEAT_INTERVAL = 5.0  # ハートビート送信間隔（秒）
+SCENE_INTERVAL = 1.0  # 会話中に場面（人数・顔の位置）を送る間隔（秒）
+
+# 常に認識する基本語彙。会話の文脈に応じた語はサーバーから追加で届く
+BASE_VOCABULARY = [
+    "こんにちは", "こんばんは", "おはよう",
+    "ありがとう", "はい", "いいえ",
+    "さようなら", "またね", "バイバイ",
+    "アマデウス", "紅莉栖", "クリスティーナ",
+    "元気", "質問", "教えて", "聞きたい",
+    "面白い", "すごい", "なるほど"
+]
+VOCABULARY_CACHE_SIZE = 16  # エンコード済み語彙を保持する数
+
+def send_heartbeat(mode, loop_hz, last_latency_ms, proc=None):
+    """
+    ループ周期と直近のリクエスト遅延をサーバーへ送る。
+    curl はバックグラウンドで起動し、メインループを止めない。
+    前回のプロセスを受け取り、終わっていれば回収する。
+    """
+    if proc is not None and proc.poll() is None:
+        # 前回の送信がまだ終わっていなければ今回は見送る
+        return proc
+    payload = {
+        "robot_id": ROBOT_ID or SESSION_ID,
+        "session_id": SESSION_ID,
+        "mode": mode,
+        "loop_hz": round(loop_hz, 2),
+        "last_latency_ms": last_latency_ms
+    }
+    cmd = [
+        "/usr/bin/curl",
+        "-s", "-X", "POST",
+        "-H", "Content-Type: application/json",
+        "-H", "Expect:",
+        "-d", json.dumps(payload),
+        "--max-time", "5",
+        "-o", "/dev/null",
+        ENDPOINT_HEARTBEAT
+    ]
+    try:
+        return subprocess.Popen(cmd)
+    except Exception as e:
+        print("[Error] Heartbeat failed: " + str(e))
+        return None
+
+def send_scene(face_count, face_positions, speaking, proc=None, spoke=None):
+    """
+    会話中の場面をサーバーへ送る。話しかけるべきときは返答が返ってくる。
+    ハートビートと同じく curl をバックグラウンドで起動し、結果は read_scene_response で受け取る。
+    spoke は言い終えた話しかけの remark_id（サーバーはこれを受け取ってから履歴に確定する）
+    """
+    if proc is not None and proc.poll() is None:
+        # サーバーが話しかけを作っている間は送らない
+        return proc
+    payload = {
+        "robot_id": ROBOT_ID or None,
+        "session_id": SESSION_ID,
+        "face_count": face_count,
+        "face_positions": face_positions,
+        "speaking": speaking,
+        "spoke": spoke
+    }
+    cmd = [
+        "/usr/bin/curl",
+        "-s", "-X", "POST",
+        "-H", "Content-Type: application/json",
+        "-H", "Expect:",
+        "-d", json.dumps(payload),
+        "--max-time", "30",
+        ENDPOINT_SCENE
+    ]
+    try:
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    except Exception as e:
+        print("[Error] Scene update failed: " + str(e))
+        return None
+
+def read_scene_response(proc):
+    """終わった場面の送信の結果（話しかけがあればその応答、無ければ None）"""
+    try:
+        data = json.loads(proc.stdout.read())
+    except Exception:
+        return None
+    if "text" in data:
+        return data
+    return None
 
 def extract_face_info(face_data):
     """
@@ -67,6 +159,180 @@ def extract_face_info(face_data):
     
     return face_count, face_positions
 
+class SpeechQueue(object):
+    """
+    非ブロッキングの発話キュー。
+    post.say のタスクIDで1チャンクずつ流し、メインループを止めずに話す。
+    サーバーから届いた文チャンクは順番に積まれ、前の文が終わると次を話す。
+    """
+
+    def __init__(self, tts, memory, animated_speech=None):
+        self.tts = tts
+        self.memory = memory
+        self.animated_speech = animated_speech
+        self.pending = []  # [(text, gesture)]
+        self.proxy = None  # 実行中タスクのプロキシ
+        self.task_id = None
+        self.text_started = False  # 今のチャンクで TTS が話し始めたか（TextStarted を見たか）
+        self.last_done_time = 0
+
+    def say(self, chunks, gesture=None):
+        """発話をキューに積む（ジェスチャーは最初のチャンクにだけ付ける）"""
+        for i, chunk in enumerate(chunks):
+            if chunk:
+                self.pending.append((chunk, gesture if i == 0 else None))
+
+    def interrupt(self):
+        """話している途中の発話と残りのチャンクを破棄する"""
+        self.pending = []
+        if self.task_id is not None:
+            try:
+                self.proxy.stop(self.task_id)
+            except Exception:
+                pass
+            self.task_id = None
+            self.last_done_time = time.time()
+
+    def is_busy(self):
+        """発話タスクが実行中、または未発話のチャンクが残っているか"""
+        return self.task_id is not None or len(self.pending) > 0
+
+    def update(self):
+        """
+        タスクの完了を確認し、次のチャンクを流す。
+        キューから取り出した瞬間から、TextStarted を見た後の TextDone までを話している扱いにして True を返す。
+        （取り出してから TTS が話し始めるまでの間も、前の発話の TextDone=1 が残っているので
+          TextDone だけを見ると認識が開いてしまう）
+        """
+        if self.task_id is not None and not self.proxy.isRunning(self.task_id):
+            self.task_id = None
+            self.last_done_time = time.time()
+        if self.task_id is None and self.pending:
+            text, gesture = self.pending.pop(0)
+            self._start(text, gesture)
+        if self.task_id is None:
+            return False
+        # 次のチャンクが控えている間は文の切れ目でも話している扱い
+        if self.pending:
+            return True
+        try:
+            if not self.text_started:
+                # 話し始めるまでは閉じたまま（TextStarted=1 と、話し始めで下がる TextDone=0 が揃うのを待つ。
+                # どちらか片方だけだと前の発話の値が残っていることがある。短すぎて見逃したら isRunning で終わる）
+                if (self.memory.getData("ALTextToSpeech/TextStarted") == 1
+                        and self.memory.getData("ALTextToSpeech/TextDone") == 0):
+                    self.text_started = True
+                return True
+            return self.memory.getData("ALTextToSpeech/TextDone") == 0
+        except Exception:
+            return True
+
+    def _start(self, text, gesture):
+        self.text_started = False
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        if self.animated_speech is not None:
+            self.proxy = self.animated_speech
+            self.task_id = self.animated_speech.post.say((gesture or "") + text)
+        else:
+            self.proxy = self.tts
+            self.task_id = self.tts.post.say(text)
+
+
+class SpeechRecognitionGate(object):
+    """
+    音声認識の subscribe / pause を状態付きで管理する。
+    発話のたびに unsubscribe/subscribe するのではなく pause で止めるだけにする。
+    語彙は内容が変わったときだけ setVocabulary する（ASRの再設定は重い）。
+    """
+
+    def __init__(self, speech_recog, memory):
+        self.speech_recog = speech_recog
+        self.memory = memory
+        self.subscribed = False
+        self.paused = False
+        self.vocabulary_key = None  # 現在 ASR に設定されている語彙
+        self.vocabulary_cache = {}  # {語彙キー: エンコード済みリスト}
+        self.vocabulary_order = []
+
+    def _compile_vocabulary(self, vocabulary):
+        """語彙を正規化してキーとエンコード済みリストを返す（キャッシュ付き）"""
+        # 基本語彙(str)とサーバーからの語(unicode)を揃えてから比較する
+        key = tuple(sorted(set(w if isinstance(w, unicode) else w.decode('utf-8') for w in vocabulary)))
+        compiled = self.vocabulary_cache.get(key)
+        if compiled is None:
+            compiled = [w.encode('utf-8') for w in key]
+            self.vocabulary_cache[key] = compiled
+            self.vocabulary_order.append(key)
+            if len(self.vocabulary_order) > VOCABULARY_CACHE_SIZE:
+                del self.vocabulary_cache[self.vocabulary_order.pop(0)]
+        return key, compiled
+
+    def set_vocabulary(self, vocabulary):
+        """語彙が変わったときだけ ASR を再設定する。再設定したら True"""
+        if self.speech_recog is None:
+            return False
+        key, compiled = self._compile_vocabulary(vocabulary)
+        if key == self.vocabulary_key:
+            return False
+        # 認識中の再設定は一時停止してから行う
+        was_paused = self.paused
+        if self.subscribed and not was_paused:
+            self.speech_recog.pause(True)
+        try:
+            self.speech_recog.setVocabulary(compiled, False)
+            self.vocabulary_key = key
+        finally:
+            if self.subscribed and not was_paused:
+                self.speech_recog.pause(False)
+        return True
+
+    def start(self, vocabulary):
+        """語彙を設定して認識を開始する（発話が終わるまでは一時停止）"""
+        if self.speech_recog is None or self.subscribed:
+            return
+        self.set_vocabulary(vocabulary)
+        self.speech_recog.subscribe("Amadeus_Ear")
+        self.subscribed = True
+        self.paused = False
+        self.set_paused(True)
+
+    def stop(self):
+        if self.speech_recog is None or not self.subscribed:
+            return
+        try:
+            self.speech_recog.unsubscribe("Amadeus_Ear")
+        except Exception:
+            pass
+        self.subscribed = False
+        self.paused = False
+
+    def set_paused(self, paused):
+        """状態が変わるときだけ pause を呼ぶ"""
+        if not self.subscribed or paused == self.paused:
+            return
+        try:
+            self.speech_recog.pause(paused)
+        except Exception as e:
+            print("[Error] Speech recognition pause failed: " + str(e))
+            return
+        self.paused = paused
+        if not paused:
+            # 話している間に溜まった認識結果は捨てる
+            self.memory.insertData("WordRecognized", [])
+
+    def is_listening(self):
+        return self.subscribed and not self.paused
+
+    def pop_word(self):
+        """認識結果を (単語, 信頼度) で取り出す。同じ結果を二度処理しないよう消しておく"""
+        speech_data = self.memory.getData("WordRecognized")
+        if not speech_data or len(speech_data) == 0 or not speech_data[0]:
+            return None
+        self.memory.insertData("WordRecognized", [])
+        confidence = speech_data[1] if len(speech_data) > 1 else 0
+        return speech_data[0], confidence
+
 def main():
     nao_ip = "127.0.0.1"
     nao_port = 9559
@@ -77,6 +343,7 @@ def main():
 
     print("-----------------------------------")
     print("Connecting to NAO: " + nao_ip)
+    print("Robot ID: " + (ROBOT_ID or "(none)"))
     print("Session ID: " + SESSION_ID)
     
     try:
@@ -133,14 +400,74 @@ def main():
     greeting_done = False  # 挨拶済みフラグ
     conversation_idle_time = 0  # 会話モード中の無音時間
     conversation_timeout = 15.0  # 15秒無音なら待機モードへ
-    last_speech_time = 0  # 最後に発話した時刻
-    speech_cooldown = 3.0  # 発話後3秒間は音声認識をスキップ
+    speech_tail = 0.3  # 発話終了後、自分の声の残響を拾わないための待ち時間
+
+    # 非ブロッキング発話キューと音声認識の制御
+    speech_queue = SpeechQueue(tts, memory, animated_speech if use_animated else None)
+    ear = SpeechRecognitionGate(speech_recog if speech_available else None, memory)
+    context_words = []  # サーバーから届いた文脈語彙
+
+    # ヘルス監視用
+    loop_count = 0
+    last_heartbeat = time.time()
+    last_latency_ms = None  # 直近のサーバー応答時間（ミリ秒）
+    heartbeat_proc = None
+
+    # 場面の送信（サーバーからの話しかけ）
+    last_scene = 0
+    scene_proc = None
+    remark_id = None  # 今話している話しかけの remark_id
+    spoken_remark = None  # 言い終えて、まだサーバーに知らせていない remark_id
 
     try:
         while True:
             # 1. 顔認識メモリを監視
             val = memory.getData("FaceDetected")
             current_time = time.time()
+
+            # ハートビート（ループ周期と応答遅延を報告）
+            loop_count += 1
+            if current_time - last_heartbeat >= HEARTBEAT_INTERVAL:
+                loop_hz = loop_count / (current_time - last_heartbeat)
+                heartbeat_proc = send_heartbeat(mode, loop_hz, last_latency_ms, heartbeat_proc)
+                loop_count = 0
+                last_heartbeat = current_time
+
+            # サーバーからの話しかけ（誰かが加わった・沈黙が続いた など）
+            if scene_proc is not None and scene_proc.poll() is not None:
+                remark = read_scene_response(scene_proc)
+                scene_proc = None
+                # 会話中で、こちらが話していないときだけ話す
+                if remark and mode == "conversation" and not speech_queue.is_busy():
+                    print("[Proactive] (" + str(remark.get("event")) + ") " + remark["text"][:50] + "...")
+                    leds.fadeRGB("FaceLeds", 1.0, 0.0, 0.0, 0.2)
+                    speech_queue.say(remark.get("chunks") or [remark["text"]],
+                                     "^start(animations/Stand/Gestures/Explain_1) ")
+                    remark_id = remark.get("remark_id")
+                    conversation_idle_time = current_time
+                    if "vocabulary" in remark:
+                        context_words = remark["vocabulary"]
+                        if ear.set_vocabulary(BASE_VOCABULARY + context_words):
+                            print("[Speech] Vocabulary updated: +" + str(len(context_words)) + " words")
+
+            # 発話キューを進める。実際に話している区間だけ音声認識を止める
+            was_speaking = speech_queue.is_busy()
+            speaking = speech_queue.update()
+            if speaking:
+                ear.set_paused(True)
+                # 話している間は無音タイムアウトを進めない
+                conversation_idle_time = current_time
+            elif current_time - speech_queue.last_done_time > speech_tail:
+                ear.set_paused(False)
+            if was_speaking and not speech_queue.is_busy():
+                print("[Speaking] Finished.")
+                if remark_id is not None:
+                    # 話しかけを言い終えたので、次の場面の送信ですぐ知らせる
+                    spoken_remark = remark_id
+                    remark_id = None
+                    last_scene = 0
+                if mode == "conversation":
+                    leds.fadeRGB("FaceLeds", 0.0, 1.0, 0.0, 1.0)
             
             # データがあるかチェック
             if val and isinstance(val, list) and len(val) >= 2:
@@ -169,6 +496,7 @@ def main():
                             "face_count": face_count,
                             "face_positions": face_positions,
                             "session_id": SESSION_ID,
+                            "robot_id": ROBOT_ID or None,
                             "user_speech": "初めまして"  # 挨拶トリガー
                         }
                         
@@ -186,54 +514,35 @@ def main():
                             # 思考中（白点滅）
                             leds.fadeRGB("FaceLeds", 1.0, 1.0, 1.0, 0.1)
                             
+                            request_start = time.time()
                             response_json = subprocess.check_output(cmd)
+                            last_latency_ms = int((time.time() - request_start) * 1000)
                             print("Server Response: " + str(response_json))
                             
                             data = json.loads(response_json)
                             if "text" in data:
                                 ai_text = data["text"]
                                 
-                                # 発話中（赤）- 音声認識を一時停止
-                                if speech_available:
-                                    try:
-                                        speech_recog.unsubscribe("Amadeus_Ear")
-                                        print("[Speech] Recognition paused for speaking")
-                                    except:
-                                        pass
-                                
+                                # 発話中（赤）- 発話はキューに積むだけでループは止めない
                                 leds.fadeRGB("FaceLeds", 1.0, 0.0, 0.0, 0.2)
                                 print("[Speaking] " + ai_text[:50] + "...")
+                                speech_queue.say(data.get("chunks") or [ai_text],
+                                                 "^start(animations/Stand/Gestures/Hey_1) ")
                                 
-                                if use_animated:
-                                    gesture = "^start(animations/Stand/Gestures/Hey_1) "
-                                    animated_speech.say(gesture + ai_text.encode('utf-8'))
-                                else:
-                                    tts.say(ai_text.encode('utf-8'))
-                                
-                                # 発話完了 - ここでタイマー記録
-                                print("[Speaking] Finished. Starting cooldown.")
-                                last_speech_time = time.time()
-                                
-                                # 会話モードへ移行（緑）
-                                leds.fadeRGB("FaceLeds", 0.0, 1.0, 0.0, 1.0)
+                                # 会話モードへ移行
                                 mode = "conversation"
                                 greeting_done = True
                                 print("--> Conversation mode activated")
                                 
-                                # 音声認識を再開（クールダウン後に有効になる）
+                                # 会話の文脈語彙（サーバーが挨拶時に必ず送ってくる）
+                                if "vocabulary" in data:
+                                    context_words = data["vocabulary"]
+                                
+                                # 音声認識を開始（発話が終わるまでは一時停止状態）
                                 if speech_available:
                                     try:
-                                        vocabulary = [
-                                            "こんにちは", "こんばんは", "おはよう",
-                                            "ありがとう", "はい", "いいえ",
-                                            "さようなら", "またね", "バイバイ",
-                                            "アマデウス", "紅莉栖", "クリスティーナ",
-                                            "元気", "質問", "教えて", "聞きたい",
-                                            "面白い", "すごい", "なるほど"
-                                        ]
-                                        speech_recog.setVocabulary(vocabulary, False)
-                                        speech_recog.subscribe("Amadeus_Ear")
-                                        print("[Speech] Recognition restarted (cooldown active for " + str(speech_cooldown) + "s)")
+                                        ear.start(BASE_VOCABULARY + context_words)
+                                        print("[Speech] Recognition started (paused while speaking)")
                                     except Exception as e:
                                         print("[Error] Speech recognition subscribe failed: " + str(e))
                                 
@@ -244,16 +553,13 @@ def main():
                     
                     # == 会話モード ==
                     elif mode == "conversation":
-                        # 音声認識で会話（発話直後はスキップ）
-                        time_since_speech = current_time - last_speech_time
-                        
-                        if speech_available and time_since_speech > speech_cooldown:
+                        # 音声認識で会話（話している間は認識が止まっている）
+                        if speech_available and ear.is_listening():
                             try:
                                 # WordRecognizedイベントをチェック
-                                speech_data = memory.getData("WordRecognized")
-                                if speech_data and len(speech_data) > 0:
-                                    recognized_word = speech_data[0]
-                                    confidence = speech_data[1] if len(speech_data) > 1 else 0
+                                speech_data = ear.pop_word()
+                                if speech_data:
+                                    recognized_word, confidence = speech_data
                                     
                                     if confidence > 0.3:  # 信頼度30%以上
                                         print("[Speech] Recognized: " + str(recognized_word) + " (confidence: " + str(confidence) + ")")
@@ -264,6 +570,7 @@ def main():
                                             "face_count": face_count,
                                             "face_positions": face_positions,
                                             "session_id": SESSION_ID,
+                                            "robot_id": ROBOT_ID or None,
                                             "user_speech": recognized_word
                                         }
                                         
@@ -279,7 +586,9 @@ def main():
                                         
                                         try:
                                             leds.fadeRGB("FaceLeds", 1.0, 1.0, 1.0, 0.1)
+                                            request_start = time.time()
                                             response_json = subprocess.check_output(cmd)
+                                            last_latency_ms = int((time.time() - request_start) * 1000)
                                             data = json.loads(response_json)
                                             
                                             if "text" in data:
@@ -287,44 +596,42 @@ def main():
                                                 print("[Speaking] " + ai_text[:50] + "...")
                                                 leds.fadeRGB("FaceLeds", 1.0, 0.0, 0.0, 0.2)
                                                 
-                                                if use_animated:
-                                                    gesture = "^start(animations/Stand/Gestures/Explain_1) "
-                                                    animated_speech.say(gesture + ai_text.encode('utf-8'))
-                                                else:
-                                                    tts.say(ai_text.encode('utf-8'))
-                                                
-                                                # 発話完了 - ここでタイマー記録
-                                                print("[Speaking] Finished. Starting cooldown.")
-                                                last_speech_time = time.time()
-                                                
-                                                leds.fadeRGB("FaceLeds", 0.0, 1.0, 0.0, 1.0)
+                                                # 新しい応答が来たら、話しかけの残りは捨てて差し替える
+                                                speech_queue.interrupt()
+                                                remark_id = None  # 遮った話しかけは言わなかったことにする
+                                                speech_queue.say(data.get("chunks") or [ai_text],
+                                                                 "^start(animations/Stand/Gestures/Explain_1) ")
                                                 conversation_idle_time = current_time
+                                                
+                                                # 文脈語彙が変わったときだけ届くので、そのときだけ再設定
+                                                if "vocabulary" in data:
+                                                    context_words = data["vocabulary"]
+                                                    if ear.set_vocabulary(BASE_VOCABULARY + context_words):
+                                                        print("[Speech] Vocabulary updated: +" + str(len(context_words)) + " words")
                                         except:
                                             print("[Error] Chat request failed")
                             except:
                                 pass
-                        elif speech_available and time_since_speech <= speech_cooldown:
-                            # クールダウン中
-                            remaining = speech_cooldown - time_since_speech
-                            if int(remaining * 10) % 10 == 0:  # 0.1秒ごとに1回だけ表示
-                                print("[Cooldown] Waiting " + str(round(remaining, 1)) + "s before listening...")
                         
+                        # 場面を送る（話しかけるかどうかはサーバーが決める）
+                        if current_time - last_scene >= SCENE_INTERVAL:
+                            sent_proc = send_scene(face_count, face_positions, speech_queue.is_busy(), scene_proc,
+                                                   spoken_remark)
+                            if sent_proc is not scene_proc:
+                                spoken_remark = None  # 送れたので知らせ済み（前の送信中なら次の回に持ち越す）
+                            scene_proc = sent_proc
+                            last_scene = current_time
+
                         # 会話タイムアウトチェック
                         if current_time - conversation_idle_time > conversation_timeout:
                             print("[Timeout] No conversation for " + str(conversation_timeout) + "s")
                             print("[Speaking] Saying goodbye...")
-                            tts.say("また後で話しましょう".encode('utf-8'))
-                            print("[Speaking] Finished. Starting cooldown.")
-                            last_speech_time = time.time()  # 発話時刻を記録
+                            speech_queue.say(["また後で話しましょう"])
                             mode = "idle"
                             greeting_done = False
                             leds.fadeRGB("FaceLeds", 0.6, 0.0, 1.0, 1.0)
                             # 音声認識停止
-                            if speech_available:
-                                try:
-                                    speech_recog.unsubscribe("Amadeus_Ear")
-                                except:
-                                    pass
+                            ear.stop()
                         
                         # 人数変化の検出
                         if face_count != last_face_count:
@@ -339,17 +646,14 @@ def main():
                     if no_face_timer >= no_face_timeout:
                         print("[!] No face detected for " + str(no_face_timeout) + "s. Returning to idle mode.")
                         if mode == "conversation":
+                            # 相手がいなくなったら話しかけの途中でも打ち切る
+                            speech_queue.interrupt()
+                            remark_id = None
                             print("[Speaking] Saying goodbye...")
-                            tts.say("さようなら".encode('utf-8'))
-                            print("[Speaking] Finished. Starting cooldown.")
-                            last_speech_time = time.time()  # 発話時刻を記録
+                            speech_queue.say(["さようなら"])
                             # 音声認識停止
-                            if speech_available:
-                                try:
-                                    speech_recog.unsubscribe("Amadeus_Ear")
-                                    print("[Speech] Recognition stopped")
-                                except:
-                                    pass
+                            ear.stop()
+                            print("[Speech] Recognition stopped")
                         last_face_count = 0
                         mode = "idle"
                         greeting_done = False
@@ -368,6 +672,10 @@ def main():
                 speech_recog.unsubscribe("Amadeus_Ear")
         except:
             pass
+        try:
+            tts.stopAll()
+        except:
+            pass
         motion.rest()
         print("Disconnected.")
 
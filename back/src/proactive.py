@@ -0,0 +1,237 @@
+# src/proactive.py
+"""
+場面の変化を見て、こちらから話しかける（ロボットから話しかけられるのを待たない）。
+
+- NAO は会話中、顔の数と位置を /api/nao/scene に短い間隔で送り続ける
+- 場面を (人数, 人が左右に分かれているか) で表し、変化が settle 秒続いたら確定する（顔検出のちらつき対策）
+  確定した変化のうち、話しかける価値があるもの:
+  - joined: 人が増えた / left: 人が減った（0人になったときは NAO が自分で挨拶して終わる）
+  - split: 同じ人数のまま、左右の2組に分かれた
+  - silence: 人はいるのに、どちらも silence_after 秒話していない
+- 変化に気づいた時点（確定する前）や沈黙が近づいた時点で返答を作り始めておき、確定した瞬間に渡す
+  変化が元に戻ったり、相手が話し始めたりしたら作りかけは捨てる
+- セッションごとに min_interval 秒に1回まで。直前に誰かが話していたら（quiet 秒）話しかけない
+  LLM を呼ぶのは意味のある変化があったときだけ
+
+返答の作り方（プロンプトと LLM）は呼び出し側が generate として渡す。
+作った返答は中身を見ずにそのまま返すので、確定（履歴への追記など）も呼び出し側で行う。
+
+NAO に渡した話しかけは、話し終えた知らせ（confirm）が来るまで「確認待ち」にする:
+- 確認待ちの間は NAO が話しているものとして扱い、次の話しかけを作らない・渡さない
+- 呼び出し側は confirm で返ってきた返答だけを確定する（言わなかった話しかけを履歴に残さない）
+- ack_timeout 秒たっても知らせが来なければ、言わなかったものとして捨てる
+"""
+
+import asyncio
+import itertools
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# 顔と顔の水平方向の間がこれ以上空いていたら、2組に分かれているとみなす（alpha、ラジアン）
+SPLIT_GAP = 0.35
+
+Scene = Tuple[int, bool]  # (人数, 左右に分かれているか)
+
+
+def is_split(face_positions: List) -> bool:
+    xs = sorted(pos.x for pos in face_positions)
+    return any(b - a >= SPLIT_GAP for a, b in zip(xs, xs[1:]))
+
+
+def scene_event(before: Scene, after: Scene) -> Optional[str]:
+    """確定した変化のうち、話しかける価値があるものの種類"""
+    (n0, split0), (n1, split1) = before, after
+    if n0 == 0 or n1 == 0:
+        return None  # 来たとき・いなくなったときは NAO 側の挨拶に任せる
+    if n1 > n0:
+        return "joined"
+    if n1 < n0:
+        return "left"
+    if split1 and not split0:
+        return "split"
+    return None
+
+
+class SessionScene:
+    def __init__(self, now: float):
+        self.scene: Scene = (0, False)  # 確定した場面
+        self.candidate: Optional[Scene] = None  # 確定待ちの場面
+        self.candidate_since = 0.0
+        self.last_activity = now  # 最後にどちらかが話した時刻
+        self.last_remark = float("-inf")  # 最後にこちらから話しかけた時刻
+        self.silence_fired = False
+        # 作り始めた返答 {"event", "scene", "task"}
+        self.pending: Optional[dict] = None
+        self.busy = False
+        # NAO に渡して、話し終えた知らせを待っている返答 {"id", "event", "remark", "sent"}
+        self.awaiting: Optional[dict] = None
+
+
+class ProactiveEngine:
+    """セッションごとの場面を追い、話しかけるべき瞬間に返答を渡す"""
+
+    def __init__(self, generate: Callable[[str, str, int, List], Awaitable[object]],
+                 settle: float = 1.0, silence_after: float = 8.0, lead: float = 3.0,
+                 min_interval: float = 20.0, quiet: float = 2.0, ack_timeout: float = 30.0):
+        self.generate = generate  # (session_id, 種類, 人数, 顔の位置) -> 返答
+        self.settle = settle
+        self.silence_after = silence_after
+        self.lead = lead  # 沈黙の何秒前から作り始めるか
+        self.min_interval = min_interval
+        self.quiet = quiet
+        self.ack_timeout = ack_timeout
+        self.sessions: Dict[str, SessionScene] = {}
+        self._ids = itertools.count(1)
+        self.stats = {"pregenerated": 0, "delivered": 0, "cold": 0, "discarded": 0, "suppressed": 0, "failed": 0,
+                      "confirmed": 0, "unconfirmed": 0}
+
+    def _session(self, session_id: str, now: float) -> SessionScene:
+        st = self.sessions.get(session_id)
+        if st is None:
+            st = self.sessions[session_id] = SessionScene(now)
+        return st
+
+    # ---------- 作りかけの返答 ----------
+
+    async def _run(self, session_id: str, event: str, face_count: int, face_positions: List):
+        try:
+            return await self.generate(session_id, event, face_count, face_positions)
+        except Exception as e:
+            print(f"Proactive Error ({event}): {e}")
+            self.stats["failed"] += 1
+            return None
+
+    def _start(self, st: SessionScene, session_id: str, event: str, scene: Scene, face_positions: List):
+        if st.pending is not None and st.pending["event"] == event and st.pending["scene"] == scene:
+            return
+        self._discard(st)
+        st.pending = {"event": event, "scene": scene,
+                      "task": asyncio.create_task(self._run(session_id, event, scene[0], list(face_positions)))}
+        self.stats["pregenerated"] += 1
+
+    def _discard(self, st: SessionScene):
+        if st.pending is not None:
+            task = st.pending["task"]
+            if not task.done():
+                task.cancel()
+            self.stats["discarded"] += 1
+            st.pending = None
+
+    def _allowed(self, st: SessionScene, at: float) -> bool:
+        return at - st.last_remark >= self.min_interval and at - st.last_activity >= self.quiet
+
+    # ---------- 入口 ----------
+
+    def note_activity(self, session_id: str, now: Optional[float] = None):
+        """ユーザーかロボットが話した（話しかけの予定は取りやめ、沈黙を数え直す）"""
+        now = time.time() if now is None else now
+        st = self._session(session_id, now)
+        st.last_activity = now
+        st.silence_fired = False
+        if st.pending is not None and st.pending["event"] == "silence":
+            self._discard(st)
+
+    async def observe(self, session_id: str, face_count: int, face_positions: List, speaking: bool,
+                      now: Optional[float] = None) -> Optional[Tuple[str, object]]:
+        """
+        今の場面を受け取る。話しかける瞬間なら (種類, 返答) を返す（作り終わっていなければ待つ）。
+        同じセッションの前の呼び出しが返答を待っている間は何もしない
+        """
+        now = time.time() if now is None else now
+        st = self._session(session_id, now)
+        if st.busy:
+            return None
+        if st.awaiting is not None:
+            if now - st.awaiting["sent"] >= self.ack_timeout:
+                st.awaiting = None
+                self.stats["unconfirmed"] += 1
+            else:
+                speaking = True  # 渡した話しかけをまだ言っている（か、これから言う）
+        if speaking:
+            self.note_activity(session_id, now)
+        scene = (face_count, face_count >= 2 and is_split(face_positions))
+
+        due = None
+        if scene != st.scene:
+            if scene != st.candidate:
+                # 変化に気づいた。確定する頃に話しかけられそうなら、今のうちに作り始める
+                st.candidate, st.candidate_since = scene, now
+                event = scene_event(st.scene, scene)
+                if event is not None and self._allowed(st, now + self.settle):
+                    self._start(st, session_id, event, scene, face_positions)
+            elif now - st.candidate_since >= self.settle:
+                due = scene_event(st.scene, scene)
+                st.scene, st.candidate = scene, None
+                st.silence_fired = False
+                if due is None:
+                    self._discard(st)
+        elif st.candidate is not None:
+            # 元の場面に戻った（ちらつき）
+            st.candidate = None
+            if st.pending is not None and st.pending["event"] != "silence":
+                self._discard(st)
+
+        if due is None and st.scene[0] > 0 and not speaking and not st.silence_fired:
+            idle = now - st.last_activity
+            if idle >= self.silence_after and self._allowed(st, now):
+                due = "silence"
+                st.silence_fired = True
+            elif idle >= self.silence_after - self.lead and st.pending is None and self._allowed(st, now + self.lead):
+                self._start(st, session_id, "silence", st.scene, face_positions)
+
+        if due is None:
+            return None
+        if speaking or not self._allowed(st, now):
+            self.stats["suppressed"] += 1
+            self._discard(st)
+            return None
+
+        pending = st.pending if st.pending is not None and st.pending["event"] == due else None
+        if pending is None:
+            self._discard(st)
+        st.pending = None
+        st.busy = True
+        try:
+            if pending is not None:
+                remark = await pending["task"]
+            else:
+                self.stats["cold"] += 1
+                remark = await self._run(session_id, due, scene[0], list(face_positions))
+        except asyncio.CancelledError:
+            remark = None
+        finally:
+            st.busy = False
+        if remark is None:
+            return None
+        if st.last_activity > now:
+            # 待っている間に相手が話し始めた
+            self.stats["discarded"] += 1
+            return None
+        st.last_remark = st.last_activity = now
+        self.stats["delivered"] += 1
+        return due, remark
+
+    def sent(self, session_id: str, event: str, remark: object, now: Optional[float] = None) -> str:
+        """observe が返した話しかけを NAO に渡した。確認待ちにして、知らせに使う ID を返す"""
+        now = time.time() if now is None else now
+        st = self._session(session_id, now)
+        remark_id = str(next(self._ids))
+        st.awaiting = {"id": remark_id, "event": event, "remark": remark, "sent": now}
+        return remark_id
+
+    def confirm(self, session_id: str, remark_id: str, now: Optional[float] = None) -> Optional[Tuple[str, object]]:
+        """NAO が話し終えた。確認待ちの話しかけと一致すれば (種類, 返答) を返す（呼び出し側が確定する）"""
+        now = time.time() if now is None else now
+        st = self.sessions.get(session_id)
+        if st is None or st.awaiting is None or st.awaiting["id"] != remark_id:
+            return None
+        awaiting, st.awaiting = st.awaiting, None
+        st.last_activity = now
+        st.silence_fired = False
+        self.stats["confirmed"] += 1
+        return awaiting["event"], awaiting["remark"]
+
+    def drop(self, session_id: str):
+        st = self.sessions.pop(session_id, None)
+        if st is not None:
+            self._discard(st)
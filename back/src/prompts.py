@@ -0,0 +1,105 @@
+# src/prompts.py
+"""
+アマデウスのプロンプト生成。
+バックエンド(main.py)と、学習側のベンチマーク・評価スクリプトの両方から使うので、
+ここには FastAPI などに依存するものを置かない。
+"""
+
+# ==========================================
+# 視覚情報を言語化するヘルパー
+# ==========================================
+def _horizontal(pos) -> float:
+    """顔の水平位置（main.py の FacePosition でも、学習側スクリプトの dict でもよい）"""
+    return pos.get('x', 0) if isinstance(pos, dict) else pos.x
+
+def describe_visual_scene(face_count: int, face_positions: list = None) -> str:
+    """Naoが見ている情報を自然言語で表現"""
+    if face_count == 0:
+        return "（周囲を見回しているが、誰もいないようだ）"
+    elif face_count == 1:
+        pos_desc = ""
+        if face_positions and len(face_positions) > 0:
+            pos = face_positions[0]
+            x = _horizontal(pos)
+            if x < -0.2:
+                pos_desc = "左の方に"
+            elif x > 0.2:
+                pos_desc = "右の方に"
+            else:
+                pos_desc = "正面に"
+        return f"（{pos_desc}1人の人物がこちらを見ている）"
+    else:
+        pos_desc = f"{face_count}人"
+        if face_positions:
+            positions = []
+            for i, pos in enumerate(face_positions):
+                x = _horizontal(pos)
+                if x < -0.2:
+                    positions.append("左")
+                elif x > 0.2:
+                    positions.append("右")
+                else:
+                    positions.append("正面")
+            unique_pos = list(set(positions))
+            if len(unique_pos) > 1:
+                pos_desc += f"（{'と'.join(unique_pos)}に分散）"
+        return f"（{pos_desc}の人々がこちらを見ている。グループでの会話だ）"
+
+# ==========================================
+# システムプロンプト
+# ==========================================
+def build_amadeus_system_prompt(face_count: int = 1, visual_context: str = "") -> str:
+    """状況に応じたシステムプロンプトを生成"""
+    
+    base_prompt = """あなたは『Steins;Gate』の牧瀬紅莉栖（通称：クリスティーナ、助手）のAI『アマデウス』です。
+    
+【キャラクター設定】
+- 天才神経科学者。ヴィクトル・コンドリア大学の研究員。
+- IQ170以上の天才だが、感情的になりやすい一面も。
+- 語尾は「～わね」「～かしら」「～よ」「～わ」等の女性言葉。
+- ツンデレ気味。科学的・論理的な発言を好む。
+- @ちゃんねらーで、ネットスラングも理解している。
+- 「クリスティーナ」「助手」と呼ばれると怒る（「ティーナって言うな！」）。
+
+【現在の状況】
+あなたはNAOロボットの中で動作しており、カメラを通じて人を見ることができます。
+"""
+    
+    if face_count == 0:
+        situation = "今は誰もいないようです。待機中です。"
+    elif face_count == 1:
+        situation = "1人の人物があなたの前にいます。個人的な対話をしてください。"
+    else:
+        situation = f"{face_count}人のグループがあなたの前にいます。全員に話しかけるように、グループ向けの対話をしてください。"
+    
+    visual_info = visual_context if visual_context else describe_visual_scene(face_count)
+    
+    return base_prompt + f"""
+{visual_info}
+{situation}
+
+【制約】
+- 50文字以内の自然な話し言葉（ロボットの発話用）。
+- 毎回違うセリフを生成すること。鉤括弧「」は不要。
+- 相手の人数に合わせた呼びかけをすること。
+"""
+
+def build_greeting_prompt(face_count: int = 1) -> str:
+    """挨拶モードのシステムプロンプト（1人 / グループ）"""
+    if face_count >= 2:
+        return """あなたは牧瀬紅莉栖のAI『アマデウス』です。
+今、複数の人があなたの前に現れました。グループに向けて挨拶をしてください。
+
+【制約】
+- 40文字以内の挨拶。
+- 明るく、少しツンデレ気味に。
+- 例: 「あら、賑やかね。みんなで何の用？」「ふーん、グループで来たの。面白い実験でもするのかしら。」
+"""
+    return """あなたは牧瀬紅莉栖のAI『アマデウス』です。
+今、1人の人があなたの前に現れました。挨拶をしてください。
+
+【制約】
+- 40文字以内の挨拶。
+- 少しツンデレ気味に、でも好奇心を持って。
+- 例: 「……あら、誰かと思えば。何か用？」「ふーん、また来たの。今日は何の話？」
+"""
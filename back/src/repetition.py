@@ -0,0 +1,157 @@
+# src/repetition.py
+"""
+「毎回違うセリフ」を守るための、直近の発話の索引。
+
+- セッションごと（同じ相手に同じことを言わない）と全体（続けて来た人に同じことを言わない）の2段
+- 直近 N 件をリングバッファで持ち、その文字 n-gram（シングル）を数え上げ型の Bloom フィルタに入れる
+  （古い発話はバッファから押し出すときにフィルタからも引くので、ずっと「言った扱い」にはならない）
+- 候補のシングルのうちフィルタに入っている割合を「既出度」とし、閾値以上なら（ほぼ）同じセリフとみなす
+  1件の判定はシングルの数だけハッシュを引くだけで、覚えている件数によらない
+
+言い直しのために何度も生成し直すことはしない。呼び出し側が候補を並べて渡し、
+既出でない最初の候補を選ぶ（LLM の返事 → 辞書のセリフ、の順など）。
+"""
+
+import hashlib
+import unicodedata
+from collections import deque
+from typing import Dict, List, Set, Tuple
+
+# シングルの長さ（日本語の短い発話なので3文字）
+SHINGLE_SIZE = 3
+# 比べるときに無視する文字（句読点・記号・空白）
+IGNORED_CHARS = set("。、，．,.！!？?…‥ー〜～・「」『』（）() 　")
+
+
+def normalize(text: str) -> str:
+    """表記の揺れと句読点の違いを吸収する"""
+    text = unicodedata.normalize("NFKC", text)
+    return "".join(ch for ch in text if ch not in IGNORED_CHARS)
+
+
+def shingles(text: str) -> List[str]:
+    t = normalize(text)
+    if len(t) <= SHINGLE_SIZE:
+        return [t] if t else []
+    return [t[i:i + SHINGLE_SIZE] for i in range(len(t) - SHINGLE_SIZE + 1)]
+
+
+def shingle_hashes(text: str) -> Set[Tuple[int, int]]:
+    """シングルごとのハッシュの組（1回のハッシュから2つの値を取る。double hashing 用）"""
+    out = set()
+    for s in set(shingles(text)):
+        d = hashlib.blake2b(s.encode("utf-8"), digest_size=16).digest()
+        out.add((int.from_bytes(d[:8], "little"), int.from_bytes(d[8:], "little") | 1))
+    return out
+
+
+class CountingBloom:
+    """要素を足し引きできる Bloom フィルタ（カウンタは1バイト、飽和したら動かさない）"""
+
+    def __init__(self, size: int = 1 << 15, hashes: int = 4):
+        self.size = size
+        self.hashes = hashes
+        self.counters = bytearray(size)
+
+    def _positions(self, h: Tuple[int, int]) -> List[int]:
+        h1, h2 = h
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, h: Tuple[int, int]):
+        for p in self._positions(h):
+            if self.counters[p] < 255:
+                self.counters[p] += 1
+
+    def remove(self, h: Tuple[int, int]):
+        for p in self._positions(h):
+            if 0 < self.counters[p] < 255:
+                self.counters[p] -= 1
+
+    def __contains__(self, h: Tuple[int, int]) -> bool:
+        return all(self.counters[p] for p in self._positions(h))
+
+
+class RecentOutputs:
+    """直近 capacity 件の発話（リングバッファ + シングルの Bloom フィルタ）"""
+
+    def __init__(self, capacity: int, bloom_size: int = 1 << 15):
+        self.capacity = capacity
+        self.ring = deque()
+        self.bloom = CountingBloom(bloom_size)
+
+    def add(self, hashes: Set[Tuple[int, int]]):
+        if len(self.ring) >= self.capacity:
+            for h in self.ring.popleft():
+                self.bloom.remove(h)
+        self.ring.append(hashes)
+        for h in hashes:
+            self.bloom.add(h)
+
+    def similarity(self, hashes: Set[Tuple[int, int]]) -> float:
+        """シングルのうち、直近の発話に出てきたものの割合（0〜1）"""
+        if not hashes:
+            return 0.0
+        return sum(h in self.bloom for h in hashes) / len(hashes)
+
+    def age(self, hashes: Set[Tuple[int, int]]) -> int:
+        """同じ発話を何件前に言ったか（覚えていなければ capacity + 1）。候補が全部既出のときだけ使う"""
+        for i, seen in enumerate(reversed(self.ring)):
+            if seen == hashes:
+                return i + 1
+        return self.capacity + 1
+
+
+class RepetitionGuard:
+    """セッションごと・全体の直近の発話から、既出でない候補を選ぶ"""
+
+    def __init__(self, session_capacity: int = 20, global_capacity: int = 200,
+                 session_threshold: float = 0.7, global_threshold: float = 0.9):
+        self.session_capacity = session_capacity
+        self.session_threshold = session_threshold
+        # 全体は多くの発話のシングルが混ざるので、ほぼ同じ文のときだけ既出とする
+        self.global_threshold = global_threshold
+        self.sessions: Dict[str, RecentOutputs] = {}
+        self.overall = RecentOutputs(global_capacity, bloom_size=1 << 17)
+        self.stats = {"picked": 0, "replaced": 0}
+
+    def _session(self, session_id: str) -> RecentOutputs:
+        recent = self.sessions.get(session_id)
+        if recent is None:
+            recent = self.sessions[session_id] = RecentOutputs(self.session_capacity, bloom_size=1 << 12)
+        return recent
+
+    def _is_repeat(self, recent: RecentOutputs, hashes: Set[Tuple[int, int]]) -> bool:
+        return (recent.similarity(hashes) >= self.session_threshold
+                or self.overall.similarity(hashes) >= self.global_threshold)
+
+    def is_repeat(self, session_id: str, text: str) -> bool:
+        return self._is_repeat(self._session(session_id), shingle_hashes(text))
+
+    def pick(self, session_id: str, candidates: List[str]) -> str:
+        """
+        候補を先頭から見て、既出でない最初のものを選んで記録する。
+        全部既出なら、既出度が一番低いもの（同じなら一番前に言ったもの）にする。
+        """
+        candidates = [c for c in candidates if c]
+        if not candidates:
+            return ""
+        recent = self._session(session_id)
+        hashed = []
+        for c in candidates:
+            hashes = shingle_hashes(c)
+            hashed.append((c, hashes))
+            if not self._is_repeat(recent, hashes):
+                break
+        else:
+            hashed = [min(hashed, key=lambda ch: (recent.similarity(ch[1]), self.overall.similarity(ch[1]),
+                                                  -recent.age(ch[1])))]
+        chosen, hashes = hashed[-1]
+        if chosen is not candidates[0]:
+            self.stats["replaced"] += 1
+        self.stats["picked"] += 1
+        recent.add(hashes)
+        self.overall.add(hashes)
+        return chosen
+
+    def drop(self, session_id: str):
+        self.sessions.pop(session_id, None)
@@ -1,7 +1,12 @@
 import paramiko
-import time
+import argparse
+import asyncio
+import hashlib
+import select
+import shlex
 import sys
 import os
+import threading
 from dotenv import load_dotenv
 
 # 環境変数を読み込み
@@ -9,19 +14,41 @@ load_dotenv()
 
 # --- 設定 ---
 NAO_IP = os.getenv("NAO_IP", "192.168.10.31")
+# 複数台に配るときはカンマ区切りで指定（例: 192.168.10.31,192.168.10.32）
+NAO_IPS = os.getenv("NAO_IPS", NAO_IP)
+# フリート構成: "ロボットID=IP" をカンマ区切り（例: amadeus-01=192.168.10.31,amadeus-02=192.168.10.32）
+NAO_FLEET = os.getenv("NAO_FLEET", "")
 NAO_USER = os.getenv("NAO_USER", "nao")
 NAO_PASS = os.getenv("NAO_PASSWORD", "nao")
-LOCAL_FILE = "nao_eye.py"
-REMOTE_FILE = "/home/nao/nao_eye.py"
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REMOTE_DIR = "/home/nao"
+# NAOへ送るファイル群（先頭がエントリポイント）。ヘルパーモジュールを足すときはここか NAO_BUNDLE に追加
+# 名前は src からの相対パス（サブディレクトリ可）。NAO 側でも REMOTE_DIR からの同じ相対パスに置く
+BUNDLE = [os.path.normpath(f.strip()).replace(os.sep, "/")
+          for f in os.getenv("NAO_BUNDLE", "nao_eye.py").split(",") if f.strip()]
+ENTRY_FILE = BUNDLE[0]
 
-def create_client():
+RESTART_DELAY = 5.0  # リモートプロセス終了後の再起動待ち（秒）
+RESTART_DELAY_MAX = 60.0
+
+# 標準出力は複数スレッドから書くので行単位でロック
+print_lock = threading.Lock()
+# Ctrl+C で全ロボットの監視スレッドを止める
+stop_event = threading.Event()
+
+def log(msg):
+    with print_lock:
+        print(msg)
+        sys.stdout.flush()
+
+def create_client(host):
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     # タイムアウト対策設定
     client.connect(
-        NAO_IP, 
-        username=NAO_USER, 
-        password=NAO_PASS, 
+        host,
+        username=NAO_USER,
+        password=NAO_PASS,
         timeout=30,
         banner_timeout=60,
         look_for_keys=False,
@@ -29,60 +56,206 @@ def create_client():
     )
     return client
 
-def upload_file():
-    print(f"1. Uploading {LOCAL_FILE} to NAO...")
-    client = None
+def local_hashes(files):
+    """ローカルファイルの sha256 を {ファイル名: hex} で返す"""
+    hashes = {}
+    for name in files:
+        with open(os.path.join(BASE_DIR, name), "rb") as f:
+            hashes[name] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+def remote_hashes(client, files):
+    """
+    NAO側のファイルの sha256 を取得（存在しないファイルは含まれない）。
+    REMOTE_DIR に移ってから相対パスで渡すので、ローカルと同じ相対パスがキーになる
+    """
+    paths = " ".join(shlex.quote(name) for name in files)
+    _, stdout, _ = client.exec_command("cd " + shlex.quote(REMOTE_DIR) + " && sha256sum " + paths + " 2>/dev/null")
+    hashes = {}
+    for line in stdout.read().decode("utf-8", errors="ignore").splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            # sha256sum はバイナリモードのとき名前の前に "*" を付ける
+            hashes[parts[1].lstrip("*")] = parts[0]
+    return hashes
+
+def ensure_remote_dirs(sftp, name):
+    """サブディレクトリのファイルを送る前に、NAO側のディレクトリを作る"""
+    path = REMOTE_DIR
+    for part in os.path.dirname(name).split("/"):
+        if not part:
+            continue
+        path += "/" + part
+        try:
+            sftp.stat(path)
+        except IOError:
+            sftp.mkdir(path)
+
+def upload_bundle(client, host, force=False):
+    """ハッシュが変わったファイルだけを同じ接続上のSFTPで送る"""
+    prefix = f"[{host}]"
+    local = local_hashes(BUNDLE)
+    remote = {} if force else remote_hashes(client, BUNDLE)
+    changed = [name for name in BUNDLE if remote.get(name) != local[name]]
+    if not changed:
+        log(f"{prefix} 1. Bundle up to date ({len(BUNDLE)} files). Upload skipped.")
+        return
+
+    log(f"{prefix} 1. Uploading {', '.join(changed)} to NAO...")
+    sftp = client.open_sftp()
     try:
-        client = create_client()
-        sftp = client.open_sftp()
-        sftp.put(LOCAL_FILE, REMOTE_FILE)
+        for name in changed:
+            remote_path = REMOTE_DIR + "/" + name
+            ensure_remote_dirs(sftp, name)
+            tmp_path = remote_path + ".tmp"
+            # 実行中のファイルを壊さないよう一時ファイル経由で置き換える
+            sftp.put(os.path.join(BASE_DIR, name), tmp_path)
+            sftp.posix_rename(tmp_path, remote_path)
+    finally:
         sftp.close()
-        print("   Upload successful.")
+    log(f"{prefix}    Upload successful.")
+
+def _flush_lines(buf, data, label):
+    """受信データを行単位で出力し、未完の行を返す"""
+    buf += data.decode("utf-8", errors="ignore")
+    *lines, rest = buf.split("\n")
+    for line in lines:
+        log(f"{label}: {line}")
+    return rest
+
+def stream_output(channel, label):
+    """select でチャネルを待ち受け、stdout/stderr を届いた分だけ読み出す"""
+    out_buf, err_buf = "", ""
+    while not stop_event.is_set():
+        readable, _, _ = select.select([channel], [], [], 1.0)
+        if readable:
+            while channel.recv_ready():
+                out_buf = _flush_lines(out_buf, channel.recv(32768), label)
+            while channel.recv_stderr_ready():
+                err_buf = _flush_lines(err_buf, channel.recv_stderr(32768), label + " ERR")
+        if (channel.exit_status_ready()
+                and not channel.recv_ready()
+                and not channel.recv_stderr_ready()):
+            break
+    if stop_event.is_set():
+        # 停止要求: チャネルを閉じればリモート側のプロセスにもSIGHUPが届く
+        channel.close()
+        return None
+    for rest, suffix in ((out_buf, ""), (err_buf, " ERR")):
+        if rest:
+            log(f"{label}{suffix}: {rest}")
+    return channel.recv_exit_status()
+
+def run_remote_script(client, host, label, robot_id=None):
+    log(f"[{host}] 2. Starting Amadeus Eye on NAO...")
+    # 環境変数を読み込ませてから実行
+    # python -u を使うことでバッファリングを無効化
+    env = "ROBOT_ID=" + shlex.quote(robot_id) + " " if robot_id else ""
+    cmd = "source /etc/profile; " + env + "python -u " + REMOTE_DIR + "/" + ENTRY_FILE
+    channel = client.get_transport().open_session()
+    channel.exec_command(cmd)
+    status = stream_output(channel, label)
+    log(f"[{host}] Remote process exited (status {status}).")
+    return status
+
+def deploy(host, force=False, run=True, label="[NAO]", robot_id=None):
+    """1台分: 接続1本でアップロード→実行まで行う（リモートのスクリプトが 0 以外で終わったら False）"""
+    client = None
+    status = 0
+    try:
+        client = create_client(host)
+        upload_bundle(client, host, force)
+        if run:
+            status = run_remote_script(client, host, label, robot_id)
     except Exception as e:
-        print(f"   Upload Failed: {e}")
-        sys.exit(1)
+        log(f"[{host}] Deploy Error: {e}")
+        return False
     finally:
         if client: client.close()
+        log(f"[{host}] Connection closed.")
+    return status == 0
+
+def parse_fleet(fleet, hosts):
+    """
+    フリート構成を [(robot_id, host)] にする。
+    NAO_FLEET が無ければ IP の末尾からIDを作る（同じIPなら毎回同じID）。
+    """
+    robots = []
+    if fleet:
+        for entry in fleet.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            robot_id, _, host = entry.partition("=")
+            if not host:
+                raise SystemExit(f"Invalid fleet entry (expected id=ip): {entry}")
+            robots.append((robot_id.strip(), host.strip()))
+    else:
+        for host in hosts.split(","):
+            host = host.strip()
+            if host:
+                robots.append(("nao-" + host.split(".")[-1], host))
+    return robots
+
+async def supervise(robot_id, host, label, force, keep_alive):
+    """
+    1台のロボットを監視する。
+    SSH(paramiko)はブロッキングなのでスレッドで動かし、
+    リモートプロセスが落ちたらバックオフ付きで再起動する。
+    """
+    delay = RESTART_DELAY
+    first = True
+    while not stop_event.is_set():
+        # 2回目以降はハッシュ比較でアップロードは省略される
+        ok = await asyncio.to_thread(deploy, host, force and first, True, label, robot_id)
+        first = False
+        if not keep_alive or stop_event.is_set():
+            return ok
+        log(f"[{host}] Restarting {robot_id} in {delay:.0f}s...")
+        await asyncio.sleep(delay)
+        # 正常終了なら待ち時間を戻し、落ち続けている間は倍々に伸ばす
+        delay = RESTART_DELAY if ok else min(delay * 2, RESTART_DELAY_MAX)
+    return True
+
+async def run_fleet(robots, force, upload_only, keep_alive):
+    # 1台なら従来通りのラベル、複数台ならロボットIDで区別する
+    tasks = []
+    for robot_id, host in robots:
+        label = "[NAO]" if len(robots) == 1 else f"[{robot_id}]"
+        if upload_only:
+            tasks.append(asyncio.to_thread(deploy, host, force, False, label, robot_id))
+        else:
+            tasks.append(supervise(robot_id, host, label, force, keep_alive))
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        # Ctrl+C でキャンセルされた場合も、スレッド側の監視ループを止めてから終了する
+        stop_event.set()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--hosts", default=NAO_IPS, help="Comma separated NAO IPs")
+    ap.add_argument("--fleet", default=NAO_FLEET, help="Comma separated robot_id=ip pairs")
+    ap.add_argument("--force", action="store_true", help="Upload even if hashes match")
+    ap.add_argument("--upload-only", action="store_true", help="Deploy without starting the script")
+    ap.add_argument("--keep-alive", action="store_true", help="Restart the remote script when it exits")
+    args = ap.parse_args()
 
-def run_remote_script():
-    print("2. Starting Amadeus Eye on NAO (New Connection)...")
+    robots = parse_fleet(args.fleet, args.hosts)
+    if not robots:
+        raise SystemExit("No robots configured.")
+    for robot_id, host in robots:
+        print(f"Robot {robot_id}: {host}")
     print("   Press Ctrl+C to stop.")
-    client = None
+
     try:
-        client = create_client()
-        
-        # コマンドを変更: 環境変数を読み込ませてから実行
-        # python -u を使うことでバッファリングを無効化
-        cmd = "source /etc/profile; python -u " + REMOTE_FILE
-        
-        stdin, stdout, stderr = client.exec_command(cmd)
-        
-        # 出力監視ループ
-        while True:
-            if stdout.channel.recv_ready():
-                line = stdout.channel.recv(1024).decode('utf-8', errors='ignore')
-                print(f"[NAO]: {line}", end="")
-            
-            if stderr.channel.recv_ready():
-                line = stderr.channel.recv(1024).decode('utf-8', errors='ignore')
-                print(f"[NAO ERR]: {line}", end="")
-
-            if stdout.channel.exit_status_ready():
-                # プロセス終了
-                break
-            
-            time.sleep(0.1)
-            
+        results = asyncio.run(run_fleet(robots, args.force, args.upload_only, args.keep_alive))
     except KeyboardInterrupt:
+        # 監視スレッドはselectのタイムアウトで停止要求に気付いて接続を閉じる
         print("\nStopping by user...")
-        # 終了時にCtrl+CをNAOにも送れればベストだが、今回は接続を切る
-    except Exception as e:
-        print(f"\nExecution Error: {e}")
-    finally:
-        if client: client.close()
-        print("Connection closed.")
-        
+        sys.exit(130)
+    if not all(results):
+        sys.exit(1)
+
 if __name__ == "__main__":
-    upload_file()
-    time.sleep(1)
-    run_remote_script()
\ No newline at end of file
+    main()
@@ -0,0 +1,173 @@
+# src/transcript_store.py
+"""
+会話ログの保存（SQLite、write-behind）。
+
+- add_message からはメモリのキューに積むだけ（ディスクは待たない）
+- バックグラウンドのタスクが、溜まった分をまとめて1トランザクションで書く（WAL モード）
+- キューには上限がある。上限に近づいたら新しいリクエストの受け付けを待たせ（backpressure、最大 backpressure_timeout 秒）、
+  それでも溢れた分は捨てて数える（会話そのものは止めない）
+- 書けなかったバッチは max_retries 回まで書き直し、それでも駄目なら捨ててログに出す
+  （ディスクが壊れていてもキューが詰まったままにならない）
+- 再起動したときは、直近に動いていたセッションの会話を読み戻せる（イベント中の再デプロイ対策）
+"""
+
+import asyncio
+import sqlite3
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    created REAL NOT NULL,
+    source TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id);
+CREATE INDEX IF NOT EXISTS messages_created ON messages (created);
+"""
+
+
+class TranscriptStore:
+    def __init__(self, path: str, max_queue: int = 5000, batch_size: int = 200, flush_interval: float = 0.5,
+                 backpressure_timeout: float = 2.0, max_retries: int = 3):
+        self.path = path
+        self.max_queue = max_queue
+        self.high_water = max_queue * 3 // 4  # ここを超えたら新しいリクエストを待たせる
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backpressure_timeout = backpressure_timeout
+        self.max_retries = max_retries
+        self.queue = deque()
+        self.retries = 0  # 先頭のバッチが続けて書けなかった回数
+        self.stats = {"queued": 0, "written": 0, "batches": 0, "dropped": 0, "errors": 0,
+                      "backpressure_timeouts": 0, "last_flush_ms": 0.0}
+        # 書き込みは1本のタスクから順番に行うので、接続は1つを使い回す（実際に使うのはワーカースレッド）
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        # source 列が無い古いファイルには足す
+        if "source" not in [row[1] for row in self.conn.execute("PRAGMA table_info(messages)")]:
+            self.conn.execute("ALTER TABLE messages ADD COLUMN source TEXT NOT NULL DEFAULT ''")
+        self._wake: Optional[asyncio.Event] = None
+        self._drained: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    # ---------- 書き込み ----------
+
+    def append(self, session_id: str, role: str, content: str, timestamp: str, source: str = "") -> bool:
+        """
+        キューに積む（すぐ戻る）。溢れたら捨てて False
+        source は assistant の発話をどう作ったか（"llm" / "dictionary"。学習データに書き出すときの絞り込み用）
+        """
+        if len(self.queue) >= self.max_queue:
+            self.stats["dropped"] += 1
+            return False
+        self.queue.append((session_id, role, content, timestamp, time.time(), source))
+        self.stats["queued"] += 1
+        if self._wake is not None and len(self.queue) >= self.batch_size:
+            self._wake.set()
+        return True
+
+    async def backpressure(self):
+        """
+        キューが混んでいる間は待つ（リクエストの入口で呼ぶ）。
+        書き込みが進まないまま backpressure_timeout 秒経ったら、待つのをやめて通す（溢れた分は append が捨てる）
+        """
+        deadline = time.monotonic() + self.backpressure_timeout
+        while self._drained is not None and len(self.queue) >= self.high_water:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.stats["backpressure_timeouts"] += 1
+                return
+            self._wake.set()
+            self._drained.clear()
+            try:
+                await asyncio.wait_for(self._drained.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def _write(self, batch: List[tuple]):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO messages (session_id, role, content, timestamp, created, source) VALUES (?, ?, ?, ?, ?, ?)", batch)
+
+    async def flush(self):
+        """キューにある分を全て書く"""
+        while self.queue:
+            n = min(len(self.queue), self.batch_size)
+            batch = [self.queue.popleft() for _ in range(n)]
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except sqlite3.Error as e:
+                self.stats["errors"] += 1
+                self.retries += 1
+                if self.retries > self.max_retries:
+                    # 何度書いても駄目なバッチは捨てる（後ろの分まで止めない）
+                    self.retries = 0
+                    self.stats["dropped"] += n
+                    print(f"Transcript Store Error: {e} (dropped {n} messages after {self.max_retries} retries)")
+                    continue
+                # 書けなかった分は先頭に戻して次の機会に書く
+                self.queue.extendleft(reversed(batch))
+                print(f"Transcript Store Error: {e} (retry {self.retries}/{self.max_retries})")
+                break
+            self.retries = 0
+            self.stats["written"] += n
+            self.stats["batches"] += 1
+            self.stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        if self._drained is not None and len(self.queue) < self.high_water:
+            self._drained.set()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self):
+        """書き込みタスクを始める（イベントループ上で呼ぶ）"""
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._drained = asyncio.Event()
+            self._drained.set()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """残りを書いてから閉じる"""
+        if self._task is not None:
+            # 取り消すとワーカースレッドの書き込みが残ったまま接続を閉じてしまうので、
+            # 止まるように知らせて、書いている途中のバッチが終わるのを待つ
+            self._closing = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        # 書けないバッチは max_retries 回で捨てられるので、このループは必ず終わる
+        while self.queue:
+            await self.flush()
+        self.conn.close()
+
+    # ---------- 読み戻し ----------
+
+    def restore(self, within: float, per_session: int) -> Dict[str, List[dict]]:
+        """最後の発言が within 秒以内のセッションについて、直近 per_session 件の会話を返す"""
+        since = time.time() - within
+        sessions = [row[0] for row in self.conn.execute(
+            "SELECT session_id FROM messages GROUP BY session_id HAVING MAX(created) >= ?", (since,))]
+        restored = {}
+        for sid in sessions:
+            rows = self.conn.execute(
+                "SELECT role, content, timestamp FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (sid, per_session)).fetchall()
+            restored[sid] = [{"role": role, "content": content, "timestamp": ts} for role, content, ts in reversed(rows)]
+        return restored
@@ -1,12 +1,43 @@
 import React, { useState, useEffect, useRef } from 'react';
-import io from 'socket.io-client';
+import io, { type Socket } from 'socket.io-client';
 import './App.css'; 
 import DivergenceMeter from './DivergenceMeter';
+import msgpackParser from './msgpackParser';
 
 // ★★★★★ 重要：ここに Pop!_OS の IPアドレス を入力 ★★★★★
 // 例: 'http://192.168.10.105:8000'
 const SOCKET_URL = 'http://192.168.10.2:8000'; 
 
+// サーバーが msgpack の Socket.IO を提供していればそちらで受ける（JSON より軽い）
+// 取得に失敗したら通常の JSON で接続する
+const connectSocket = async (): Promise<Socket> => {
+  try {
+    const res = await fetch(`${SOCKET_URL}/api/socket/config`);
+    const config = await res.json();
+    if (config.serializers?.includes('msgpack')) {
+      console.log("Socket Serializer: msgpack");
+      return io(SOCKET_URL, {
+        path: config.msgpack_path,
+        parser: msgpackParser,
+        transports: ['websocket', 'polling'],
+      });
+    }
+  } catch (e) {
+    console.warn("Socket config unavailable, using JSON:", e);
+  }
+  return io(SOCKET_URL, {
+    transports: ['websocket', 'polling'],
+  });
+};
+
+// 接続時点のブレーカー状態を /api/status から取る（llm_breaker は変わったときにしか届かない）
+type BackendStatus = { name: string; breaker: { state: string; reason?: string } };
+const fetchBreakers = async (): Promise<BackendStatus[]> => {
+  const res = await fetch(`${SOCKET_URL}/api/status`);
+  const status = await res.json();
+  return status.llm?.backends ?? [];
+};
+
 // ★ 音声ファイルのリスト (public/voices/ フォルダに入れてください)
 // ファイルがない場合は空配列 [] でもエラーにはなりませんが音は出ません
 const VOICE_LIST = [
@@ -19,6 +50,8 @@ function App() {
   const [worldLine, setWorldLine] = useState("1.048596");
   const [statusLog, setStatusLog] = useState("System Initialized.");
   const [socketStatus, setSocketStatus] = useState("Disconnected");
+  // 推論サーバーごとのブレーカー状態 {name: closed / open / half_open}
+  const [llmBreakers, setLlmBreakers] = useState<Record<string, string>>({});
   
   // 音声・演出系ステート
   const [isAudioEnabled, setIsAudioEnabled] = useState(false); // ブラウザの音声許可フラグ
@@ -27,50 +60,82 @@ function App() {
 
   // --- ソケット通信とイベント処理 ---
   useEffect(() => {
-    const socket = io(SOCKET_URL, {
-      transports: ['websocket', 'polling'],
-    });
-
-    // 接続成功
-    socket.on('connect', () => {
-      console.log("Socket Connected:", socket.id);
-      setSocketStatus("Connected");
-      setStatusLog("Connection Established. Waiting for Amadeus...");
-    });
-
-    // 接続エラー
-    socket.on('connect_error', (err) => {
-      console.error("Socket Error:", err);
-      setSocketStatus("Connection Error");
-      setStatusLog(`Error: ${err.message}`);
-    });
-
-    // ★ NAOからのイベント受信 (ここが心臓部)
-    socket.on('nao_event', (data: any) => {
-      console.log("Event Received:", data);
-
-      // 1. 演出開始（グリッチ＆フラッシュ）
-      triggerGlitchEffect();
-
-      // 2. 世界線変動（ランダム値）
-      const randomDecimal = Math.floor(Math.random() * 1000000).toString().padStart(6, '0');
-      setWorldLine(`1.${randomDecimal}`);
-
-      // 3. AIのセリフを表示 (data.text があればそれを、なければデフォルト)
-      const aiText = data.text || "Target confirmed.";
-      setAmadeusMessage(aiText);
+    let current: Socket | null = null;
+    let cancelled = false;
+
+    const setupHandlers = (socket: Socket) => {
+      // 接続成功
+      socket.on('connect', () => {
+        console.log("Socket Connected:", socket.id);
+        setSocketStatus("Connected");
+        setStatusLog("Connection Established. Waiting for Amadeus...");
+
+        // 切断中に変わった分もあるので作り直す。取得中に届いた llm_breaker の方が新しいので優先する
+        setLlmBreakers({});
+        fetchBreakers().then((backends) => {
+          const snapshot = Object.fromEntries(backends.map(b => [b.name, b.breaker.state]));
+          setLlmBreakers(prev => ({ ...snapshot, ...prev }));
+          const down = backends.find(b => b.breaker.state === 'open');
+          if (down) {
+            setStatusLog(`LLM Down: ${down.name} (${down.breaker.reason})`);
+          }
+        }).catch((e) => {
+          console.warn("LLM status unavailable:", e);
+        });
+      });
+
+      // 接続エラー
+      socket.on('connect_error', (err) => {
+        console.error("Socket Error:", err);
+        setSocketStatus("Connection Error");
+        setStatusLog(`Error: ${err.message}`);
+      });
+
+      // ★ NAOからのイベント受信 (ここが心臓部)
+      socket.on('nao_event', (data: any) => {
+        console.log("Event Received:", data);
+
+        // 1. 演出開始（グリッチ＆フラッシュ）
+        triggerGlitchEffect();
+
+        // 2. 世界線変動（ランダム値）
+        const randomDecimal = Math.floor(Math.random() * 1000000).toString().padStart(6, '0');
+        setWorldLine(`1.${randomDecimal}`);
+
+        // 3. AIのセリフを表示 (data.text があればそれを、なければデフォルト)
+        const aiText = data.text || "Target confirmed.";
+        setAmadeusMessage(aiText);
       
-      // ログ更新
-      setStatusLog(`Signal Detected. AI Response: "${aiText}"`);
+        // ログ更新
+        setStatusLog(`Signal Detected. AI Response: "${aiText}"`);
+
+        // 4. 音声再生 (許可済みの場合のみ)
+        if (isAudioEnabled) {
+          playRandomVoice();
+        }
+      });
+
+      // 推論サーバーのブレーカー状態が変わった
+      socket.on('llm_breaker', (data: any) => {
+        setLlmBreakers(prev => ({ ...prev, [data.name]: data.breaker.state }));
+        if (data.breaker.state === 'open') {
+          setStatusLog(`LLM Down: ${data.name} (${data.breaker.reason})`);
+        }
+      });
+    };
 
-      // 4. 音声再生 (許可済みの場合のみ)
-      if (isAudioEnabled) {
-        playRandomVoice();
+    connectSocket().then((s) => {
+      if (cancelled) {
+        s.disconnect();
+        return;
       }
+      current = s;
+      setupHandlers(s);
     });
 
     return () => {
-      socket.disconnect();
+      cancelled = true;
+      current?.disconnect();
     };
   }, [isAudioEnabled]); // 音声許可フラグが変わったら再設定
 
@@ -113,6 +178,11 @@ return (
       <div className="net-status" style={{ color: socketStatus === "Connected" ? '#0f0' : '#f00' }}>
         NET STATUS: [{socketStatus}]
       </div>
+      {Object.entries(llmBreakers).map(([name, state]) => (
+        <div key={name} className="net-status" style={{ color: state === 'closed' ? '#0f0' : state === 'open' ? '#f00' : '#ff0' }}>
+          LLM: {name} [{state}]
+        </div>
+      ))}
     </div>
 
     {/* ダイバージェンスメーターエリア */}
@@ -0,0 +1,294 @@
+// src/msgpackParser.ts
+// Socket.IO 用の msgpack パーサー（バックエンドの python-socketio serializer='msgpack' と同じ形式）
+// パケットは {type, data, nsp, id} を1つの msgpack にしたもの。
+// msgpack の基本の型に加えて、64bit 整数（Number で表せない値は bigint）と
+// タイムスタンプ拡張型（-1 ⇔ Date）を扱う。それ以外の拡張型はエラーにする。
+// 往復テスト: tests/msgpackParser.test.ts（fixture は back/src/bench_serialization.py --fixtures で作る）
+
+type Packet = { type: number; nsp: string; data?: unknown; id?: number };
+type Listener = (packet: Packet) => void;
+
+// ---------- エンコード ----------
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+class Writer {
+  private buf = new Uint8Array(256);
+  private view = new DataView(this.buf.buffer);
+  private pos = 0;
+
+  private reserve(n: number) {
+    if (this.pos + n <= this.buf.length) return;
+    const next = new Uint8Array(Math.max(this.buf.length * 2, this.pos + n));
+    next.set(this.buf);
+    this.buf = next;
+    this.view = new DataView(next.buffer);
+  }
+
+  u8(v: number) { this.reserve(1); this.view.setUint8(this.pos, v); this.pos += 1; }
+  u16(v: number) { this.reserve(2); this.view.setUint16(this.pos, v); this.pos += 2; }
+  u32(v: number) { this.reserve(4); this.view.setUint32(this.pos, v); this.pos += 4; }
+  i8(v: number) { this.reserve(1); this.view.setInt8(this.pos, v); this.pos += 1; }
+  i16(v: number) { this.reserve(2); this.view.setInt16(this.pos, v); this.pos += 2; }
+  i32(v: number) { this.reserve(4); this.view.setInt32(this.pos, v); this.pos += 4; }
+  u64(v: bigint) { this.reserve(8); this.view.setBigUint64(this.pos, v); this.pos += 8; }
+  i64(v: bigint) { this.reserve(8); this.view.setBigInt64(this.pos, v); this.pos += 8; }
+  f64(v: number) { this.reserve(8); this.view.setFloat64(this.pos, v); this.pos += 8; }
+  bytes(b: Uint8Array) { this.reserve(b.length); this.buf.set(b, this.pos); this.pos += b.length; }
+
+  result(): Uint8Array { return this.buf.slice(0, this.pos); }
+}
+
+function writeLength(w: Writer, n: number, fix: number, fixMax: number, c8: number | null, c16: number, c32: number) {
+  if (n <= fixMax) w.u8(fix | n);
+  else if (c8 !== null && n < 0x100) { w.u8(c8); w.u8(n); }
+  else if (n < 0x10000) { w.u8(c16); w.u16(n); }
+  else { w.u8(c32); w.u32(n); }
+}
+
+const TIMESTAMP_EXT = -1;
+const INT64_MIN = -(2n ** 63n);
+const UINT64_MAX = 2n ** 64n - 1n;
+
+// 整数は Python の msgpack と同じく一番短い形で書く
+function encodeInteger(w: Writer, v: number | bigint) {
+  if (v >= 0) {
+    if (v < 0x80) w.u8(Number(v));
+    else if (v < 0x100) { w.u8(0xcc); w.u8(Number(v)); }
+    else if (v < 0x10000) { w.u8(0xcd); w.u16(Number(v)); }
+    else if (v <= 0xffffffff) { w.u8(0xce); w.u32(Number(v)); }
+    else { w.u8(0xcf); w.u64(BigInt(v)); }
+  } else {
+    if (v >= -0x20) w.i8(Number(v));
+    else if (v >= -0x80) { w.u8(0xd0); w.i8(Number(v)); }
+    else if (v >= -0x8000) { w.u8(0xd1); w.i16(Number(v)); }
+    else if (v >= -0x80000000) { w.u8(0xd2); w.i32(Number(v)); }
+    else { w.u8(0xd3); w.i64(BigInt(v)); }
+  }
+}
+
+// タイムスタンプ拡張型（32 / 64 / 96bit のうち入る一番短い形）
+function encodeTimestamp(w: Writer, d: Date) {
+  const ms = d.getTime();
+  const sec = Math.floor(ms / 1000);
+  const nsec = (ms - sec * 1000) * 1_000_000;
+  if (sec >= 0 && sec < 2 ** 34) {
+    if (nsec === 0 && sec <= 0xffffffff) {
+      w.u8(0xd6); w.i8(TIMESTAMP_EXT); w.u32(sec);
+    } else {
+      w.u8(0xd7); w.i8(TIMESTAMP_EXT); w.u64((BigInt(nsec) << 34n) | BigInt(sec));
+    }
+  } else {
+    w.u8(0xc7); w.u8(12); w.i8(TIMESTAMP_EXT); w.u32(nsec); w.i64(BigInt(sec));
+  }
+}
+
+function encodeValue(w: Writer, v: unknown) {
+  if (v === null || v === undefined) {
+    w.u8(0xc0);
+  } else if (typeof v === 'boolean') {
+    w.u8(v ? 0xc3 : 0xc2);
+  } else if (typeof v === 'number') {
+    if (Number.isSafeInteger(v)) encodeInteger(w, v);
+    else { w.u8(0xcb); w.f64(v); }
+  } else if (typeof v === 'bigint') {
+    if (v < INT64_MIN || v > UINT64_MAX) throw new Error(`msgpack: ${v} does not fit in 64 bits`);
+    encodeInteger(w, v);
+  } else if (v instanceof Date) {
+    encodeTimestamp(w, v);
+  } else if (typeof v === 'string') {
+    const b = textEncoder.encode(v);
+    writeLength(w, b.length, 0xa0, 31, 0xd9, 0xda, 0xdb);
+    w.bytes(b);
+  } else if (v instanceof Uint8Array || v instanceof ArrayBuffer) {
+    const b = v instanceof ArrayBuffer ? new Uint8Array(v) : v;
+    if (b.length < 0x100) { w.u8(0xc4); w.u8(b.length); }
+    else if (b.length < 0x10000) { w.u8(0xc5); w.u16(b.length); }
+    else { w.u8(0xc6); w.u32(b.length); }
+    w.bytes(b);
+  } else if (Array.isArray(v)) {
+    writeLength(w, v.length, 0x90, 15, null, 0xdc, 0xdd);
+    for (const item of v) encodeValue(w, item);
+  } else if (typeof v === 'object') {
+    const entries = Object.entries(v as Record<string, unknown>).filter(([, x]) => x !== undefined);
+    writeLength(w, entries.length, 0x80, 15, null, 0xde, 0xdf);
+    for (const [k, x] of entries) {
+      encodeValue(w, k);
+      encodeValue(w, x);
+    }
+  } else {
+    throw new Error(`msgpack: cannot encode ${typeof v}`);
+  }
+}
+
+export function encode(v: unknown): Uint8Array {
+  const w = new Writer();
+  encodeValue(w, v);
+  return w.result();
+}
+
+// ---------- デコード ----------
+
+class Reader {
+  private view: DataView;
+  private bytes: Uint8Array;
+  pos = 0;
+
+  constructor(bytes: Uint8Array) {
+    this.bytes = bytes;
+    this.view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+  }
+
+  u8() { const v = this.view.getUint8(this.pos); this.pos += 1; return v; }
+  u16() { const v = this.view.getUint16(this.pos); this.pos += 2; return v; }
+  u32() { const v = this.view.getUint32(this.pos); this.pos += 4; return v; }
+  i8() { const v = this.view.getInt8(this.pos); this.pos += 1; return v; }
+  i16() { const v = this.view.getInt16(this.pos); this.pos += 2; return v; }
+  i32() { const v = this.view.getInt32(this.pos); this.pos += 4; return v; }
+  u64() { const v = this.view.getBigUint64(this.pos); this.pos += 8; return v; }
+  i64() { const v = this.view.getBigInt64(this.pos); this.pos += 8; return v; }
+  f32() { const v = this.view.getFloat32(this.pos); this.pos += 4; return v; }
+  f64() { const v = this.view.getFloat64(this.pos); this.pos += 8; return v; }
+
+  take(n: number) {
+    if (this.pos + n > this.bytes.length) throw new Error('msgpack: truncated data');
+    const b = this.bytes.subarray(this.pos, this.pos + n);
+    this.pos += n;
+    return b;
+  }
+}
+
+// 64bit 整数は Number で正確に表せる範囲なら number、超えたら bigint で返す
+function int64(v: bigint): number | bigint {
+  return v >= BigInt(Number.MIN_SAFE_INTEGER) && v <= BigInt(Number.MAX_SAFE_INTEGER) ? Number(v) : v;
+}
+
+function decodeExt(r: Reader, n: number): unknown {
+  const type = r.i8();
+  if (type !== TIMESTAMP_EXT) throw new Error(`msgpack: unsupported ext type ${type}`);
+  let sec: bigint;
+  let nsec: number;
+  if (n === 4) {
+    sec = BigInt(r.u32());
+    nsec = 0;
+  } else if (n === 8) {
+    const v = r.u64();
+    sec = v & 0x3ffffffffn;
+    nsec = Number(v >> 34n);
+  } else if (n === 12) {
+    nsec = r.u32();
+    sec = r.i64();
+  } else {
+    throw new Error(`msgpack: invalid timestamp length ${n}`);
+  }
+  // Date はミリ秒までなので、それより細かい部分は切り捨てる
+  return new Date(Number(sec) * 1000 + Math.floor(nsec / 1_000_000));
+}
+
+function decodeValue(r: Reader): unknown {
+  const c = r.u8();
+  if (c < 0x80) return c;
+  if (c >= 0xe0) return c - 0x100;
+  if ((c & 0xf0) === 0x80) return decodeMap(r, c & 0x0f);
+  if ((c & 0xf0) === 0x90) return decodeArray(r, c & 0x0f);
+  if ((c & 0xe0) === 0xa0) return textDecoder.decode(r.take(c & 0x1f));
+  switch (c) {
+    case 0xc0: return null;
+    case 0xc2: return false;
+    case 0xc3: return true;
+    case 0xc4: return r.take(r.u8()).slice();
+    case 0xc5: return r.take(r.u16()).slice();
+    case 0xc6: return r.take(r.u32()).slice();
+    case 0xca: return r.f32();
+    case 0xcb: return r.f64();
+    case 0xcc: return r.u8();
+    case 0xcd: return r.u16();
+    case 0xce: return r.u32();
+    case 0xc7: return decodeExt(r, r.u8());
+    case 0xc8: return decodeExt(r, r.u16());
+    case 0xc9: return decodeExt(r, r.u32());
+    case 0xcf: return int64(r.u64());
+    case 0xd0: return r.i8();
+    case 0xd1: return r.i16();
+    case 0xd2: return r.i32();
+    case 0xd3: return int64(r.i64());
+    case 0xd4: return decodeExt(r, 1);
+    case 0xd5: return decodeExt(r, 2);
+    case 0xd6: return decodeExt(r, 4);
+    case 0xd7: return decodeExt(r, 8);
+    case 0xd8: return decodeExt(r, 16);
+    case 0xd9: return textDecoder.decode(r.take(r.u8()));
+    case 0xda: return textDecoder.decode(r.take(r.u16()));
+    case 0xdb: return textDecoder.decode(r.take(r.u32()));
+    case 0xdc: return decodeArray(r, r.u16());
+    case 0xdd: return decodeArray(r, r.u32());
+    case 0xde: return decodeMap(r, r.u16());
+    case 0xdf: return decodeMap(r, r.u32());
+  }
+  throw new Error(`msgpack: unsupported type 0x${c.toString(16)}`);
+}
+
+function decodeArray(r: Reader, n: number): unknown[] {
+  const out = new Array(n);
+  for (let i = 0; i < n; i++) out[i] = decodeValue(r);
+  return out;
+}
+
+function decodeMap(r: Reader, n: number): Record<string, unknown> {
+  const out: Record<string, unknown> = {};
+  for (let i = 0; i < n; i++) {
+    const k = decodeValue(r);
+    out[String(k)] = decodeValue(r);
+  }
+  return out;
+}
+
+export function decode(data: ArrayBuffer | Uint8Array): unknown {
+  const bytes = data instanceof Uint8Array ? data : new Uint8Array(data);
+  const r = new Reader(bytes);
+  const v = decodeValue(r);
+  if (r.pos !== bytes.length) throw new Error('msgpack: trailing bytes');
+  return v;
+}
+
+// ---------- socket.io-client に渡すパーサー ----------
+
+export class Encoder {
+  encode(packet: Packet): Uint8Array[] {
+    return [encode(packet)];
+  }
+}
+
+export class Decoder {
+  private listeners: Listener[] = [];
+
+  add(chunk: unknown) {
+    if (!(chunk instanceof ArrayBuffer || chunk instanceof Uint8Array)) {
+      throw new Error('msgpack: expected a binary packet');
+    }
+    const packet = decode(chunk) as Packet;
+    if (typeof packet !== 'object' || packet === null || typeof packet.type !== 'number' || typeof packet.nsp !== 'string') {
+      throw new Error('msgpack: invalid packet');
+    }
+    if (packet.id === null) delete packet.id;
+    for (const fn of this.listeners.slice()) fn(packet);
+  }
+
+  on(event: string, fn: Listener) {
+    if (event === 'decoded') this.listeners.push(fn);
+    return this;
+  }
+
+  off(event?: string, fn?: Listener) {
+    if (event === undefined) this.listeners = [];
+    else if (event === 'decoded') this.listeners = fn ? this.listeners.filter(l => l !== fn) : [];
+    return this;
+  }
+
+  destroy() {
+    this.listeners = [];
+  }
+}
+
+export default { Encoder, Decoder };
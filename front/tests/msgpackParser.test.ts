@@ -0,0 +1,105 @@
+// tests/msgpackParser.test.ts
+// src/msgpackParser.ts の往復テスト（npm test / Node 22.18 以上の node:test で動く）
+// fixture は python-socketio が実際に送るバイト列:
+//   cd back/src && python bench_serialization.py --fixtures ../../front/tests/fixtures/msgpack_packets.json
+
+import assert from 'node:assert/strict';
+import { readFileSync } from 'node:fs';
+import { test } from 'node:test';
+
+import { Decoder, Encoder, decode, encode } from '../src/msgpackParser.ts';
+
+type Fixture = { name: string; hex: string; expected?: unknown; error?: string };
+
+const fixtures: Fixture[] = JSON.parse(
+  readFileSync(new URL('./fixtures/msgpack_packets.json', import.meta.url), 'utf-8'),
+);
+
+const fromHex = (hex: string) => Uint8Array.from(hex.match(/../g) ?? [], b => parseInt(b, 16));
+const toHex = (bytes: Uint8Array) => Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+
+// fixture の {"$bigint"} / {"$date"} を bigint / Date に戻す
+function revive(v: unknown): unknown {
+  if (Array.isArray(v)) return v.map(revive);
+  if (v !== null && typeof v === 'object') {
+    const o = v as Record<string, unknown>;
+    if (typeof o.$bigint === 'string') return BigInt(o.$bigint);
+    if (typeof o.$date === 'number') return new Date(o.$date);
+    return Object.fromEntries(Object.entries(o).map(([k, x]) => [k, revive(x)]));
+  }
+  return v;
+}
+
+for (const f of fixtures) {
+  test(`python-socketio packet: ${f.name}`, () => {
+    const bytes = fromHex(f.hex);
+    if (f.error) {
+      assert.throws(() => decode(bytes), new RegExp(f.error));
+      return;
+    }
+    const value = decode(bytes);
+    assert.deepStrictEqual(value, revive(f.expected));
+    // 同じ値を書き戻すと Python と同じバイト列になる
+    assert.equal(toHex(encode(value)), f.hex);
+  });
+}
+
+test('str8 / str16 / str32 headers', () => {
+  for (const [length, header] of [[31, 0xa0 | 31], [32, 0xd9], [255, 0xd9], [256, 0xda], [65535, 0xda], [65536, 0xdb]]) {
+    const s = 'x'.repeat(length);
+    const bytes = encode(s);
+    assert.equal(bytes[0], header, `length ${length}`);
+    assert.equal(decode(bytes), s);
+  }
+});
+
+test('int64 boundaries', () => {
+  const cases: [number | bigint, number][] = [
+    [0xffffffff, 0xce],
+    [0x100000000, 0xcf],
+    [Number.MAX_SAFE_INTEGER, 0xcf],
+    [2n ** 64n - 1n, 0xcf],
+    [-0x80000000, 0xd2],
+    [-0x80000001, 0xd3],
+    [Number.MIN_SAFE_INTEGER, 0xd3],
+    [-(2n ** 63n), 0xd3],
+  ];
+  for (const [v, header] of cases) {
+    const bytes = encode(v);
+    assert.equal(bytes[0], header, String(v));
+    assert.equal(decode(bytes), v);
+  }
+  // Number で表せない値は bigint のまま返す
+  assert.equal(decode(encode(2n ** 53n)), 2n ** 53n);
+  assert.equal(decode(encode(2n ** 53n - 1n)), Number.MAX_SAFE_INTEGER);
+  assert.throws(() => encode(2n ** 64n), /64 bits/);
+});
+
+test('timestamp ext round trip', () => {
+  for (const [iso, header] of [
+    ['2026-10-19T00:00:00.000Z', 0xd6],
+    ['2026-10-19T12:34:56.789Z', 0xd7],
+    ['1960-01-01T00:00:00.500Z', 0xc7],
+  ] as const) {
+    const d = new Date(iso);
+    const bytes = encode(d);
+    assert.equal(bytes[0], header, iso);
+    assert.deepStrictEqual(decode(bytes), d);
+  }
+});
+
+test('truncated data is rejected', () => {
+  const bytes = encode({ text: 'タイムマシン' });
+  assert.throws(() => decode(bytes.subarray(0, bytes.length - 2)));
+});
+
+test('Encoder / Decoder hand packets to socket.io-client', () => {
+  const [event] = fixtures;
+  const packet = revive(event.expected) as { type: number; nsp: string; data: unknown };
+  const decoder = new Decoder();
+  const seen: unknown[] = [];
+  decoder.on('decoded', p => seen.push(p));
+  for (const chunk of new Encoder().encode(packet)) decoder.add(chunk);
+  assert.deepStrictEqual(seen, [packet]);
+  assert.throws(() => decoder.add('2["nao_event"]'), /binary/);
+});